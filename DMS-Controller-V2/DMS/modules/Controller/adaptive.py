@@ -0,0 +1,68 @@
+# Poll interval of each module, adapted to the rate at which its sensors produce values.
+# A module stores the values of a sensor until it is polled, in a buffer of fixed size (MEM seconds at the fastest
+# sample rate of the sensor, see the attribute response). When the buffer is full, new values are lost. The
+# production rate of every sensor is estimated from the number of values in each telemetry response and the time
+# since the previous response; a response without new values counts as zero values. The module is polled when
+# its fullest buffer is expected to reach TargetFill of its capacity.
+# A rising rate is followed at once, so a module which speeds up is not allowed to overflow. A full buffer only
+# gives a lower bound of the rate, so the estimate is doubled until the buffer is no longer full when polled.
+# A falling rate is followed gradually, so the interval of an idle module grows step by step up to MaxInterval.
+
+# Gain of a falling rate estimate
+ALPHA = 0.25
+
+class PollRateController:
+    def __init__(self):
+        # {'TargetFill': ..., 'MinInterval': ..., 'MaxInterval': ...}, None when polling is not adapted
+        self.Config = None
+        # Values per second by (module name, sensor name)
+        self.Rates = dict()
+        # Timestamp of the previous telemetry response by module name
+        self.LastResponse = dict()
+
+    # Apply the twin setting. None disables adaptive polling.
+    def Configure(self, Setting: dict):
+        if(Setting is None):
+            self.Config = None
+            self.Rates.clear()
+            self.LastResponse.clear()
+            return
+        self.Config = {
+            'TargetFill': float(Setting.get('TargetFill', 0.5)),
+            'MinInterval': float(Setting.get('MinInterval', 0.1)),
+            'MaxInterval': float(Setting.get('MaxInterval', 30.0))
+        }
+
+    # Forget the estimates of a removed module
+    def RemoveModule(self, ModuleName: str):
+        self.LastResponse.pop(ModuleName, None)
+        for Key in [Key for Key in self.Rates if Key[0] == ModuleName]:
+            del self.Rates[Key]
+
+    # Update the estimates with a telemetry response. Samples is a list of (sensor name, number of values, capacity)
+    # of every sensor of the module, or None when the response had no usable values. Returns the new poll interval
+    # of the module (s), or None if it can't be estimated.
+    def Update(self, ModuleName: str, Samples: list, Timestamp: float):
+        if(self.Config is None): return None
+        Last = self.LastResponse.get(ModuleName)
+        self.LastResponse[ModuleName] = Timestamp
+        if(Samples is None or Last is None or Timestamp <= Last): return None
+        Elapsed = Timestamp - Last
+        TimeToFill = None
+        for SensorName, Count, Capacity in Samples:
+            if(not Capacity): continue
+            Rate = Count / Elapsed
+            Estimate = self.Rates.get((ModuleName, SensorName))
+            if(Count >= Capacity):
+                # Values were lost, the rate is higher than measured
+                Rate = 2 * max(Rate, Estimate or 0.0)
+            elif(Estimate is not None and Rate < Estimate):
+                Rate = (1 - ALPHA) * Estimate + ALPHA * Rate
+            self.Rates[(ModuleName, SensorName)] = Rate
+            if(Rate > 0):
+                TimeToFill = min(TimeToFill, Capacity / Rate) if TimeToFill is not None else Capacity / Rate
+        if(TimeToFill is None):
+            if(not any(Capacity for SensorName, Count, Capacity in Samples)): return None
+            # No sensor produces values
+            return self.Config['MaxInterval']
+        return min(max(self.Config['TargetFill'] * TimeToFill, self.Config['MinInterval']), self.Config['MaxInterval'])
@@ -0,0 +1,109 @@
+# Aggregation of sensor values over tumbling windows, before they are sent to the data platform adapters.
+# A sensor with an aggregation setting is not sent upstream value by value. Its values are grouped in windows of
+# a fixed length, aligned to the epoch, and every window is sent as a few statistics. The statistics of a sensor
+# are sent as sensor blocks of their own, named after the sensor and the statistic (for example 'Compass.mean'),
+# with a value per window: t0 is the start of the first window and dt the window length.
+# A window is complete when a value of a later window arrives, the values of the last window are kept until then.
+# All statistics are computed with reduceat over the values of a block, without a loop over the windows.
+# Values which are not finite (null in the telemetry, NaN or infinity) are left out of the statistics. A window
+# without any finite value is not sent.
+
+import numpy as np
+
+STATISTICS = ('min', 'max', 'mean', 'stddev', 'last')
+
+# Statistics of the values in each window. Starts are the positions of the first value of every window.
+def WindowStatistics(Values: np.ndarray, Starts: np.ndarray, Statistics: list):
+    Sizes = np.diff(np.append(Starts, len(Values)))
+    Result = dict()
+    if('min' in Statistics):
+        Result['min'] = np.minimum.reduceat(Values, Starts)
+    if('max' in Statistics):
+        Result['max'] = np.maximum.reduceat(Values, Starts)
+    Mean = np.add.reduceat(Values, Starts) / Sizes
+    if('mean' in Statistics):
+        Result['mean'] = Mean
+    if('stddev' in Statistics):
+        Deviations = Values - np.repeat(Mean, Sizes)
+        Result['stddev'] = np.sqrt(np.add.reduceat(Deviations * Deviations, Starts) / Sizes)
+    if('last' in Statistics):
+        Result['last'] = Values[Starts + Sizes - 1]
+    return Result
+
+class Aggregator:
+    def __init__(self):
+        # Settings by sensor name: {'Window': window length (ms), 'Statistics': [...], 'Raw': send the values too}
+        self.Config = dict()
+        # Values of the incomplete window by (module name, sensor name): (timestamps, values)
+        self.Pending = dict()
+
+    # Apply the twin setting of a sensor. None removes the setting.
+    def Configure(self, SensorName: str, Setting: dict):
+        for Key in [Key for Key in self.Pending if Key[1] == SensorName]:
+            del self.Pending[Key]
+        if(Setting is None):
+            self.Config.pop(SensorName, None)
+            return
+        Statistics = [Statistic for Statistic in Setting.get('Statistics', STATISTICS) if Statistic in STATISTICS]
+        self.Config[SensorName] = {
+            'Window': max(1, int(round(float(Setting['Window']) * 1000))),
+            'Statistics': Statistics,
+            'Raw': bool(Setting.get('Raw', False))
+        }
+
+    # Forget the incomplete windows of a removed module
+    def RemoveModule(self, ModuleName: str):
+        for Key in [Key for Key in self.Pending if Key[0] == ModuleName]:
+            del self.Pending[Key]
+
+    # Aggregate the sensor blocks of a module. Blocks of sensors without aggregation are returned as they are.
+    def Process(self, ModuleName: str, Blocks: list):
+        Result = []
+        for Sensor in Blocks:
+            for SensorName, Block in Sensor.items():
+                Setting = self.Config.get(SensorName)
+                if(Setting is None):
+                    Result.append(Sensor)
+                    continue
+                try:
+                    Values = np.asarray(Block['values'], dtype=np.float64)
+                except (TypeError, ValueError):
+                    # Only numeric values can be aggregated
+                    Result.append(Sensor)
+                    continue
+                if(Setting['Raw']):
+                    Result.append(Sensor)
+                Result.extend(self.Aggregate(ModuleName, SensorName, Block, Values, Setting))
+        return Result
+
+    def Aggregate(self, ModuleName: str, SensorName: str, Block: dict, Values: np.ndarray, Setting: dict):
+        Window = Setting['Window']
+        Timestamps = Block['t0'] + np.arange(len(Values), dtype=np.int64) * Block['dt']
+        Finite = np.isfinite(Values)
+        if(not Finite.all()):
+            Timestamps, Values = Timestamps[Finite], Values[Finite]
+        if((ModuleName, SensorName) in self.Pending):
+            PendingTimestamps, PendingValues = self.Pending[(ModuleName, SensorName)]
+            Timestamps = np.concatenate((PendingTimestamps, Timestamps))
+            Values = np.concatenate((PendingValues, Values))
+        Windows = Timestamps // Window
+        Starts = np.concatenate(([0], np.flatnonzero(np.diff(Windows)) + 1))
+        # The last window stays open
+        Open = Starts[-1]
+        self.Pending[(ModuleName, SensorName)] = (Timestamps[Open:], Values[Open:])
+        Starts = Starts[:-1]
+        if(len(Starts) == 0 or len(Setting['Statistics']) == 0):
+            return []
+        Statistics = WindowStatistics(Values[:Open], Starts, Setting['Statistics'])
+        # A block per run of consecutive windows
+        Windows = Windows[Starts]
+        Runs = np.concatenate(([0], np.flatnonzero(np.diff(Windows) != 1) + 1, [len(Windows)]))
+        Result = []
+        for Start, End in zip(Runs[:-1].tolist(), Runs[1:].tolist()):
+            for Statistic, Aggregates in Statistics.items():
+                Result.append({'{}.{}'.format(SensorName, Statistic): {
+                    't0': int(Windows[Start]) * Window,
+                    'dt': Window,
+                    'values': Aggregates[Start:End].tolist()
+                }})
+        return Result
@@ -0,0 +1,67 @@
+# Size benchmark of the telemetry messages from the controller to the data platform adapters.
+# Run with: python3 benchmark_upstream.py --sensors 4 --samples 10
+# A telemetry message of slowly changing sensor values is encoded in each format of upstream.py, and in the
+# format of the controller before sensor blocks (a list of {sensor: [value, timestamp]} pairs). Reported are the
+# bytes per value and the time to encode and decode a message. Every format is decoded and checked against the
+# original values.
+
+import argparse
+import json
+import time
+import numpy as np
+import upstream
+
+def Blocks(Sensors: int, Samples: int, Seed: int):
+    Random = np.random.RandomState(Seed)
+    Result = []
+    t0 = 1602935000000
+    for Sensor in range(Sensors):
+        # Random walk around a typical reading, as measured with 2 decimals
+        Values = np.round(20.0 + np.cumsum(Random.normal(0, 0.05, Samples)), 2).tolist()
+        Result.append({'Sensor{}'.format(Sensor): {'t0': t0 + Sensor, 'dt': 100, 'values': Values}})
+    return Result
+
+def Pairs(Message: list):
+    Result = []
+    for Sensor in Message:
+        for Name, Block in Sensor.items():
+            for Index, Value in enumerate(Block['values']):
+                Result.append({Name: [Value, (Block['t0'] + Index * Block['dt']) / 1000.0]})
+    return Result
+
+def Timing(Function, Repeat: int):
+    Start = time.perf_counter()
+    for _ in range(Repeat):
+        Function()
+    return (time.perf_counter() - Start) / Repeat
+
+def Main():
+    Parser = argparse.ArgumentParser(description='Size of the telemetry messages to the data platform adapters')
+    Parser.add_argument('--sensors', type=int, default=4)
+    Parser.add_argument('--samples', type=int, default=10, help='values per sensor in each message')
+    Parser.add_argument('--resolution', type=float, default=0.01, help='resolution of the quantised values')
+    Parser.add_argument('--repeat', type=int, default=2000)
+    Args = Parser.parse_args()
+
+    Message = Blocks(Args.sensors, Args.samples, 1)
+    Count = Args.sensors * Args.samples
+    Resolution = {Name: Args.resolution for Sensor in Message for Name in Sensor}
+    Expected = [(Name, Block['t0'] + np.arange(len(Block['values'])) * Block['dt'], Block['values']) for Sensor in Message for Name, Block in Sensor.items()]
+
+    Legacy = json.dumps(Pairs(Message))
+    print('Sensors: {}, values per sensor: {}, resolution: {}'.format(Args.sensors, Args.samples, Args.resolution))
+    print('{:<22} {:>8} {:>12} {:>12} {:>12}'.format('Format', 'Bytes', 'Bytes/value', 'Encode (us)', 'Decode (us)'))
+    print('{:<22} {:>8} {:>12.1f}'.format('Pairs (before v1)', len(Legacy), len(Legacy) / Count))
+    for Name, Version, Res in [('Blocks (v1)', 1, None), ('Compact (v2)', 2, None), ('Quantised (v2)', 2, Resolution)]:
+        Encode = lambda: json.dumps(upstream.Encode(Message, Res, Version), separators=(',', ':'))
+        Encoded = Encode()
+        Decode = lambda: upstream.Decode(json.loads(Encoded))
+        for (Sensor, Timestamps, Values), (ExpectedSensor, ExpectedTimestamps, ExpectedValues) in zip(Decode(), Expected):
+            assert Sensor == ExpectedSensor
+            assert Timestamps.tolist() == ExpectedTimestamps.tolist()
+            assert Values == ExpectedValues, (Name, Values, ExpectedValues)
+        print('{:<22} {:>8} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+            Name, len(Encoded), len(Encoded) / Count, Timing(Encode, Args.repeat) * 1e6, Timing(Decode, Args.repeat) * 1e6))
+
+if __name__ == '__main__':
+    Main()
@@ -0,0 +1,135 @@
+# Deadband filtering (report by exception) of sensor values, before they are sent to the data platform adapters.
+# A value of a sensor with a deadband setting is only sent upstream if it differs from the last value sent by more
+# than the deadband: the largest of the Absolute threshold and the Relative threshold times the last value sent.
+# If nothing was sent for Heartbeat seconds, the next value is sent anyway, so the data platform can tell a flat
+# sensor from a dead one.
+# Values which are not finite (null in the telemetry, NaN or infinity) are always sent, because a missing value is
+# news to the data platform, but they never become the value compared with: the next finite value is compared with
+# the last finite value sent.
+# Each block is compared with NumPy masks. After a value is sent, the next values are compared with it in a window
+# which doubles while no value leaves the deadband: a flat block costs a few passes. The first window is compared
+# value by value, which is faster than a NumPy call for a few values, so a noisy block costs a few comparisons per
+# value sent. The values left are sent as blocks of consecutive values, which keeps t0 and dt exact.
+
+import numpy as np
+
+# Number of values compared at once after a value is sent
+FIRST_WINDOW = 8
+
+class DeadbandFilter:
+    def __init__(self):
+        # Settings by sensor name: {'Absolute': ..., 'Relative': ..., 'Heartbeat': largest silence (ms) or None}
+        self.Config = dict()
+        # Timestamp and value last sent by (module name, sensor name)
+        self.Last = dict()
+        # Number of values received and suppressed by (module name, sensor name)
+        self.Counters = dict()
+
+    # Apply the twin setting of a sensor. None removes the setting.
+    def Configure(self, SensorName: str, Setting: dict):
+        for Key in [Key for Key in self.Last if Key[1] == SensorName]:
+            del self.Last[Key]
+        if(Setting is None):
+            self.Config.pop(SensorName, None)
+            return
+        self.Config[SensorName] = {
+            'Absolute': float(Setting.get('Absolute', 0.0)),
+            'Relative': float(Setting.get('Relative', 0.0)),
+            'Heartbeat': int(float(Setting['Heartbeat']) * 1000) if Setting.get('Heartbeat') else None
+        }
+
+    # Forget the state of a removed module
+    def RemoveModule(self, ModuleName: str):
+        for Table in (self.Last, self.Counters):
+            for Key in [Key for Key in Table if Key[0] == ModuleName]:
+                del Table[Key]
+
+    # Filter the sensor blocks of a module. Blocks of sensors without a deadband are returned as they are.
+    def Process(self, ModuleName: str, Blocks: list):
+        Result = []
+        for Sensor in Blocks:
+            for SensorName, Block in Sensor.items():
+                Setting = self.Config.get(SensorName)
+                if(Setting is None):
+                    Result.append(Sensor)
+                    continue
+                try:
+                    Values = np.asarray(Block['values'], dtype=np.float64)
+                except (TypeError, ValueError):
+                    # Only numeric values can be compared
+                    Result.append(Sensor)
+                    continue
+                Timestamps = Block['t0'] + np.arange(len(Values), dtype=np.int64) * Block['dt']
+                Keep = self.Filter((ModuleName, SensorName), Setting, Timestamps, Values)
+                Counters = self.Counters.setdefault((ModuleName, SensorName), {'Received': 0, 'Suppressed': 0})
+                Counters['Received'] += len(Values)
+                Counters['Suppressed'] += len(Values) - int(np.count_nonzero(Keep))
+                # A block per run of consecutive values
+                Kept = np.flatnonzero(Keep)
+                Runs = np.concatenate(([0], np.flatnonzero(np.diff(Kept) != 1) + 1, [len(Kept)]))
+                for Start, End in zip(Runs[:-1].tolist(), Runs[1:].tolist()):
+                    if(Start == End): continue
+                    Result.append({SensorName: {
+                        't0': int(Timestamps[Kept[Start]]),
+                        'dt': Block['dt'],
+                        'values': Block['values'][Kept[Start]:Kept[End - 1] + 1]
+                    }})
+        return Result
+
+    # Mask of the values to send. Values which are not finite are always sent, and do not change the last value sent.
+    def Filter(self, Key: tuple, Setting: dict, Timestamps: np.ndarray, Values: np.ndarray):
+        Finite = np.isfinite(Values)
+        if(not Finite.all()):
+            Keep = ~Finite
+            Keep[Finite] = self.Filter(Key, Setting, Timestamps[Finite], Values[Finite])
+            return Keep
+        Keep = np.zeros(len(Values), dtype=bool)
+        ValueList = Values.tolist()
+        TimeList = Timestamps.tolist()
+        Heartbeat = Setting['Heartbeat']
+        LastTime, LastValue = self.Last.get(Key, (None, None))
+        Position = 0
+        Window = FIRST_WINDOW
+        while(Position < len(Values)):
+            Index = None
+            End = min(Position + Window, len(Values))
+            if(LastValue is None):
+                Index = Position
+            elif(Window == FIRST_WINDOW):
+                Deadband = max(Setting['Absolute'], Setting['Relative'] * abs(LastValue))
+                for i in range(Position, End):
+                    if(abs(ValueList[i] - LastValue) > Deadband or (Heartbeat is not None and TimeList[i] - LastTime >= Heartbeat)):
+                        Index = i
+                        break
+            else:
+                Deadband = max(Setting['Absolute'], Setting['Relative'] * abs(LastValue))
+                Changed = np.abs(Values[Position:End] - LastValue) > Deadband
+                if(Heartbeat is not None):
+                    Changed |= Timestamps[Position:End] - LastTime >= Heartbeat
+                Hits = np.flatnonzero(Changed)
+                if(len(Hits) > 0):
+                    Index = Position + int(Hits[0])
+            if(Index is None):
+                Position = End
+                Window *= 2
+                continue
+            Keep[Index] = True
+            LastTime, LastValue = TimeList[Index], ValueList[Index]
+            Position = Index + 1
+            Window = FIRST_WINDOW
+        self.Last[Key] = (LastTime, LastValue)
+        return Keep
+
+    # Add the counters of a worker process (see shards.py)
+    def AddCounters(self, Counters: dict):
+        for Key, Value in Counters.items():
+            Total = self.Counters.setdefault(Key, {'Received': 0, 'Suppressed': 0})
+            Total['Received'] += Value['Received']
+            Total['Suppressed'] += Value['Suppressed']
+
+    # Counters for the reported properties, by module name and sensor name
+    def Report(self):
+        Report = dict()
+        for (ModuleName, SensorName), Counters in self.Counters.items():
+            Report.setdefault(ModuleName, dict())[SensorName] = dict(Counters)
+        return Report
@@ -0,0 +1,74 @@
+# Recent values of a sensor, kept in memory so they can be queried locally without going through the cloud.
+# Every sensor has a ring buffer of fixed capacity: two preallocated NumPy arrays with the timestamps (ms since
+# epoch) and the values. When the buffer is full, new values overwrite the oldest ones, so the memory used by a
+# sensor never grows beyond 16 bytes per value of capacity.
+
+import numpy as np
+
+class RingBuffer:
+    def __init__(self, Capacity: int):
+        self.Capacity = max(1, int(Capacity))
+        self.Timestamps = np.zeros(self.Capacity, dtype=np.int64)
+        self.Values = np.zeros(self.Capacity, dtype=np.float64)
+        # Position of the next value
+        self.Head = 0
+        # Number of values held
+        self.Count = 0
+
+    def __len__(self):
+        return self.Count
+
+    # Add a sensor block: values sampled every dt ms, starting at t0
+    def Append(self, t0: int, dt: int, Values: list):
+        Values = np.asarray(Values, dtype=np.float64)
+        Timestamps = t0 + np.arange(len(Values), dtype=np.int64) * dt
+        if(len(Values) > self.Capacity):
+            Values = Values[-self.Capacity:]
+            Timestamps = Timestamps[-self.Capacity:]
+        Positions = (self.Head + np.arange(len(Values))) % self.Capacity
+        self.Timestamps[Positions] = Timestamps
+        self.Values[Positions] = Values
+        self.Head = (self.Head + len(Values)) % self.Capacity
+        self.Count = min(self.Count + len(Values), self.Capacity)
+
+    # All values held, oldest first
+    def Ordered(self):
+        Positions = (self.Head - self.Count + np.arange(self.Count)) % self.Capacity
+        return self.Timestamps[Positions], self.Values[Positions]
+
+    # Values with a timestamp between Start and End (ms, inclusive). The timestamps are compared one by one
+    # instead of searched, because they jump back when the clock of a module is synchronised again.
+    def Window(self, Start: int = None, End: int = None):
+        Timestamps, Values = self.Ordered()
+        Mask = np.ones(len(Timestamps), dtype=bool)
+        if(Start is not None):
+            Mask &= Timestamps >= Start
+        if(End is not None):
+            Mask &= Timestamps <= End
+        return Timestamps[Mask], Values[Mask]
+
+    # Change the capacity, keeping the newest values
+    def Resize(self, Capacity: int):
+        Timestamps, Values = self.Ordered()
+        self.Capacity = max(1, int(Capacity))
+        Timestamps = Timestamps[-self.Capacity:]
+        Values = Values[-self.Capacity:]
+        self.Timestamps = np.zeros(self.Capacity, dtype=np.int64)
+        self.Values = np.zeros(self.Capacity, dtype=np.float64)
+        self.Timestamps[:len(Values)] = Timestamps
+        self.Values[:len(Values)] = Values
+        self.Count = len(Values)
+        self.Head = self.Count % self.Capacity
+
+# Reduce a window to at most MaxPoints values. Consecutive values are averaged in buckets of equal size,
+# each bucket has the timestamp of its first value. None keeps all values, less than 1 is taken as 1.
+def Decimate(Timestamps: np.ndarray, Values: np.ndarray, MaxPoints: int):
+    if(MaxPoints is None):
+        return Timestamps, Values
+    MaxPoints = max(1, MaxPoints)
+    if(len(Values) <= MaxPoints):
+        return Timestamps, Values
+    Step = -(-len(Values) // MaxPoints)
+    Starts = np.arange(0, len(Values), Step)
+    Sizes = np.diff(np.append(Starts, len(Values)))
+    return Timestamps[Starts], np.add.reduceat(Values, Starts) / Sizes
@@ -3,13 +3,29 @@
 # full license information.
 
 import datetime
+import math
 import os
 import sys
+import time
 import asyncio
 from azure.iot.device.aio import IoTHubModuleClient
-from azure.iot.device import Message
+from azure.iot.device import Message, MethodResponse
 import json
+import logging
+import log
 import config
+from registry import ModuleRegistry, ModuleRecord
+from history import Decimate
+from aggregation import Aggregator
+from deadband import DeadbandFilter
+from polling import PollScheduler
+from adaptive import PollRateController
+from queues import BoundedQueue, BLOCK, COALESCE
+from metrics import MetricsRegistry, METRICS_PORT
+from profiling import Profiler, PROFILE_PATH
+from telemetry import SensorBlocks, LastTimestamp, CountValues
+from shards import ShardPool
+import upstream
 
 """
     This is an example of how the IoT Edge module twin should look like.
@@ -17,7 +33,8 @@ import config
         "Modules":{
             "SWT-Head-Module":{
                 "Interface": "SerialInterface",
-                "Address": 1
+                "Address": 1,
+                "PollInterval": 0.5
             }
             "SWT-Rotor-Module":{
                 "Interface": "BluetoothInterface",
@@ -30,96 +47,330 @@ import config
                 "Interface": "NetworkInterface",
                 "Address": "192.168.1.123"
             }
-        }
+        },
+        "BroadcastInterval": 1,
+        "PollInterval": 1,
+        "PollTimeout": 5,
+        "PollFailures": 5,
+        "AdaptivePolling": {
+            "TargetFill": 0.5,
+            "MinInterval": 0.1,
+            "MaxInterval": 30
+        },
+        "UpstreamVersion": 2,
+        "Resolution": {
+            "Compass": 0.1
+        },
+        "HistorySize": 3600,
+        "Aggregation": {
+            "Compass": {
+                "Window": 60,
+                "Statistics": ["mean", "min", "max"],
+                "Raw": false
+            }
+        },
+        "Deadband": {
+            "Strain": {
+                "Absolute": 0.5,
+                "Relative": 0.01,
+                "Heartbeat": 300
+            }
+        },
+        "ReportInterval": 60,
+        "LogLevel": "INFO",
+        "LogRate": 10,
+        "Queues": {
+            "InterfaceIn": {"MaxSize": 1000, "Policy": "block"},
+            "InterfaceOut": {"MaxSize": 1000, "Policy": "coalesce"},
+            "CloudOut": {"MaxSize": 1000, "Policy": "block"}
+        },
+        "Profile": {"Id": "slow-polls-1", "Mode": "sample", "Duration": 60, "Interval": 0.01, "SlowCallback": 0.1},
+        "Shards": 3
+    }
+    If BroadcastInterval (s) is set, all serial modules are polled for telemetry at once with a broadcast request.
+    A serial module can have a "Port" entry with the name of the serial port it is connected to, as configured
+    in the SerialInterface twin. Modules on different ports can have the same address.
+    A module set to null is removed.
+    Modules which are not polled by broadcast are polled for telemetry every PollInterval (s), or the PollInterval
+    of the module if set (see polling.py). A module has one request in flight at most. A request without response
+    for PollTimeout seconds has failed, failed requests are retried with a growing delay. After PollFailures failures
+    in a row, the module is discovered again with attribute requests. A PollInterval or PollTimeout which is not a
+    positive number is logged and ignored.
+    With AdaptivePolling, modules without their own PollInterval are polled when the fullest sensor buffer of the
+    module is expected to be TargetFill full, but not more often than every MinInterval and at least every
+    MaxInterval (see adaptive.py). Null switches back to PollInterval.
+    Telemetry is sent to the adapters in the format of UpstreamVersion (see upstream.py). With version 2, the values of
+    the sensors in Resolution are quantised to that resolution.
+    The last HistorySize values of every sensor are kept in memory, and can be queried with the GetHistory direct
+    method. The payload selects a module, optionally a sensor, and either the last Seconds or a Start and End
+    timestamp (ms since epoch):
+    {
+        "Module": "SWT-Head-Module",
+        "Sensor": "Compass",
+        "Seconds": 60,
+        "MaxPoints": 100
     }
+    Windows with more than MaxPoints values are reduced by averaging consecutive values.
+    The values of the sensors in Aggregation are sent upstream as statistics over windows of Window seconds (see
+    aggregation.py). Statistics can be min, max, mean, stddev and last, all of them if omitted. With Raw, the values
+    are sent as well. A sensor set to null is sent as it is again.
+    Values of the sensors in Deadband are only sent if they differ from the last value sent by more than Absolute,
+    or by more than Relative times that value, or if nothing was sent for Heartbeat seconds (see deadband.py).
+    The number of values received and suppressed, and the polling statistics, are reported every ReportInterval
+    seconds.
+    The queues between the tasks are bounded, each with a MaxSize and a Policy for a full queue: block, drop-oldest,
+    drop-newest or coalesce (see queues.py). Identical commands in InterfaceOut are coalesced. While one of the
+    queues, or the queue of an adapter, is congested, no telemetry requests are sent: the values stay in the buffers
+    of the modules until the messages already received have been processed and sent upstream. The adapters report
+    their congestion in Backpressure messages on the AdapterIn input. The queue statistics are reported with the
+    polling statistics.
+    The log lines of all tasks are JSON objects (see log.py). LogLevel sets the level of all tasks, or of each task
+    by name with a dict, for example {"Default": "INFO", "Process messages": "DEBUG"}. At most LogRate lines per
+    second are written for every message, 0 writes all lines.
+    Throughput, queue depths and the latency of every stage are kept in metrics (see metrics.py). They are reported
+    in Metrics, and served in the Prometheus text format on http://Controller:METRICS_PORT/metrics.
+    A Profile with a new Id starts a profiling session of Duration seconds (see profiling.py). The state of the
+    session is reported in Profile, the results are kept in PROFILE_PATH and fetched with the direct method
+    GetProfile.
+    With Shards set, the telemetry is converted, aggregated, filtered and encoded in Shards worker processes
+    instead of the event loop (see shards.py). The modules are divided over the workers by interface type and
+    address, the telemetry of a module is sent upstream in order. A gateway with N cores can use N - 1 shards.
+    The state of the shards is reported in Shards.
 """
 
 # UTILITIES
-# Find index of module
-def FindModuleByTypeAndAddress(Modules: dict, Type, Address):
-    # There can be only 1 bluetooth module be connected to the controller
-    if(Type == 'BluetoothInterface'):
-        for Key, Value in Modules.items():
-            if(Value['InterfaceType'] == Type):
-                return Key
-        return None
-    elif(Type == 'SerialInterface'):
-        for Key, Value in Modules.items():
-            if(
-                Value['InterfaceType'] == Type and
-                Value['Address'] == Address
-                ):
-                return Key
+# Construct a command for a module, sent on the port the module is connected to
+def ModuleCommand(Module: ModuleRecord, FunctionCode: int):
+    Msg = {
+        'InterfaceType': Module.InterfaceType,
+        'MessageType': 'ModuleCommand',
+        'Address': Module.Address,
+        'FunctionCode': FunctionCode
+    }
+    if(Module.Port is not None):
+        Msg['Port'] = Module.Port
+    return Msg
+
+# Modules which announced binary telemetry support in their attribute response are polled with binary requests
+def TelemetryRequestCode(Module: ModuleRecord):
+    return config.REQ_TEL_BINARY if Module.Binary else config.REQ_TEL
+
+# Number of values of each sensor of a module in a telemetry response, as (sensor name, number of values, number
+# of values the module can store). None if the response holds no values because of an error.
+def SampleCounts(Module: ModuleRecord, Msg: dict, Code: int):
+    global Registry
+    Counts = dict()
+    if(Code in (config.RESP_TEL_SUCCESS, config.RESP_TEL_BINARY_SUCCESS)):
+        for data in Msg['Message']:
+            SensorName = data[0]
+            if(isinstance(SensorName, int)):
+                SensorName = Module.SensorNames[SensorName]
+            Counts[SensorName] = len(data[3])
+    elif(Code != config.RESP_TEL_NO_NEW_VALUES):
         return None
+    Samples = []
+    for SensorName in Module.SensorNames:
+        Sensor = Registry.FindSensor(Module.Name, SensorName)
+        Samples.append((SensorName, Counts.get(SensorName, 0), Sensor.Capacity if Sensor is not None else None))
+    return Samples
 
-# Find index of sensor
-def FindSensorByModuleAndName(Sensors: dict, SensorName, ModuleName):
-    for Key, Value in Sensors.items():
-            if(Key == SensorName):
-                if(Value['ModuleName'] == ModuleName):
-                    return Key
-    return None
+# Messages are waiting in a congested queue, of the controller or of an adapter. New telemetry requests would only
+# add to them.
+def Congested():
+    global Queues, AdapterBackpressure
+    if(any(Queue.Congested for Queue in Queues.values())): return True
+    Now = asyncio.get_event_loop().time()
+    return any(Until > Now for Until in AdapterBackpressure.values())
 
-# Message scheduler callback
-async def ScheduleMessage(delay: float, Queue: asyncio.Queue, Msg):
-    await asyncio.sleep(delay)
-    await Queue.put(Msg)
+# Histogram of the time messages wait in a queue
+def QueueWait(Name: str):
+    global Metrics
+    return Metrics.Histogram('dms_queue_wait_seconds', 'Time messages wait in a queue', {'queue': Name})
 
-# Schedule a new telemetry request on the event loop, for when it needs to be sent to the module
-def ScheduleTelemetryRequest(loop: asyncio.AbstractEventLoop, Queue: asyncio.Queue, Module, delay: float):
-    print('Scheduling new telemtry request on event loop')
-    Msg = {
-        'InterfaceType': Module['InterfaceType'],
-        'MessageType': 'ModuleCommand',
-        'Address': Module['Address'],
-        'FunctionCode': config.REQ_TEL
-    }
-    loop.create_task( ScheduleMessage( delay, Queue, Msg) )
+# Depth and drop counters of a queue
+def QueueMetrics(Name: str, Queue: BoundedQueue):
+    global Metrics
+    Metrics.Gauge('dms_queue_depth', 'Messages waiting in a queue', {'queue': Name}, Queue.qsize)
+    Metrics.Counter('dms_queue_dropped_total', 'Messages dropped by a full queue', {'queue': Name}, lambda: Queue.Stats['Dropped'])
+    Metrics.Counter('dms_queue_coalesced_total', 'Messages replaced by a newer message in a queue', {'queue': Name}, lambda: Queue.Stats['Coalesced'])
 
+# Coalescing key of a command: identical commands give the same answer
+def CommandKey(Msg: dict):
+    return json.dumps(Msg, sort_keys=True)
 
-async def ManageModules(InterfaceOut: asyncio.Queue):
-    global Modules, Sensors
-    while(True):
-        for ModuleName, Properties in Modules.items():
-            if(not Properties['Complete']):
-                print('Manage modules: Incomplete module found. Sending Attribute request to address {}'.format(Properties['Address']))
-                # Module information is not complete, request attribute update from module
+# Modules which are polled by the broadcast poller don't get their own telemetry requests
+def PolledByBroadcast(Module: ModuleRecord):
+    global Settings
+    return bool(Settings['BroadcastInterval']) and Module.InterfaceType == 'SerialInterface'
+
+# Poll all serial modules with a single broadcast telemetry request. Each module answers in its own time slot.
+async def BroadcastPoller(InterfaceOut: asyncio.Queue):
+    global Registry, Settings
+    Log = logging.getLogger('Broadcast poller')
+    try:
+        while(True):
+            if(not Settings['BroadcastInterval']):
+                await asyncio.sleep(1)
+                continue
+            if(Congested()):
+                await asyncio.sleep(Settings['BroadcastInterval'])
+                continue
+            # One broadcast per serial port
+            Ports = dict()
+            for Module in Registry.Modules.values():
+                if(Module.InterfaceType == 'SerialInterface' and Module.Complete):
+                    Ports.setdefault(Module.Port, []).append(Module)
+            for Port, Polled in Ports.items():
+                # Binary requests can only be broadcast if every module understands them
+                Code = config.REQ_TEL_BINARY if all(Module.Binary for Module in Polled) else config.REQ_TEL
                 Msg = {
-                    'InterfaceType': Properties['InterfaceType'],
+                    'InterfaceType': 'SerialInterface',
                     'MessageType': 'ModuleCommand',
-                    'Address': Properties['Address'],
-                    'FunctionCode': config.REQ_ATT
+                    'Address': config.ADDRESS_BROADCAST,
+                    'FunctionCode': Code,
+                    # Lets the serial interface stop listening as soon as all modules have answered
+                    'Addresses': [Module.Address for Module in Polled]
                 }
+                if(Port is not None):
+                    Msg['Port'] = Port
+                await InterfaceOut.put(Msg)
+            await asyncio.sleep(Settings['BroadcastInterval'])
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
+
+
+# Send telemetry requests to the modules when their polls are due
+async def PollModules(InterfaceOut: asyncio.Queue):
+    global Registry, Polls
+    Log = logging.getLogger('Poll modules')
+    loop = asyncio.get_event_loop()
+    try:
+        while(True):
+            await Polls.Wait(loop.time())
+            Now = loop.time()
+            Polled, Rediscover = Polls.Due(Now)
+            for Name in Rediscover:
+                Module = Registry.Modules.get(Name)
+                if(Module is not None):
+                    # ManageModules sends attribute requests until the module answers
+                    Log.warning('No response from module %s, discovering it again', Name)
+                    Module.Complete = False
+            Throttled = Congested()
+            for Name in Polled:
+                Module = Registry.Modules.get(Name)
+                if(Module is None or not Module.Complete or PolledByBroadcast(Module)):
+                    Polls.Skip(Name, Now)
+                    continue
+                if(Throttled):
+                    Polls.Throttle(Name, Now)
+                    continue
+                try:
+                    InterfaceOut.put_nowait(ModuleCommand(Module, TelemetryRequestCode(Module)))
+                except asyncio.QueueFull:
+                    Polls.Throttle(Name, Now)
+                    continue
+                Polls.Sent(Name, Now)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
+
+async def ManageModules(InterfaceOut: asyncio.Queue):
+    global Registry
+    Log = logging.getLogger('Manage modules')
+    while(True):
+        for Module in list(Registry.Modules.values()):
+            if(not Module.Complete):
+                Log.info('Incomplete module found. Sending attribute request to address %s', Module.Address)
+                # Module information is not complete, request attribute update from module
+                Msg = ModuleCommand(Module, config.REQ_ATT)
                 await InterfaceOut.put(Msg)
         await asyncio.sleep(10)
 
+# A poll interval or timeout from the twin (s). Returns None if it is not a positive number, the setting is ignored then.
+def PositiveSeconds(Name: str, Value):
+    Seconds = float(Value)
+    if(math.isfinite(Seconds) and Seconds > 0):
+        return Seconds
+    logging.getLogger('Update properties').warning('%s must be a positive number of seconds, %s is ignored', Name, Value)
+    return None
+
 # Update settings from received twin properties
 def UpdateProperties(Twin: dict):
-    global Modules, Sensors, Settings
+    global Registry, Settings, Aggregation, Deadband, Polls, Rates, Queues, Profiling, Shards
+    Log = logging.getLogger('Update properties')
+    Now = asyncio.get_event_loop().time()
+    if('PollInterval' in Twin):
+        Interval = PositiveSeconds('PollInterval', Twin['PollInterval'])
+        if(Interval is not None):
+            Polls.SetInterval(Interval, Now)
+    if('PollTimeout' in Twin):
+        Timeout = PositiveSeconds('PollTimeout', Twin['PollTimeout'])
+        if(Timeout is not None):
+            Polls.Timeout = Timeout
+    if('PollFailures' in Twin):
+        Polls.MaxFailures = int(Twin['PollFailures'])
+    if('AdaptivePolling' in Twin):
+        Rates.Configure(Twin['AdaptivePolling'])
+        if(Rates.Config is None):
+            Polls.SetInterval(Polls.Interval, Now)
     if('Modules' in Twin):
         for Key, Value in Twin['Modules'].items():
-            if(Key not in Modules):
-                print('Update properties: Registering new module')
-                # new module
-                ModuleTemplate = {
-                    
-                    Key:{
-                        'InterfaceType': Value['InterfaceType'],
-                        'Address': Value['Address'],
-                        'Complete': False
-                    }
-                }
-                print('Update properties: ', ModuleTemplate)
-                Modules.update(ModuleTemplate)
+            if(Value is None):
+                Log.info('Removing module %s', Key)
+                Registry.RemoveModule(Key)
+                Aggregation.RemoveModule(Key)
+                Deadband.RemoveModule(Key)
+                Shards.Configure('RemoveModule', Key, None)
+                Polls.Remove(Key)
+                Rates.RemoveModule(Key)
+                continue
+            if(Key not in Registry.Modules):
+                Log.info('Registering new module %s', Key)
+            Module = Registry.SetModule(Key, Value['InterfaceType'], Value['Address'], Value.get('Port'))
+            # Without a valid interval of its own, the module is polled every PollInterval
+            Polls.Add(Key, Now, PositiveSeconds('PollInterval of module {}'.format(Key), Value['PollInterval']) if Value.get('PollInterval') is not None else None)
+            Log.info('Module %s', Module)
+    if('BroadcastInterval' in Twin):
+        Settings['BroadcastInterval'] = Twin['BroadcastInterval']
+    if('UpstreamVersion' in Twin):
+        Settings['UpstreamVersion'] = int(Twin['UpstreamVersion'])
+    if('Resolution' in Twin):
+        for Key, Value in Twin['Resolution'].items():
+            if(Value is None):
+                Settings['Resolution'].pop(Key, None)
             else:
-                Modules[Key]['InterfaceType'] = Value['InterfaceType']
-                Modules[Key]['Address'] = Value['Address']
-                print('Update properties: Updating module', Modules[Key])
+                Settings['Resolution'][Key] = float(Value)
+    if('UpstreamVersion' in Twin or 'Resolution' in Twin):
+        Shards.Configure('Upstream', None, (dict(Settings['Resolution']), Settings['UpstreamVersion']))
+    if('HistorySize' in Twin):
+        Registry.SetHistorySize(int(Twin['HistorySize']))
+    if('Aggregation' in Twin):
+        for Key, Value in Twin['Aggregation'].items():
+            Aggregation.Configure(Key, Value)
+            Shards.Configure('Aggregation', Key, Value)
+    if('Deadband' in Twin):
+        for Key, Value in Twin['Deadband'].items():
+            Deadband.Configure(Key, Value)
+            Shards.Configure('Deadband', Key, Value)
+    if('ReportInterval' in Twin):
+        Settings['ReportInterval'] = float(Twin['ReportInterval'])
+    if('LogLevel' in Twin):
+        log.SetLevel(Twin['LogLevel'])
+    if('LogRate' in Twin):
+        log.SetRate(Twin['LogRate'])
+    if('Queues' in Twin):
+        for Key, Value in Twin['Queues'].items():
+            if(Key in Queues and Value is not None):
+                Queues[Key].Configure(Value.get('MaxSize'), Value.get('Policy'))
+    if('Shards' in Twin):
+        Settings['Shards'] = max(0, int(Twin['Shards'] or 0))
+    if('Profile' in Twin):
+        Profiling.Request(Twin['Profile'])
     return
 
 # IOT EDGE MESSAGE PROCESSORS
 # Listens to incoming messages from interface adapter, like the Serial interface and the Bluetooth interface
 async def InterfaceReceiver(Client: IoTHubModuleClient, InterfaceIn: asyncio.Queue):
+    Log = logging.getLogger('Interface receiver')
     try:
         while(True):
             try:
@@ -127,240 +378,443 @@ async def InterfaceReceiver(Client: IoTHubModuleClient, InterfaceIn: asyncio.Que
                 Msg = input_message.data
                 try:
                     Msg = json.loads(Msg)
-                    print('Interface receiver: Message available.', Msg)
-                    if(Msg['MessageType'] == 'ModuleResponse'):
-                        await InterfaceIn.put(Msg)
-                        print('Interface receiver: Message queued.')
+                    Log.debug('Message available', extra={'Message': Msg})
+                    # An interface adapter can send a batch of responses as a list
+                    for Item in (Msg if isinstance(Msg, list) else [Msg]):
+                        if(Item['MessageType'] == 'ModuleResponse'):
+                            await InterfaceIn.put(Item)
+                    Log.debug('Message queued')
                 except json.JSONDecodeError as ex:
-                    print('Interface receiver: Error decoding JSON - {}'.format(ex))
+                    Log.error('Error decoding JSON - %s', ex)
             except Exception as ex:
-                print('Message receiver: Error - {}'.format(ex))
+                Log.error('Error - %s', ex)
             
     except asyncio.CancelledError:
-        print('Interface receiver: Task cancelled.')
+        Log.info('Task cancelled')
+
+# Listens to the backpressure messages of the data platform adapters
+async def AdapterReceiver(Client: IoTHubModuleClient):
+    global AdapterBackpressure
+    Log = logging.getLogger('Adapter receiver')
+    try:
+        while(True):
+            try:
+                input_message = await Client.receive_message_on_input('AdapterIn')  # blocking call
+                Msg = json.loads(input_message.data)
+                if(Msg['MessageType'] == 'Backpressure'):
+                    if(Msg['Congested']):
+                        # An adapter repeats the message while it is congested, the last one expires
+                        AdapterBackpressure[Msg['Adapter']] = asyncio.get_event_loop().time() + BACKPRESSURE_TIMEOUT
+                    else:
+                        AdapterBackpressure.pop(Msg['Adapter'], None)
+                    Log.info('%s congested - %s', Msg['Adapter'], Msg['Congested'])
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 # Sends messages to modules
 async def InterfaceSender(Client: IoTHubModuleClient, InterfaceOut: asyncio.Queue):
+    Log = logging.getLogger('Interface sender')
+    Latency = Metrics.Histogram('dms_send_seconds', 'Time to send a message to another module', {'output': 'InterfaceOut'})
     try:
         while(True):
             data = await InterfaceOut.get()
-            print('Interface sender: Message to send.', data)
+            Log.debug('Message to send', extra={'Message': data})
+            Start = time.perf_counter()
             msg = json.dumps(data)
             msg = Message(msg)
             try:
                 await Client.send_message_to_output(msg, 'InterfaceOut')
+                Latency.Record(time.perf_counter() - Start)
                 InterfaceOut.task_done()
             except Exception as ex:
-                print ('Interface sender: Unexpected error in sender: {}'.format(ex))
-            print('Interface sender: Finished sending')
+                Log.error('Unexpected error in sender - %s', ex)
+            Log.debug('Finished sending')
     except asyncio.CancelledError:
-        print('Interface sender: Task cancelled')
+        Log.info('Task cancelled')
 
 # Send values upstream
 async def DataPlatformSender(Client: IoTHubModuleClient, CloudOut: asyncio.Queue):
+    Log = logging.getLogger('Data platform sender')
+    Latency = Metrics.Histogram('dms_send_seconds', 'Time to send a message to another module', {'output': 'AdapterOut'})
+    Bytes = Metrics.Counter('dms_upstream_bytes_total', 'Bytes of telemetry sent to the adapters')
     try:
         while(True):
             data = await CloudOut.get()
             try:
-                print('Data platform sender: Message to send.', data)
-                msg = json.dumps(data)
+                Log.debug('Message to send', extra={'Message': data})
+                Start = time.perf_counter()
+                # Messages from the shards are encoded already
+                if(isinstance(data, str)):
+                    msg = data
+                else:
+                    msg = json.dumps(upstream.Encode(data, Settings['Resolution'], Settings['UpstreamVersion']), separators=(',', ':'))
+                Bytes.Add(len(msg))
                 msg = Message(msg)
                 await Client.send_message_to_output(msg, 'AdapterOut')
+                Latency.Record(time.perf_counter() - Start)
                 CloudOut.task_done()
             except Exception as ex:
-                print ('Data platform sender: Unexpected error in sender: {}'.format(ex))
-            print('Data platform sender: Finished sending')
+                Log.error('Unexpected error in sender - %s', ex)
+            Log.debug('Finished sending')
     except asyncio.CancelledError:
-        print('Data platform sender: Task cancelled')
+        Log.info('Task cancelled')
 
 
-def ProcessTelemetry(ModuleKey: str, Msg: dict):
+# Convert telemetry to a list of columnar sensor blocks (see telemetry.py), and keep the values in the history
+def ProcessTelemetry(Module: ModuleRecord, Msg: dict):
+    Log = logging.getLogger('Process telemetry')
     # There is a module for that sensor
     try:
-        Data = []
-        for data in Msg['Message']:
-            SensorName = data[0]
-            if(SensorName in Sensors):
-                # Sensor is also known
-                UpdateInterval = float(data[1]) / 1000.0
-                Timestamp = Modules[ModuleKey]['ModuleTime'] + float(data[2]) / 1000.0
-                Values = data[3]
-                # TS = Modules[ModuleKey]['Timestamp'] + Timestamp
-                Sensor = {
-                    SensorName: []
-                }
-                for value in Values:
-                    Sensor[SensorName].append([Timestamp, value])
-                    Timestamp += UpdateInterval
-                Data.append(Sensor)
-                Modules[ModuleKey]['LastUpdated'] = Timestamp
+        Data = SensorBlocks(Module.ModuleTime, Module.SensorNames, Msg['Message'])
+        for Sensor in Data:
+            for SensorName, Block in Sensor.items():
+                try:
+                    Registry.FindSensor(Module.Name, SensorName).Data.Append(Block['t0'], Block['dt'], Block['values'])
+                except (TypeError, ValueError):
+                    # Only numeric values are kept
+                    pass
+        if(Data):
+            Module.LastUpdated = LastTimestamp(Data)
         return Data
     except Exception as ex:
-        print ('Process telemetry: Error - {}'.format(ex)) 
+        Log.error('Error - %s', ex)
+
+# Apply the result of a worker process (see shards.Process): keep the values in the history and send the message
+async def ApplyTelemetry(Name: str, Result: tuple, CloudOut: asyncio.Queue, ValuesIn, ValuesOut):
+    global Registry, Deadband
+    History, LastUpdated, Received, Sent, Counters, Msg = Result
+    Module = Registry.Modules.get(Name)
+    if(Module is not None):
+        for SensorName, t0, dt, Values in History:
+            Sensor = Registry.FindSensor(Name, SensorName)
+            if(Sensor is not None):
+                Sensor.Data.Append(t0, dt, Values)
+        if(LastUpdated is not None):
+            Module.LastUpdated = LastUpdated
+    Deadband.AddCounters(Counters)
+    ValuesIn.Add(Received)
+    ValuesOut.Add(Sent)
+    if(Msg is not None):
+        await CloudOut.put(Msg)
 
 # Task to process module responses, including but not limited to telemetry and attribute responses
 async def ProcessMessages(
-        loop: asyncio.AbstractEventLoop, 
         InterfaceIn: asyncio.Queue, 
         InterfaceOut: asyncio.Queue, 
         CloudOut: asyncio.Queue
     ):
-    global Modules, Sensors
+    global Registry, Aggregation, Deadband, Polls, Rates, Shards, Settings
+    Log = logging.getLogger('Process messages')
+    Latency = Metrics.Histogram('dms_process_seconds', 'Time to process a module response')
+    Responses = Metrics.Counter('dms_responses_total', 'Module responses processed')
+    ValuesIn = Metrics.Counter('dms_values_received_total', 'Sensor values received from the modules')
+    ValuesOut = Metrics.Counter('dms_values_sent_total', 'Sensor values sent upstream, after aggregation and deadband filtering')
+    loop = asyncio.get_event_loop()
     try:
         while(True):
             # process incoming messages
             Msg = await InterfaceIn.get()
             InterfaceIn.task_done()
-            print('Process messages: Received message -', Msg)
-            if(Msg['MessageType'] == 'ModuleResponse'):
-                Code = Msg['FunctionCode']
-                # Process errors
-                if(Code in range(0, 0x10)):
-                    pass
+            if(Shards.Workers != Settings['Shards']):
+                await Shards.Resize(Settings['Shards'], (lambda Name, Result: ApplyTelemetry(Name, Result, CloudOut, ValuesIn, ValuesOut)),
+                    Settings['Resolution'], Settings['UpstreamVersion'])
+            Start = time.perf_counter()
+            Responses.Add()
+            try:
+                Log.debug('Received message', extra={'Message': Msg})
+                if(Msg['MessageType'] == 'ModuleResponse'):
+                    # The serial interface reports the code sent by the module as ResponseCode and the request code as FunctionCode
+                    Code = Msg.get('ResponseCode', Msg['FunctionCode'])
+                    # Process errors
+                    if(Code in range(0, 0x10)):
+                        # A telemetry request which failed is retried by the poll scheduler
+                        if(Msg['FunctionCode'] in (config.REQ_TEL, config.REQ_TEL_BINARY)):
+                            Module = Registry.FindModule(Msg['InterfaceType'], Msg['Address'], Msg.get('Port'))
+                            if(Module is not None and Polls.Failed(Module.Name, loop.time())):
+                                Log.warning('No telemetry from module %s, discovering it again', Module.Name)
+                                Module.Complete = False
 
-                # Process telemetry message
-                if(Code in range(config.RESP_TEL_SUCCESS, config.REQ_ATT)):
-                    # Verify if module exists
-                    print('Process messages: Received telemetry.')
-                    ModuleKey = FindModuleByTypeAndAddress(Modules, Msg['InterfaceType'], Msg['Address'])
-                    if(ModuleKey is not None):
-                        ScheduleTelemetryRequest(loop, InterfaceOut, Modules[ModuleKey], 1)
-                        if(Code == config.RESP_TEL_SUCCESS):
-                            Data = ProcessTelemetry(ModuleKey, Msg)
-                            await CloudOut.put(Data)
-                    else:
-                        print('Process messages: Corresponding module not found.')
-                
-                # Process module attributes
-                elif(Code == config.RESP_ATT_SUCCESS):
-                    body = Msg['Message']
-                    ModuleName = FindModuleByTypeAndAddress(Modules, Msg['InterfaceType'], Msg['Address'])
-
-                    if(ModuleName is not None):
-                        # Module is declared in IoT Edge twin
-                        if(Modules[ModuleName]['Complete'] == False):
-                            # Finalize setup
-                            TS = datetime.datetime.now().timestamp()
-                            ModuleTemplate = {
-                                'HardwareVersion': body['HWV'],
-                                'SoftwareVersion': body['SWV'],
-                                # Timestamp when module clock was 0
-                                'ModuleTime': Msg['Timestamp'] - (float(body['Time']) / 1000.0),
-                                'LastUpdated': TS
-                            }
-                            Modules[ModuleName].update(ModuleTemplate)
-                            Modules[ModuleName]['Complete'] = True
-                            
-                            # Schedule first time telemetry request. Next requests will be made after each telemetry response
-                            ScheduleTelemetryRequest(loop, InterfaceOut, Modules[ModuleName], 1)
+                    # Process telemetry message
+                    if(Code in range(config.RESP_TEL_SUCCESS, config.REQ_ATT)):
+                        # Verify if module exists
+                        Log.debug('Received telemetry')
+                        Module = Registry.FindModule(Msg['InterfaceType'], Msg['Address'], Msg.get('Port'))
+                        if(Module is not None):
+                            if(not PolledByBroadcast(Module)):
+                                Interval = Rates.Update(Module.Name, SampleCounts(Module, Msg, Code), Msg.get('Timestamp', time.time()))
+                                if(Interval is not None):
+                                    Polls.Adapt(Module.Name, Interval)
+                            Polls.Answered(Module.Name, loop.time())
+                            if(Code in (config.RESP_TEL_SUCCESS, config.RESP_TEL_BINARY_SUCCESS)):
+                                if(Shards.Workers > 0):
+                                    # Processed by the worker of the module, the result is applied by ApplyTelemetry
+                                    await Shards.Submit(Module, Msg)
+                                else:
+                                    Data = ProcessTelemetry(Module, Msg)
+                                    if(Data):
+                                        ValuesIn.Add(CountValues(Data))
+                                        Data = Aggregation.Process(Module.Name, Data)
+                                        Data = Deadband.Process(Module.Name, Data)
+                                    if(Data):
+                                        ValuesOut.Add(CountValues(Data))
+                                        await CloudOut.put(Data)
                         else:
-                            Modules[ModuleName]['HardwareVersion'] = body['HWV']
-                            Modules[ModuleName]['SoftwareVersion'] = body['SWV']
-                            Modules[ModuleName]['ModuleTime'] = Msg['Timestamp'] - (float(body['Time']) / 1000.0)
-                            # Modules[ModuleName]['LastUpdated'] = datetime.datetime.now().timestamp()
-                        
-                        for Sensor in body['Sensors']:
-                            if(Sensor['Name'] not in Sensors):
-                                SensorTemplate = {
-                                    Sensor['Name']:{
-                                        'ModuleName': ModuleName,
-                                        'Unit': Sensor['Unit'],
-                                        'Data': list()
-                                    }
-                                }
-                                Sensors.update(SensorTemplate)
-                            else:
-                                Sensors[Sensor['Name']]['ModuleName'] = ModuleName
-                                Sensors[Sensor['Name']]['Unit'] = Sensor['Unit']
+                            Log.warning('Corresponding module not found')
+                
+                    # Process module attributes
+                    elif(Code == config.RESP_ATT_SUCCESS):
+                        body = Msg['Message']
+                        Module = Registry.FindModule(Msg['InterfaceType'], Msg['Address'], Msg.get('Port'))
+
+                        if(Module is not None):
+                            # Module is declared in IoT Edge twin
+                            Module.Binary = body.get('BIN', 0) == 1
+                            Registry.SetSensors(Module, body['Sensors'], body.get('MEM'))
+                            Module.HardwareVersion = body['HWV']
+                            Module.SoftwareVersion = body['SWV']
+                            # Timestamp when module clock was 0
+                            Module.ModuleTime = Msg['Timestamp'] - (float(body['Time']) / 1000.0)
+                            if(Module.Complete == False):
+                                # Finalize setup
+                                Module.LastUpdated = datetime.datetime.now().timestamp()
+                                Module.Complete = True
+                                Polls.Discovered(Module.Name, loop.time())
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+            Latency.Record(time.perf_counter() - Start)
     except asyncio.CancelledError:
-        print('Process messages: Task cancelled')
-    except Exception as ex:
-        print ('Process messages: Error - {}'.format(ex) )
+        Log.info('Task cancelled')
+
+# DIRECT METHODS
+# Recent values of the sensors of a module. Returns the status code and payload of the method response.
+def GetHistory(Payload: dict):
+    global Registry, Settings
+    if(not isinstance(Payload, dict) or Payload.get('Module') not in Registry.Modules):
+        return 404, {'Error': 'Unknown module'}
+    Module = Registry.Modules[Payload['Module']]
+    SensorNames = Module.SensorNames
+    if(Payload.get('Sensor') is not None):
+        if(Payload['Sensor'] not in SensorNames):
+            return 404, {'Error': 'Unknown sensor'}
+        SensorNames = [Payload['Sensor']]
+    try:
+        Start = int(Payload['Start']) if Payload.get('Start') is not None else None
+        End = int(Payload['End']) if Payload.get('End') is not None else None
+        if(Payload.get('Seconds') is not None):
+            Start = int((time.time() - float(Payload['Seconds'])) * 1000)
+        # Direct method responses are limited in size, so the number of values in a response is too
+        MaxPoints = max(1, Settings['HistoryMaxPoints'] // max(1, len(SensorNames)))
+        if(Payload.get('MaxPoints') is not None):
+            MaxPoints = max(1, min(int(Payload['MaxPoints']), MaxPoints))
+        Response = {
+            'Module': Module.Name,
+            'Sensors': dict()
+        }
+        for SensorName in SensorNames:
+            Sensor = Registry.FindSensor(Module.Name, SensorName)
+            Timestamps, Values = Sensor.Data.Window(Start, End)
+            Timestamps, Values = Decimate(Timestamps, Values, MaxPoints)
+            Response['Sensors'][SensorName] = {
+                'Unit': Sensor.Unit,
+                'Timestamps': Timestamps.tolist(),
+                'Values': Values.tolist()
+            }
+        return 200, Response
+    except (TypeError, ValueError) as ex:
+        return 400, {'Error': str(ex)}
+
+# Profiling sessions and their files, see Profiler.Get
+def GetProfile(Payload: dict):
+    global Profiling
+    return Profiling.Get(Payload)
+
+# Direct methods by name
+Methods = {
+    'GetHistory': GetHistory,
+    'GetProfile': GetProfile
+}
+
+# Answer direct method requests
+async def MethodRequestListener(client: IoTHubModuleClient):
+    Log = logging.getLogger('Method request listener')
+    try:
+        while(True):
+            try:
+                Request = await client.receive_method_request()  # blocking call
+                Log.info('Received %s', Request.name)
+                if(Request.name in Methods):
+                    Status, Payload = Methods[Request.name](Request.payload)
+                else:
+                    Status, Payload = 404, {'Error': 'Unknown method'}
+                await client.send_method_response(MethodResponse.create_from_method_request(Request, Status, Payload))
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
+
+# Report the deadband counters and polling statistics as reported properties
+async def ReportProperties(client: IoTHubModuleClient):
+    global Settings, Deadband, Polls, Queues, Metrics, Profiling, Shards
+    Log = logging.getLogger('Report properties')
+    # Modules in the last report, a module which is gone is removed from the reported properties by reporting None
+    Reported = set()
+    try:
+        while(True):
+            await asyncio.sleep(Settings['ReportInterval'])
+            Counters = Deadband.Report()
+            Counters.update({Name: None for Name in Reported if Name not in Counters})
+            try:
+                await client.patch_twin_reported_properties({
+                    'Deadband': Counters,
+                    'Polling': Polls.Report(),
+                    'Queues': {Name: Queue.Report() for Name, Queue in Queues.items()},
+                    'Logging': log.Report(),
+                    'Metrics': Metrics.Report(),
+                    'Profile': Profiling.Report(),
+                    'Shards': Shards.Report()
+                })
+                Reported = set(Name for Name, Value in Counters.items() if Value is not None)
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 # ReceiveTwinProperties is invoked when the module twin's desired properties are updated.
 async def ReceiveTwinProperties(client: IoTHubModuleClient, InterfaceOut: asyncio.Queue):
-    global Modules, Sensors
+    global Registry
+    Log = logging.getLogger('Receive twin properties')
     try:
         # Get desired properties
         properties = await client.get_twin()
-        print('Receive twin properties: Got twin', properties)
+        Log.info('Got twin', extra={'Twin': properties})
         UpdateProperties(properties['desired'])
         # await ManageModules(InterfaceOut)
         # Listen for updates
         while(True):
             try:
                 data = await client.receive_twin_desired_properties_patch()  # blocking call
-                print('Receive twin properties: Got update patch')
+                Log.info('Got update patch', extra={'Patch': data})
                 UpdateProperties(data)
                 # await ManageModules(InterfaceOut)
             except KeyError:
                 # invalid message
                 pass
             except Exception as ex:
-                print ('Receive twin properties: {}'.format(ex) )
+                Log.error('Error - %s', ex)
     except asyncio.CancelledError:
-        print('Receive twin properties: Task cancelled')
+        Log.info('Task cancelled')
     
 
 async def Startup():
-    print("Starting now")
+    Log = logging.getLogger('Startup')
+    Log.info('Starting now')
     client = IoTHubModuleClient.create_from_edge_environment()
-    print("Created client")
+    Log.info('Created client')
     await client.connect()
-    print("Connected")
+    Log.info('Connected')
     return client
         
 # GLOBALS
-Modules = dict()
-Sensors = dict()
+# Modules and their sensors
+Registry = ModuleRegistry()
+# Aggregation of sensor values before they are sent upstream
+Aggregation = Aggregator()
+# Deadband filtering of sensor values before they are sent upstream
+Deadband = DeadbandFilter()
+# Telemetry polling schedule
+Polls = PollScheduler()
+# Poll intervals adapted to the production rate of the modules
+Rates = PollRateController()
+# Queues between the tasks by name, created in Main
+Queues = dict()
+# Time until which each congested adapter holds back the polling, by adapter name
+AdapterBackpressure = dict()
+# Time a backpressure message of an adapter is valid (s)
+BACKPRESSURE_TIMEOUT = 15
+# Counters, gauges and latency histograms of the pipeline
+Metrics = MetricsRegistry()
+# On-demand profiling sessions, written to a volume of the host
+Profiling = Profiler(os.environ.get('PROFILE_PATH', PROFILE_PATH))
+# Worker processes for the telemetry, if Shards is set
+Shards = ShardPool(Aggregation, Deadband, Metrics)
+Settings = {
+    'BroadcastInterval': None,
+    # Telemetry message format for the adapters
+    'UpstreamVersion': upstream.VERSION,
+    # Resolution of the values of each sensor, by sensor name. Values of other sensors are sent as they are.
+    'Resolution': dict(),
+    # Largest number of values in a GetHistory response
+    'HistoryMaxPoints': 2000,
+    # Interval between reports of the reported properties (s)
+    'ReportInterval': 60,
+    # Number of worker processes for the telemetry, 0 processes the telemetry in the event loop
+    'Shards': 0
+}
 
 # Everthing starts at the main
 def Main():
-    global Modules, Sensors, Settings
+    global Registry, Settings, Queues
+    Log = logging.getLogger('Controller')
     # All settings required for the operation of the DMS
     
     Tasks = []
+    log.Setup('Controller')
     
     # All settings required for the operation of this adapter are in place
     try:
         if(not sys.version >= '3.5.3'):
             raise Exception('The sample requires python 3.5.3+. Current version of Python: {}'.format(sys.version))
         loop = asyncio.get_event_loop()
-        print('Controller: Starting')
+        Log.info('Starting')
         client = loop.run_until_complete(Startup())
         
         # message queue shared by all interfaces which send data to the controller
-        InterfaceIn = asyncio.Queue()
+        InterfaceIn = BoundedQueue(1000, BLOCK, Wait=QueueWait('InterfaceIn'))
         # Message queue for controller to serial interface
-        InterfaceOut = asyncio.Queue()
+        InterfaceOut = BoundedQueue(1000, COALESCE, CommandKey, QueueWait('InterfaceOut'))
         # Message queue for controller to cloud adapter
-        CloudOut = asyncio.Queue()
+        CloudOut = BoundedQueue(1000, BLOCK, Wait=QueueWait('CloudOut'))
+        Queues['InterfaceIn'] = InterfaceIn
+        Queues['InterfaceOut'] = InterfaceOut
+        Queues['CloudOut'] = CloudOut
+        for Name, Queue in Queues.items():
+            QueueMetrics(Name, Queue)
+        for Event in ('Polls', 'Skipped', 'Failures', 'Watchdog', 'Rediscoveries', 'Throttled'):
+            Metrics.Counter('dms_poll_events_total', 'Telemetry polls and poll failures', {'event': Event}, (lambda Event=Event: Polls.Stats[Event]))
 
         # Construct parallel processes
         # SerialAdapter = mp.Process(target=Thread_SerialAdapter, args=(MessageIn, SerialOut, Settings['SerialInterface']))
         # BluetoothAdapter = mp.Process(target=Thread_BluetoothAdapter, args=(MessageIn, BluetoothOut, Settings['BluetoothInterface']))
-        print('Controller: Creating tasks')
+        Log.info('Creating tasks')
         # asynchronous tasks
         Tasks.append( loop.create_task( ReceiveTwinProperties( client, InterfaceOut ) ) )
         Tasks.append( loop.create_task( DataPlatformSender( client, CloudOut ) ) )
         Tasks.append( loop.create_task( InterfaceReceiver( client, InterfaceIn ) ) )
+        Tasks.append( loop.create_task( AdapterReceiver( client ) ) )
         Tasks.append( loop.create_task( InterfaceSender( client, InterfaceOut ) ) )
-        Tasks.append( loop.create_task( ProcessMessages( loop, InterfaceIn, InterfaceOut, CloudOut ) ) )
+        Tasks.append( loop.create_task( ProcessMessages( InterfaceIn, InterfaceOut, CloudOut ) ) )
         Tasks.append( loop.create_task( ManageModules( InterfaceOut ) ) )
+        Tasks.append( loop.create_task( BroadcastPoller( InterfaceOut ) ) )
+        Tasks.append( loop.create_task( PollModules( InterfaceOut ) ) )
+        Tasks.append( loop.create_task( MethodRequestListener( client ) ) )
+        Tasks.append( loop.create_task( ReportProperties( client ) ) )
+        Tasks.append( loop.create_task( Metrics.Serve( int(os.environ.get('METRICS_PORT', METRICS_PORT)) ) ) )
         
         # Infinite loop. The aforementioned tasks run during the asyncio.sleep function.
         while(True):
             loop.run_until_complete(asyncio.sleep(30))
         
     except KeyboardInterrupt:
-        print('Controller: Quittin')
+        Log.info('Quittin')
         for task in Tasks:
             task.cancel()
         loop.run_until_complete(client.disconnect())
 
 if __name__ == "__main__":
     Main()
-    print('Goodbye')
+    logging.getLogger('Controller').info('Goodbye')
 
     # If using Python 3.7 or above, you can use following code instead:
     # asyncio.run(main())
\ No newline at end of file
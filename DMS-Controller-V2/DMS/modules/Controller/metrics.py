@@ -0,0 +1,207 @@
+# Metrics of the module: counters, gauges and latency histograms of the stages of the pipeline.
+# Ensure that this file is equal in the Controller, SerialInterface, ThingsboardAdapter and IshareAdapter modules.
+# The metrics are published in two ways:
+#   - Report() for the reported properties, with the count, mean, 50th, 90th and 99th percentile and largest value
+#     of every histogram (ms)
+#   - Prometheus() in the Prometheus text format, served on http://<module>:METRICS_PORT/metrics by Serve
+# A metric is identified by its name and labels, for example Histogram('dms_queue_wait_seconds', ..., {'queue':
+# 'CloudOut'}). Asking for the same metric again returns the same object.
+# Histograms are log-linear, like HDR histograms: every power of two (in us) is split in SUB_BUCKETS / 2 buckets of
+# equal width, so a percentile is within 1 / SUB_BUCKETS of the real value, over any range. Recording a value costs a
+# few integer operations and a dict update, and only the buckets which were hit are stored. The Prometheus histogram
+# has a bucket per power of two, which are sums of the log-linear buckets.
+
+import asyncio
+
+# Linear buckets below SUB_BUCKETS us, and half as many buckets per power of two above
+SUB_BITS = 5
+SUB_BUCKETS = 1 << SUB_BITS
+HALF_BUCKETS = SUB_BUCKETS >> 1
+# Upper bounds of the Prometheus buckets (us): 2^6 us (64 us) up to 2^26 us (67 s)
+PROMETHEUS_BOUNDS = [1 << Exponent for Exponent in range(6, 27)]
+
+METRICS_PORT = 9600
+
+# Index of the bucket of a value (us)
+def BucketIndex(Value: int):
+    if(Value < SUB_BUCKETS):
+        return Value
+    Shift = Value.bit_length() - SUB_BITS
+    return SUB_BUCKETS + (Shift - 1) * HALF_BUCKETS + (Value >> Shift) - HALF_BUCKETS
+
+# Lowest value and highest value + 1 of a bucket (us)
+def BucketBounds(Index: int):
+    if(Index < SUB_BUCKETS):
+        return Index, Index + 1
+    Shift = (Index - SUB_BUCKETS) // HALF_BUCKETS + 1
+    Top = (Index - SUB_BUCKETS) % HALF_BUCKETS + HALF_BUCKETS
+    return Top << Shift, (Top + 1) << Shift
+
+class Counter:
+    # A counter with a Function is read when the metrics are published, for counters kept elsewhere
+    def __init__(self, Function = None):
+        self.Value = 0
+        self.Function = Function
+
+    def Add(self, Amount = 1):
+        self.Value += Amount
+
+    def Get(self):
+        return self.Function() if self.Function is not None else self.Value
+
+class Gauge:
+    # A gauge with a Function is read when the metrics are published
+    def __init__(self, Function = None):
+        self.Value = 0
+        self.Function = Function
+
+    def Set(self, Value):
+        self.Value = Value
+
+    def Get(self):
+        return self.Function() if self.Function is not None else self.Value
+
+class Histogram:
+    def __init__(self):
+        # Number of values by bucket index
+        self.Counts = dict()
+        self.Count = 0
+        # Sum of the values (s)
+        self.Sum = 0.0
+        self.Max = 0.0
+
+    # Record a duration (s)
+    def Record(self, Seconds: float):
+        Index = BucketIndex(int(Seconds * 1e6)) if Seconds > 0 else 0
+        self.Counts[Index] = self.Counts.get(Index, 0) + 1
+        self.Count += 1
+        self.Sum += Seconds
+        if(Seconds > self.Max):
+            self.Max = Seconds
+
+    # Value (s) below which a fraction Quantile of the values is
+    def Percentile(self, Quantile: float):
+        if(self.Count == 0): return 0.0
+        Rank = Quantile * self.Count
+        Seen = 0
+        for Index in sorted(self.Counts):
+            Seen += self.Counts[Index]
+            if(Seen >= Rank):
+                Low, High = BucketBounds(Index)
+                return min((Low + High) / 2e6, self.Max)
+        return self.Max
+
+    # Cumulative counts at PROMETHEUS_BOUNDS
+    def Cumulative(self):
+        Counts = [0] * len(PROMETHEUS_BOUNDS)
+        for Index, Count in self.Counts.items():
+            High = BucketBounds(Index)[1]
+            for Position, Bound in enumerate(PROMETHEUS_BOUNDS):
+                if(High <= Bound):
+                    Counts[Position] += Count
+                    break
+        Total = 0
+        for Position in range(len(Counts)):
+            Total += Counts[Position]
+            Counts[Position] = Total
+        return Counts
+
+    def Get(self):
+        return {
+            'Count': self.Count,
+            'Mean': round(self.Sum / self.Count * 1000, 3) if self.Count else 0.0,
+            'P50': round(self.Percentile(0.5) * 1000, 3),
+            'P90': round(self.Percentile(0.9) * 1000, 3),
+            'P99': round(self.Percentile(0.99) * 1000, 3),
+            'Max': round(self.Max * 1000, 3)
+        }
+
+# Label values are used as property names in the reported properties, which can't contain these characters
+def PropertyName(Value: str):
+    for Character in '.$# ':
+        Value = Value.replace(Character, '_')
+    return Value
+
+class MetricsRegistry:
+    def __init__(self):
+        # (name, labels) -> metric, labels as a tuple of (label, value)
+        self.Metrics = dict()
+        # Help text and type by name
+        self.Help = dict()
+
+    def Get(self, Type, TypeName: str, Name: str, Help: str, Labels: dict, *Args):
+        Key = (Name, tuple(sorted(Labels.items())) if Labels else ())
+        Metric = self.Metrics.get(Key)
+        if(Metric is None):
+            Metric = self.Metrics[Key] = Type(*Args)
+            self.Help[Name] = (Help, TypeName)
+        return Metric
+
+    def Counter(self, Name: str, Help: str, Labels: dict = None, Function = None):
+        return self.Get(Counter, 'counter', Name, Help, Labels, Function)
+
+    def Gauge(self, Name: str, Help: str, Labels: dict = None, Function = None):
+        return self.Get(Gauge, 'gauge', Name, Help, Labels, Function)
+
+    def Histogram(self, Name: str, Help: str, Labels: dict = None):
+        return self.Get(Histogram, 'histogram', Name, Help, Labels)
+
+    # Forget the metrics with a label, for example of a removed port
+    def Remove(self, Label: str, Value: str):
+        for Key in [Key for Key in self.Metrics if (Label, Value) in Key[1]]:
+            del self.Metrics[Key]
+
+    # Values by name and label values, for the reported properties
+    def Report(self):
+        Report = dict()
+        for (Name, Labels), Metric in self.Metrics.items():
+            if(len(Labels) == 0):
+                Report[Name] = Metric.Get()
+            else:
+                Report.setdefault(Name, dict())[PropertyName('_'.join(str(Value) for Label, Value in Labels))] = Metric.Get()
+        return Report
+
+    def Prometheus(self):
+        Lines = []
+        Written = set()
+        for (Name, Labels), Metric in sorted(self.Metrics.items(), key=lambda Item: Item[0]):
+            if(Name not in Written):
+                Help, TypeName = self.Help[Name]
+                Lines.append('# HELP {} {}'.format(Name, Help))
+                Lines.append('# TYPE {} {}'.format(Name, TypeName))
+                Written.add(Name)
+            Text = ','.join('{}="{}"'.format(Label, str(Value).replace('\\', '\\\\').replace('"', '\\"')) for Label, Value in Labels)
+            if(not isinstance(Metric, Histogram)):
+                Lines.append('{}{} {}'.format(Name, '{' + Text + '}' if Text else '', Metric.Get()))
+                continue
+            Prefix = Text + ',' if Text else ''
+            for Bound, Count in zip(PROMETHEUS_BOUNDS, Metric.Cumulative()):
+                Lines.append('{}_bucket{{{}le="{}"}} {}'.format(Name, Prefix, Bound / 1e6, Count))
+            Lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(Name, Prefix, Metric.Count))
+            Lines.append('{}_sum{} {}'.format(Name, '{' + Text + '}' if Text else '', Metric.Sum))
+            Lines.append('{}_count{} {}'.format(Name, '{' + Text + '}' if Text else '', Metric.Count))
+        return '\n'.join(Lines) + '\n'
+
+    # Answer every HTTP request with the metrics in the Prometheus text format
+    async def Respond(self, Reader: asyncio.StreamReader, Writer: asyncio.StreamWriter):
+        try:
+            # Only the request line is needed, the headers end with an empty line
+            while((await Reader.readline()).strip()):
+                pass
+            Body = self.Prometheus().encode()
+            Writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' +
+                str(len(Body)).encode() + b'\r\nConnection: close\r\n\r\n' + Body)
+            await Writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            Writer.close()
+
+    # Serve the metrics until the task is cancelled
+    async def Serve(self, Port: int = METRICS_PORT):
+        Server = await asyncio.start_server(self.Respond, '0.0.0.0', Port)
+        try:
+            while(True):
+                await asyncio.sleep(3600)
+        finally:
+            Server.close()
@@ -0,0 +1,249 @@
+# Telemetry polling schedule of the modules, run by a single task instead of a sleeping task per request.
+# The next event of every module is kept in a heap, ordered by the time it is due. Polls are due at fixed-rate
+# deadlines: the next deadline is the previous deadline plus the interval, not the time of the response plus the
+# interval, so the polling rate does not drift with the response time. When the scheduler falls behind by more
+# than an interval, the missed deadlines are skipped instead of sent in a burst.
+# Deadlines are on a grid of the interval, with a phase per module derived from its name. Modules with the same
+# interval are spread over the interval, instead of all being polled at the same moment.
+#
+# Every module has a poll state:
+#   Idle       waiting for the next deadline
+#   Waiting    a request is outstanding. No other request is sent until the response arrives or the watchdog
+#              (Timeout seconds after the request) expires, so at most one request per module is in flight.
+#   Backoff    the last request failed, it is retried after the interval times 2 to the number of failures
+#   Discovery  MaxFailures requests in a row failed. The module is not polled until it answers an attribute request.
+# Any response of the module ends a failure streak, so a lost frame never stops the polling of a module.
+
+import asyncio
+import heapq
+import math
+import zlib
+
+IDLE = 'Idle'
+WAITING = 'Waiting'
+BACKOFF = 'Backoff'
+DISCOVERY = 'Discovery'
+
+# Longest wait before a retry (s)
+MAX_BACKOFF = 60.0
+
+class PollState:
+    __slots__ = (
+        # Sequence of the heap entry of the module, older entries are stale
+        'Sequence',
+        'Interval',
+        # Interval set for this module in the twin, otherwise the default interval or an adapted interval is used
+        'Fixed',
+        'State',
+        # Last poll deadline, the next deadlines follow from it
+        'Anchor',
+        # Failed requests in a row
+        'Failures'
+    )
+
+    def __init__(self, Interval: float):
+        self.Sequence = None
+        self.Interval = Interval
+        self.Fixed = False
+        self.State = IDLE
+        self.Anchor = None
+        self.Failures = 0
+
+class PollScheduler:
+    def __init__(self, Interval: float = 1.0, Timeout: float = 5.0, MaxFailures: int = 5):
+        # Default interval between polls (s)
+        self.Interval = Interval
+        # Time to wait for a response (s)
+        self.Timeout = Timeout
+        # Failures in a row before the module is discovered again
+        self.MaxFailures = MaxFailures
+        # (due time, sequence, module name)
+        self.Heap = []
+        # Poll state by module name
+        self.Entries = dict()
+        self.Sequence = 0
+        # Set when an event is scheduled before the others, so the scheduler task doesn't sleep past it
+        self.Changed = asyncio.Event()
+        self.Stats = {
+            'Polls': 0,
+            'Skipped': 0,
+            'Failures': 0,
+            # Failures because the watchdog expired
+            'Watchdog': 0,
+            'Rediscoveries': 0,
+            # Polls held back because the messages of earlier polls were not processed yet
+            'Throttled': 0,
+            # Largest delay of a poll after its deadline (ms) since the last report
+            'MaxLate': 0.0
+        }
+
+    def __len__(self):
+        return len(self.Entries)
+
+    def Push(self, Name: str, Due: float):
+        self.Sequence += 1
+        self.Entries[Name].Sequence = self.Sequence
+        heapq.heappush(self.Heap, (Due, self.Sequence, Name))
+        # The scheduler task may be sleeping until a later event
+        if(self.Heap[0][1] == self.Sequence):
+            self.Changed.set()
+
+    # First deadline of a module after Now: on the grid of the interval, shifted by the phase of the module
+    def FirstDue(self, Name: str, Interval: float, Now: float):
+        Phase = zlib.crc32(Name.encode()) / 2.0**32 * Interval
+        Due = math.floor(Now / Interval) * Interval + Phase
+        return Due if Due > Now else Due + Interval
+
+    # Schedule the regular deadline which follows the last one
+    def Next(self, Name: str, Now: float):
+        Entry = self.Entries[Name]
+        Entry.State = IDLE
+        if(Entry.Anchor is None):
+            Next = self.FirstDue(Name, Entry.Interval, Now)
+        else:
+            Next = Entry.Anchor + Entry.Interval
+            if(Next <= Now):
+                Missed = math.floor((Now - Next) / Entry.Interval) + 1
+                self.Stats['Skipped'] += Missed
+                Next += Missed * Entry.Interval
+        Entry.Anchor = Next
+        self.Push(Name, Next)
+
+    # Set the interval of a module. A new interval starts on its own grid, a module with an outstanding request
+    # keeps waiting for it.
+    def Reschedule(self, Name: str, Now: float, Interval: float, Fixed: bool):
+        Entry = self.Entries[Name]
+        Entry.Interval = Interval
+        Entry.Fixed = Fixed
+        Entry.Anchor = None
+        if(Entry.State in (IDLE, BACKOFF)):
+            self.Next(Name, Now)
+
+    # Add a module, or change the interval of a known module. None selects the default interval, a module which
+    # already uses the default interval or an adapted interval keeps it.
+    def Add(self, Name: str, Now: float, Interval: float = None):
+        Entry = self.Entries.get(Name)
+        if(Entry is None):
+            self.Entries[Name] = PollState(Interval or self.Interval)
+        elif(Interval is None and not Entry.Fixed):
+            return
+        elif(Interval is not None and Entry.Fixed and Entry.Interval == Interval):
+            return
+        self.Reschedule(Name, Now, Interval or self.Interval, Interval is not None)
+
+    def Remove(self, Name: str):
+        self.Entries.pop(Name, None)
+
+    # Change the default interval, and the interval of the modules which use it
+    def SetInterval(self, Interval: float, Now: float):
+        self.Interval = Interval
+        for Name, Entry in list(self.Entries.items()):
+            if(not Entry.Fixed):
+                self.Reschedule(Name, Now, Interval, False)
+
+    # Change the interval of a module without a fixed interval. The deadline after the next poll uses it.
+    def Adapt(self, Name: str, Interval: float):
+        Entry = self.Entries.get(Name)
+        if(Entry is not None and not Entry.Fixed):
+            Entry.Interval = Interval
+
+    def State(self, Name: str):
+        Entry = self.Entries.get(Name)
+        return Entry.State if Entry is not None else None
+
+    def IsCurrent(self, Sequence: int, Name: str):
+        Entry = self.Entries.get(Name)
+        return Entry is not None and Entry.Sequence == Sequence
+
+    # Time until the first event (s), None without events
+    def Delay(self, Now: float):
+        while(len(self.Heap) > 0):
+            Due, Sequence, Name = self.Heap[0]
+            if(self.IsCurrent(Sequence, Name)):
+                return max(0.0, Due - Now)
+            heapq.heappop(self.Heap)
+        return None
+
+    # Process the events before Now. Returns the names of the modules to poll, which must be passed to Sent or
+    # Skip, and the names of the modules which have to be discovered again.
+    def Due(self, Now: float):
+        Polls = []
+        Rediscover = []
+        while(len(self.Heap) > 0 and self.Heap[0][0] <= Now):
+            Due, Sequence, Name = heapq.heappop(self.Heap)
+            if(not self.IsCurrent(Sequence, Name)): continue
+            Entry = self.Entries[Name]
+            if(Entry.State == WAITING):
+                # The watchdog expired
+                self.Stats['Watchdog'] += 1
+                if(self.Failed(Name, Now)):
+                    Rediscover.append(Name)
+                continue
+            Polls.append(Name)
+            self.Stats['MaxLate'] = max(self.Stats['MaxLate'], (Now - Due) * 1000)
+        return Polls, Rediscover
+
+    # A request was sent to a module
+    def Sent(self, Name: str, Now: float):
+        self.Stats['Polls'] += 1
+        self.Entries[Name].State = WAITING
+        self.Push(Name, Now + self.Timeout)
+
+    # A module was not polled at its deadline
+    def Skip(self, Name: str, Now: float):
+        self.Next(Name, Now)
+
+    # A module was not polled because of backpressure. Its values stay in its buffers until the next deadline.
+    def Throttle(self, Name: str, Now: float):
+        self.Stats['Throttled'] += 1
+        self.Next(Name, Now)
+
+    # A module answered a telemetry request
+    def Answered(self, Name: str, Now: float):
+        Entry = self.Entries.get(Name)
+        if(Entry is None): return
+        Entry.Failures = 0
+        if(Entry.State == WAITING):
+            self.Next(Name, Now)
+
+    # A telemetry request of a module failed. Returns True when the module has to be discovered again.
+    def Failed(self, Name: str, Now: float):
+        Entry = self.Entries.get(Name)
+        if(Entry is None or Entry.State != WAITING): return False
+        self.Stats['Failures'] += 1
+        Entry.Failures += 1
+        if(Entry.Failures >= self.MaxFailures):
+            self.Stats['Rediscoveries'] += 1
+            Entry.State = DISCOVERY
+            Entry.Sequence = None
+            return True
+        Entry.State = BACKOFF
+        self.Push(Name, Now + min(Entry.Interval * 2 ** Entry.Failures, MAX_BACKOFF))
+        return False
+
+    # A module answered an attribute request, polling starts again if it was stopped
+    def Discovered(self, Name: str, Now: float):
+        Entry = self.Entries.get(Name)
+        if(Entry is None or Entry.State != DISCOVERY): return
+        Entry.Failures = 0
+        Entry.Anchor = None
+        self.Next(Name, Now)
+
+    # Wait until an event is due, or an earlier event was scheduled
+    async def Wait(self, Now: float):
+        Delay = self.Delay(Now)
+        self.Changed.clear()
+        try:
+            await asyncio.wait_for(self.Changed.wait(), Delay)
+        except asyncio.TimeoutError:
+            pass
+
+    # Statistics for the reported properties, the largest delay is reset
+    def Report(self):
+        Report = dict(self.Stats)
+        Report['MaxLate'] = round(Report['MaxLate'], 2)
+        Report['States'] = {State: 0 for State in (IDLE, WAITING, BACKOFF, DISCOVERY)}
+        for Entry in self.Entries.values():
+            Report['States'][Entry.State] += 1
+        self.Stats['MaxLate'] = 0.0
+        return Report
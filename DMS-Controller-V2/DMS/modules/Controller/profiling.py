@@ -0,0 +1,264 @@
+# On-demand profiling of the module, to find the hot spots on the gateway under real load.
+# Ensure that this file is equal in the Controller, SerialInterface, ThingsboardAdapter and IshareAdapter modules.
+# A session is requested with a dict in the module twin (Profile in the controller, PROFILE in the other modules).
+# Its keys are read in any case, like the other settings of the module:
+#   {"Id": "slow-polls-1", "Mode": "sample", "Duration": 60, "Interval": 0.01, "SlowCallback": 0.1}
+# The modes are:
+#   sample    the stacks of all threads are taken every Interval seconds. Written as collapsed stacks (<Id>.folded),
+#             one line per stack with the number of samples, for flamegraph.pl or speedscope. The overhead is low,
+#             and calls blocking a worker thread are seen as well.
+#   cprofile  every function call in the thread of the event loop is profiled with cProfile. Written as pstats
+#             (<Id>.pstats) and as text sorted by cumulative time (<Id>.txt). Slows the module down a lot.
+# During a session the event loop runs in debug mode: every callback which takes longer than SlowCallback seconds
+# is written to <Id>.slow, with the task it ran. A summary with the hottest functions is written to <Id>.json.
+# The files are kept in a volume of the host, for the last KEEP_SESSIONS sessions. A session runs once for every
+# Id: a session with a summary on disk is not run again when the module restarts.
+# The summary and the files are fetched with the direct method GetProfile (see Get).
+
+import asyncio
+import base64
+import collections
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+PROFILE_PATH = '/data/profiles'
+MODES = ('sample', 'cprofile')
+# Files of a session, by the name used in GetProfile
+FILES = {
+    'summary': '.json',
+    'folded': '.folded',
+    'pstats': '.pstats',
+    'text': '.txt',
+    'slow': '.slow'
+}
+# Longest session (s) and shortest sample interval (s)
+MAX_DURATION = 3600
+MIN_INTERVAL = 0.001
+# Sessions kept on disk
+KEEP_SESSIONS = 5
+# Functions in the summary
+TOP_FUNCTIONS = 20
+# Largest part of a file in a direct method response (bytes). Responses are limited to 128 KB, and base64 adds a third.
+CHUNK_SIZE = 65536
+
+# Session ids are used as file names
+def FileName(Id: str):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', Id)[:64]
+
+# Collects the warnings of asyncio in debug mode about callbacks which took too long
+class SlowCallbackHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.Lines = []
+
+    def emit(self, record: logging.LogRecord):
+        if(str(record.msg).startswith('Executing')):
+            self.Lines.append('{:.3f} {}'.format(record.created, record.getMessage()))
+
+# Counts the stacks of all other threads, on a thread of its own
+class StackSampler:
+    def __init__(self, Interval: float):
+        self.Interval = Interval
+        self.Stacks = collections.Counter()
+        self.Samples = 0
+        self.Stopped = threading.Event()
+        self.Thread = threading.Thread(target=self.Run, name='Profiler', daemon=True)
+
+    def Run(self):
+        Own = threading.get_ident()
+        while(not self.Stopped.wait(self.Interval)):
+            Names = {Thread.ident: Thread.name for Thread in threading.enumerate()}
+            for Ident, Frame in sys._current_frames().items():
+                if(Ident == Own): continue
+                Stack = []
+                while(Frame is not None):
+                    Code = Frame.f_code
+                    Stack.append('{} ({}:{})'.format(Code.co_name, os.path.basename(Code.co_filename), Code.co_firstlineno))
+                    Frame = Frame.f_back
+                Stack.append(Names.get(Ident, str(Ident)))
+                self.Stacks[';'.join(reversed(Stack))] += 1
+            self.Samples += 1
+
+    # [function, samples in the function itself, samples in the function and the functions it called]
+    def Top(self):
+        Self = collections.Counter()
+        Total = collections.Counter()
+        for Stack, Count in self.Stacks.items():
+            Functions = Stack.split(';')[1:]
+            if(len(Functions) == 0): continue
+            Self[Functions[-1]] += Count
+            for Function in set(Functions):
+                Total[Function] += Count
+        return [[Function, Count, Total[Function]] for Function, Count in Self.most_common(TOP_FUNCTIONS)]
+
+class Profiler:
+    def __init__(self, Path: str = PROFILE_PATH):
+        self.Path = Path
+        self.Task = None
+        # Summary of the running or last session
+        self.Session = None
+
+    # Start the session requested in the twin, unless it ran already
+    def Request(self, Twin: dict):
+        if(Twin is None): return
+        Request = {str(Key).upper(): Value for Key, Value in Twin.items()}
+        Id = FileName(str(Request.get('ID', '')))
+        if(not Id):
+            raise ValueError('A profiling session needs an Id')
+        if(self.Session is not None and self.Session['Id'] == Id): return
+        if(os.path.exists(self.File(Id, 'summary'))): return
+        Mode = str(Request.get('MODE', 'sample')).lower()
+        if(Mode not in MODES):
+            raise ValueError('Unknown profiling mode {}'.format(Mode))
+        Duration = min(float(Request.get('DURATION', 60)), MAX_DURATION)
+        Interval = max(float(Request.get('INTERVAL', 0.01)), MIN_INTERVAL)
+        SlowCallback = float(Request.get('SLOWCALLBACK', 0.1))
+        if(self.Task is not None and not self.Task.done()):
+            raise RuntimeError('Profiling session {} is still running'.format(self.Session['Id']))
+        self.Session = {
+            'Id': Id,
+            'Mode': Mode,
+            'State': 'running',
+            'Start': round(time.time(), 3),
+            'Duration': Duration
+        }
+        self.Task = asyncio.ensure_future(self.Run(Id, Mode, Duration, Interval, SlowCallback))
+
+    def File(self, Id: str, Name: str):
+        return os.path.join(self.Path, Id + FILES[Name])
+
+    async def Run(self, Id: str, Mode: str, Duration: float, Interval: float, SlowCallback: float):
+        Log = logging.getLogger('Profiler')
+        loop = asyncio.get_event_loop()
+        Debug = loop.get_debug()
+        SlowCallbackDuration = loop.slow_callback_duration
+        Slow = SlowCallbackHandler()
+        Profile = cProfile.Profile() if Mode == 'cprofile' else None
+        Sampler = StackSampler(Interval) if Mode == 'sample' else None
+        Log.info('Profiling session %s started', Id, extra={'Mode': Mode, 'Duration': Duration})
+        logging.getLogger('asyncio').addHandler(Slow)
+        loop.slow_callback_duration = SlowCallback
+        loop.set_debug(True)
+        try:
+            if(Profile is not None):
+                Profile.enable()
+            else:
+                Sampler.Thread.start()
+            await asyncio.sleep(Duration)
+        except asyncio.CancelledError:
+            self.Session['State'] = 'cancelled'
+            raise
+        finally:
+            if(Profile is not None):
+                Profile.disable()
+            else:
+                Sampler.Stopped.set()
+            loop.set_debug(Debug)
+            loop.slow_callback_duration = SlowCallbackDuration
+            logging.getLogger('asyncio').removeHandler(Slow)
+        try:
+            # Sorting the statistics takes a while, the event loop goes on meanwhile
+            self.Session = await loop.run_in_executor(None, self.Write, Id, Profile, Sampler, Slow.Lines)
+            Log.info('Profiling session %s finished', Id, extra={'Files': self.Session['Files']})
+        except Exception as ex:
+            self.Session['State'] = 'failed'
+            self.Session['Error'] = str(ex)
+            Log.error('Error writing profiling session %s - %s', Id, ex)
+
+    # Write the files of a session, returns the summary
+    def Write(self, Id: str, Profile: cProfile.Profile, Sampler: StackSampler, SlowLines: list):
+        os.makedirs(self.Path, exist_ok=True)
+        Summary = dict(self.Session)
+        Summary['State'] = 'done'
+        Summary['SlowCallbacks'] = len(SlowLines)
+        Files = ['summary', 'slow']
+        if(Profile is not None):
+            Profile.dump_stats(self.File(Id, 'pstats'))
+            Text = io.StringIO()
+            Stats = pstats.Stats(Profile, stream=Text)
+            Stats.sort_stats('cumulative').print_stats()
+            with open(self.File(Id, 'text'), 'w') as File:
+                File.write(Text.getvalue())
+            Summary['Calls'] = Stats.total_calls
+            # [function, calls, time in the function itself (s), time in the function and the functions it called (s)]
+            Top = sorted(Stats.stats.items(), key=lambda Item: Item[1][2], reverse=True)[:TOP_FUNCTIONS]
+            Summary['Top'] = [['{} ({}:{})'.format(Function, os.path.basename(Source), Line), Calls, round(Own, 6), round(Cumulative, 6)]
+                for (Source, Line, Function), (_, Calls, Own, Cumulative, _) in Top]
+            Files += ['pstats', 'text']
+        else:
+            # The last sample may still be taken
+            Sampler.Thread.join()
+            with open(self.File(Id, 'folded'), 'w') as File:
+                for Stack, Count in Sampler.Stacks.items():
+                    File.write('{} {}\n'.format(Stack, Count))
+            Summary['Samples'] = Sampler.Samples
+            Summary['Top'] = Sampler.Top()
+            Files.append('folded')
+        with open(self.File(Id, 'slow'), 'w') as File:
+            File.write(''.join(Line + '\n' for Line in SlowLines))
+        Summary['Files'] = Files
+        with open(self.File(Id, 'summary'), 'w') as File:
+            json.dump(Summary, File)
+        self.Clean()
+        return Summary
+
+    # Remove the files of all but the last KEEP_SESSIONS sessions
+    def Clean(self):
+        Summaries = [Name for Name in os.listdir(self.Path) if Name.endswith(FILES['summary'])]
+        Summaries.sort(key=lambda Name: os.path.getmtime(os.path.join(self.Path, Name)))
+        for Name in Summaries[:-KEEP_SESSIONS]:
+            Id = Name[:-len(FILES['summary'])]
+            for Extension in FILES.values():
+                if(os.path.exists(os.path.join(self.Path, Id + Extension))):
+                    os.remove(os.path.join(self.Path, Id + Extension))
+
+    # Session ids on disk
+    def Sessions(self):
+        if(not os.path.isdir(self.Path)): return []
+        return sorted(Name[:-len(FILES['summary'])] for Name in os.listdir(self.Path) if Name.endswith(FILES['summary']))
+
+    # Direct method. Without payload, returns the summary of the running or last session and the sessions on disk.
+    # {"Id": ...} returns the summary of a session, {"Id": ..., "File": "folded", "Offset": 0} returns at most
+    # CHUNK_SIZE bytes of a file of the session, base64 encoded. Returns the status code and payload of the response.
+    def Get(self, Payload: dict):
+        if(not isinstance(Payload, dict) or Payload.get('Id') is None):
+            return 200, {'Session': self.Session, 'Sessions': self.Sessions()}
+        Id = FileName(str(Payload['Id']))
+        Name = Payload.get('File', 'summary')
+        if(Name not in FILES):
+            return 400, {'Error': 'Unknown file {}, one of {}'.format(Name, ', '.join(FILES))}
+        Path = self.File(Id, Name)
+        if(not os.path.exists(Path)):
+            return 404, {'Error': 'Unknown session or file'}
+        try:
+            if(Name == 'summary'):
+                with open(Path) as File:
+                    return 200, json.load(File)
+            Offset = int(Payload.get('Offset', 0))
+            if(Offset < 0):
+                return 400, {'Error': 'Offset must not be negative'}
+            with open(Path, 'rb') as File:
+                File.seek(Offset)
+                Data = File.read(CHUNK_SIZE)
+            return 200, {
+                'Id': Id,
+                'File': Name,
+                'Offset': Offset,
+                'Size': os.path.getsize(Path),
+                'Data': base64.b64encode(Data).decode()
+            }
+        except (TypeError, ValueError) as ex:
+            return 400, {'Error': str(ex)}
+
+    # State of the running or last session for the reported properties
+    def Report(self):
+        if(self.Session is None): return None
+        return {Key: Value for Key, Value in self.Session.items() if Key != 'Top'}
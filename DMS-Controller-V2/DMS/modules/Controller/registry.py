@@ -0,0 +1,158 @@
+# Registry of the modules declared in the twin and the sensors they announced in their attribute responses.
+# Every incoming message needs its module and sensors, so both are indexed: modules by interface type, address
+# and port, sensors by module name and sensor name. The records are plain classes with __slots__, which keeps
+# them small when there are hundreds of modules.
+
+import json
+from history import RingBuffer
+
+class ModuleRecord:
+    __slots__ = (
+        'Name',
+        'InterfaceType',
+        'Address',
+        'Port',
+        # Attribute response received
+        'Complete',
+        # Module answers binary telemetry requests
+        'Binary',
+        # Sensor names in the order of the attribute response, binary telemetry refers to sensors by this index
+        'SensorNames',
+        'HardwareVersion',
+        'SoftwareVersion',
+        # Timestamp when module clock was 0
+        'ModuleTime',
+        'LastUpdated'
+    )
+
+    def __init__(self, Name: str, InterfaceType: str, Address, Port = None):
+        self.Name = Name
+        self.InterfaceType = InterfaceType
+        self.Address = Address
+        self.Port = Port
+        self.Complete = False
+        self.Binary = False
+        self.SensorNames = []
+        self.HardwareVersion = None
+        self.SoftwareVersion = None
+        self.ModuleTime = None
+        self.LastUpdated = None
+
+    def __repr__(self):
+        return 'ModuleRecord({})'.format({Slot: getattr(self, Slot) for Slot in self.__slots__})
+
+class SensorRecord:
+    __slots__ = (
+        'Name',
+        'ModuleName',
+        'Unit',
+        # Number of values the module can store of this sensor, None if unknown
+        'Capacity',
+        # Recent values
+        'Data'
+    )
+
+    def __init__(self, Name: str, ModuleName: str, Unit: str, HistorySize: int):
+        self.Name = Name
+        self.ModuleName = ModuleName
+        self.Unit = Unit
+        self.Capacity = None
+        self.Data = RingBuffer(HistorySize)
+
+    def __repr__(self):
+        return 'SensorRecord({})'.format({Slot: getattr(self, Slot) for Slot in self.__slots__})
+
+# Key of a module in the index
+def ModuleKey(InterfaceType: str, Address, Port):
+    # There can be only 1 bluetooth module be connected to the controller
+    if(InterfaceType == 'BluetoothInterface'):
+        return (InterfaceType, None, None)
+    # Addresses from the twin can be objects
+    if(isinstance(Address, (dict, list))):
+        Address = json.dumps(Address, sort_keys=True)
+    return (InterfaceType, Address, Port)
+
+# Number of values a module stores of a sensor: MEM seconds of the attribute response at the fastest sample rate
+# of the sensor (SR, ms), as the sensor buffers of the module are sized
+def BufferCapacity(Sensor: dict, Memory):
+    if(not Memory or not Sensor.get('SR')): return None
+    return max(1, int(Memory) * (1000 // int(Sensor['SR'])))
+
+class ModuleRegistry:
+    def __init__(self, HistorySize: int = 3600):
+        # Number of recent values kept of each sensor
+        self.HistorySize = HistorySize
+        # Modules by name
+        self.Modules = dict()
+        # Sensors by (module name, sensor name)
+        self.Sensors = dict()
+        # Names of the modules by (interface type, address, port). Modules are found in the order they were added.
+        self.Index = dict()
+
+    def Unindex(self, Module: ModuleRecord):
+        Key = ModuleKey(Module.InterfaceType, Module.Address, Module.Port)
+        Names = self.Index.get(Key, [])
+        if(Module.Name in Names):
+            Names.remove(Module.Name)
+        if(len(Names) == 0):
+            self.Index.pop(Key, None)
+
+    # Add a module, or update the interface, address and port of a known module
+    def SetModule(self, Name: str, InterfaceType: str, Address, Port = None):
+        Module = self.Modules.get(Name)
+        if(Module is None):
+            Module = ModuleRecord(Name, InterfaceType, Address, Port)
+            self.Modules[Name] = Module
+        elif(ModuleKey(InterfaceType, Address, Port) == ModuleKey(Module.InterfaceType, Module.Address, Module.Port)):
+            # Same place in the index
+            Module.Address = Address
+            return Module
+        else:
+            self.Unindex(Module)
+            Module.InterfaceType = InterfaceType
+            Module.Address = Address
+            Module.Port = Port
+        self.Index.setdefault(ModuleKey(InterfaceType, Address, Port), []).append(Name)
+        return Module
+
+    # Remove a module and its sensors
+    def RemoveModule(self, Name: str):
+        Module = self.Modules.pop(Name, None)
+        if(Module is None): return
+        self.Unindex(Module)
+        for SensorName in Module.SensorNames:
+            self.Sensors.pop((Name, SensorName), None)
+
+    # Find the module which sent a message. Modules without a configured port match messages from any port.
+    def FindModule(self, InterfaceType: str, Address, Port = None):
+        Names = self.Index.get(ModuleKey(InterfaceType, Address, Port))
+        if(not Names and Port is not None):
+            Names = self.Index.get(ModuleKey(InterfaceType, Address, None))
+        if(not Names): return None
+        return self.Modules[Names[0]]
+
+    # Register the sensors from an attribute response. Sensors the module no longer announces are removed,
+    # known sensors keep their data. Memory is the MEM entry of the attribute response.
+    def SetSensors(self, Module: ModuleRecord, Sensors: list, Memory = None):
+        Names = [Sensor['Name'] for Sensor in Sensors]
+        for SensorName in Module.SensorNames:
+            if(SensorName not in Names):
+                self.Sensors.pop((Module.Name, SensorName), None)
+        for Sensor in Sensors:
+            Record = self.Sensors.get((Module.Name, Sensor['Name']))
+            if(Record is None):
+                Record = SensorRecord(Sensor['Name'], Module.Name, Sensor['Unit'], self.HistorySize)
+                self.Sensors[(Module.Name, Sensor['Name'])] = Record
+            else:
+                Record.Unit = Sensor['Unit']
+            Record.Capacity = BufferCapacity(Sensor, Memory)
+        Module.SensorNames = Names
+
+    def FindSensor(self, ModuleName: str, SensorName: str):
+        return self.Sensors.get((ModuleName, SensorName))
+
+    # Change the number of recent values kept of each sensor
+    def SetHistorySize(self, HistorySize: int):
+        self.HistorySize = HistorySize
+        for Sensor in self.Sensors.values():
+            Sensor.Data.Resize(HistorySize)
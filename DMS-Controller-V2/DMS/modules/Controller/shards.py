@@ -0,0 +1,213 @@
+# Sharding of the telemetry processing over worker processes, so a gateway with several cores is not limited to
+# the one core of the event loop.
+# The modules are divided over the shards by (InterfaceType, Address). Every shard has one worker process, which
+# runs its tasks in the order they were submitted, and the results are applied in the same order, so the telemetry
+# of a module is processed and sent upstream in order. At most IN_FLIGHT responses of a shard are in the worker at
+# once, the others wait in the queue of the shard. A full queue blocks the process messages task, which makes
+# InterfaceIn congested and holds back the polling.
+# A worker converts the telemetry of a module to sensor blocks, aggregates and filters them, and encodes the message
+# for the adapters. It returns the encoded message, the numeric values for the history of the registry and the
+# deadband counters, so the event loop only copies the history and sends the message.
+# The workers hold the aggregation and deadband state of their modules. They start with the state of the event
+# loop, and the state of their modules is copied back when the number of shards changes. Settings are applied in
+# the event loop first, and then sent to every worker (see Configure).
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import time
+import numpy as np
+import upstream
+from queues import BoundedQueue, BLOCK
+from registry import ModuleKey
+from telemetry import SensorBlocks, LastTimestamp, CountValues
+
+# Responses of a shard waiting for its worker
+QUEUE_SIZE = 1000
+# Responses of a shard in its worker at once
+IN_FLIGHT = 8
+
+# STATE OF A WORKER PROCESS
+Aggregation = None
+Deadband = None
+# Resolution and version of the upstream messages
+Upstream = (dict(), upstream.VERSION)
+
+def Initialise(AggregationState, DeadbandState, Resolution: dict, Version: int):
+    global Aggregation, Deadband, Upstream
+    Aggregation = AggregationState
+    Deadband = DeadbandState
+    # The event loop has counted the values before the worker started
+    Deadband.Counters = dict()
+    Upstream = (Resolution, Version)
+
+# Apply a setting of the twin in a worker
+def Configure(Kind: str, Name: str, Setting):
+    global Aggregation, Deadband, Upstream
+    if(Kind == 'Aggregation'):
+        Aggregation.Configure(Name, Setting)
+    elif(Kind == 'Deadband'):
+        Deadband.Configure(Name, Setting)
+    elif(Kind == 'RemoveModule'):
+        Aggregation.RemoveModule(Name)
+        Deadband.RemoveModule(Name)
+    elif(Kind == 'Upstream'):
+        Upstream = Setting
+
+def State():
+    return Aggregation, Deadband
+
+# Process the telemetry of a module in a worker. Returns the history as (sensor name, t0, dt, values), the timestamp
+# of the last value, the number of values received and sent, the deadband counters and the message for the
+# adapters, or None if nothing is sent.
+def Process(Name: str, ModuleTime: float, SensorNames: list, Telemetry: list):
+    global Aggregation, Deadband, Upstream
+    Data = SensorBlocks(ModuleTime, SensorNames, Telemetry)
+    if(not Data):
+        return [], None, 0, 0, dict(), None
+    History = []
+    for Sensor in Data:
+        for SensorName, Block in Sensor.items():
+            try:
+                # An array is sent back as one buffer instead of an object per value
+                History.append((SensorName, Block['t0'], Block['dt'], np.asarray(Block['values'], dtype=np.float64)))
+            except (TypeError, ValueError):
+                # Only numeric values are kept
+                pass
+    LastUpdated = LastTimestamp(Data)
+    Received = CountValues(Data)
+    Data = Aggregation.Process(Name, Data)
+    Data = Deadband.Process(Name, Data)
+    # The counters since the last response are added to the counters of the event loop
+    Counters = Deadband.Counters
+    Deadband.Counters = dict()
+    if(not Data):
+        return History, LastUpdated, Received, 0, Counters, None
+    Msg = json.dumps(upstream.Encode(Data, Upstream[0], Upstream[1]), separators=(',', ':'))
+    return History, LastUpdated, Received, CountValues(Data), Counters, Msg
+
+# SHARDS IN THE EVENT LOOP
+class ShardPool:
+    def __init__(self, AggregationState, DeadbandState, Metrics = None):
+        # Aggregation and deadband state of the event loop
+        self.Aggregation = AggregationState
+        self.Deadband = DeadbandState
+        self.Metrics = Metrics
+        self.Shards = []
+        # Number of shards, 0 if the telemetry is processed in the event loop
+        self.Workers = 0
+        self.Upstream = (dict(), upstream.VERSION)
+
+    # A worker process, started when the first task is submitted. Workers are started by a fork server, because
+    # forking the event loop process would copy the threads of the IoT Edge client.
+    def Start(self):
+        return concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('forkserver'), Initialise,
+            (self.Aggregation, self.Deadband, self.Upstream[0], self.Upstream[1]))
+
+    # Change the number of shards, 0 processes the telemetry in the event loop. The responses in the shards are
+    # processed first, and the state of the workers is copied back. Apply(Name, Result) is awaited with the result
+    # of every response, in order.
+    async def Resize(self, Count: int, Apply, Resolution: dict, Version: int):
+        Log = logging.getLogger('Shards')
+        loop = asyncio.get_event_loop()
+        self.Upstream = (dict(Resolution), Version)
+        Old = self.Shards
+        self.Shards = []
+        self.Workers = Count
+        for Shard in Old:
+            await Shard['Queue'].put(None)
+        await asyncio.gather(*[Shard['Task'] for Shard in Old], return_exceptions=True)
+        for Index, Shard in enumerate(Old):
+            try:
+                WorkerAggregation, WorkerDeadband = await loop.run_in_executor(Shard['Executor'], State)
+                for Table, WorkerTable in ((self.Aggregation.Pending, WorkerAggregation.Pending), (self.Deadband.Last, WorkerDeadband.Last)):
+                    for Key in [Key for Key in Table if Key[0] in Shard['Modules']]:
+                        del Table[Key]
+                    Table.update({Key: Value for Key, Value in WorkerTable.items() if Key[0] in Shard['Modules']})
+            except Exception as ex:
+                Log.error('State of shard %s lost - %s', Index, ex)
+            Shard['Executor'].shutdown(wait=False)
+            if(self.Metrics is not None):
+                self.Metrics.Remove('queue', 'Shard{}'.format(Index))
+                self.Metrics.Remove('shard', str(Index))
+        for Index in range(Count):
+            Name = 'Shard{}'.format(Index)
+            Shard = {
+                'Queue': BoundedQueue(QUEUE_SIZE, BLOCK),
+                'Executor': self.Start(),
+                # Names of the modules processed by the shard
+                'Modules': set(),
+                # (module name, submit time, future) of the responses in the worker, oldest first
+                'Pending': collections.deque(),
+                'Latency': None
+            }
+            if(self.Metrics is not None):
+                Shard['Queue'].Wait = self.Metrics.Histogram('dms_queue_wait_seconds', 'Time messages wait in a queue', {'queue': Name})
+                self.Metrics.Gauge('dms_queue_depth', 'Messages waiting in a queue', {'queue': Name}, Shard['Queue'].qsize)
+                Shard['Latency'] = self.Metrics.Histogram('dms_shard_seconds', 'Time from submitting a response to a worker until its result', {'shard': str(Index)})
+            Shard['Task'] = asyncio.ensure_future(self.Run(Index, Shard, Apply))
+            self.Shards.append(Shard)
+        Log.info('Processing telemetry in %s shards', Count)
+
+    # Send the telemetry of a module to its shard
+    async def Submit(self, Module, Msg: dict):
+        Shard = self.Shards[hash(ModuleKey(Module.InterfaceType, Module.Address, None)) % len(self.Shards)]
+        Shard['Modules'].add(Module.Name)
+        await Shard['Queue'].put((Module.Name, Module.ModuleTime, Module.SensorNames, Msg['Message']))
+
+    # Apply a setting of the twin in every worker, after the tasks already submitted
+    def Configure(self, Kind: str, Name: str, Setting):
+        if(Kind == 'Upstream'):
+            self.Upstream = Setting
+        for Shard in self.Shards:
+            try:
+                Shard['Executor'].submit(Configure, Kind, Name, Setting)
+            except concurrent.futures.process.BrokenProcessPool:
+                # The next worker starts with the setting
+                pass
+
+    # Submit the responses of a shard to its worker and apply the results, until None is taken from the queue
+    async def Run(self, Index: int, Shard: dict, Apply):
+        Log = logging.getLogger('Shards')
+        loop = asyncio.get_event_loop()
+        Pending = Shard['Pending']
+        Closing = False
+        try:
+            while(True):
+                if(len(Pending) > 0 and (Closing or len(Pending) >= IN_FLIGHT or Shard['Queue'].empty())):
+                    Name, Start, Future = Pending.popleft()
+                    try:
+                        Result = await Future
+                        if(Shard['Latency'] is not None):
+                            Shard['Latency'].Record(time.perf_counter() - Start)
+                        await Apply(Name, Result)
+                    except concurrent.futures.process.BrokenProcessPool as ex:
+                        Log.error('Worker of shard %s stopped - %s', Index, ex)
+                    except Exception as ex:
+                        Log.error('Error in shard %s - %s', Index, ex)
+                    continue
+                if(Closing): return
+                Item = await Shard['Queue'].get()
+                if(Item is None):
+                    Closing = True
+                    continue
+                try:
+                    Future = loop.run_in_executor(Shard['Executor'], Process, *Item)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # The state of the worker is lost, a new worker starts with the state of the event loop
+                    Log.warning('Starting a new worker for shard %s', Index)
+                    Shard['Executor'] = self.Start()
+                    Future = loop.run_in_executor(Shard['Executor'], Process, *Item)
+                Pending.append((Item[0], time.perf_counter(), Future))
+        except asyncio.CancelledError:
+            Shard['Executor'].shutdown(wait=False)
+
+    # Queue statistics and number of modules of every shard, for the reported properties
+    def Report(self):
+        Report = {'Workers': len(self.Shards)}
+        for Index, Shard in enumerate(self.Shards):
+            Report['Shard{}'.format(Index)] = dict(Shard['Queue'].Report(), Modules=len(Shard['Modules']), InFlight=len(Shard['Pending']))
+        return Report
@@ -0,0 +1,33 @@
+# Conversion of telemetry responses to columnar sensor blocks: [{SensorName: {'t0': ..., 'dt': ..., 'values': [...]}}].
+# t0 is the timestamp of the first value (ms since epoch) and dt the interval between values (ms), both integers,
+# so the timestamp of value i is exactly t0 + i * dt. The adapters expand the blocks to the format they need.
+# Used by the event loop, and by the worker processes when the processing is sharded (see shards.py), so only the
+# module time and sensor names of the module record are needed.
+
+# Blocks of the sensors known to the module. ModuleTime is the timestamp when the module clock was 0 (s).
+def SensorBlocks(ModuleTime: float, SensorNames: list, Telemetry: list):
+    Data = []
+    ModuleTime = int(round(ModuleTime * 1000))
+    for data in Telemetry:
+        SensorName = data[0]
+        # Binary telemetry identifies sensors by their index in the attribute response
+        if(isinstance(SensorName, int)):
+            SensorName = SensorNames[SensorName]
+        elif(SensorName not in SensorNames):
+            continue
+        if(len(data[3]) > 0):
+            Data.append({SensorName: {
+                't0': ModuleTime + int(data[2]),
+                'dt': int(data[1]),
+                'values': data[3]
+            }})
+    return Data
+
+# Timestamp of the last value in a list of sensor blocks (s)
+def LastTimestamp(Data: list):
+    Block = next(iter(Data[-1].values()))
+    return (Block['t0'] + (len(Block['values']) - 1) * Block['dt']) / 1000.0
+
+# Number of values in a list of sensor blocks
+def CountValues(Data: list):
+    return sum(len(Block['values']) for Sensor in Data for Block in Sensor.values())
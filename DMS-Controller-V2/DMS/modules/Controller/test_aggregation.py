@@ -0,0 +1,40 @@
+# Tests of the aggregation of sensor values over windows. Run with python -m pytest in this directory.
+
+import json
+import math
+from aggregation import Aggregator
+
+def Aggregate(Values: list, Statistics: list = ['min', 'max', 'mean', 'stddev', 'last']):
+    Filter = Aggregator()
+    Filter.Configure('S', {'Window': 1, 'Statistics': Statistics})
+    # 4 values per window, the last window is closed by a value of a later window
+    Result = Filter.Process('M', [{'S': {'t0': 0, 'dt': 250, 'values': Values + [0.0] * (-len(Values) % 4) + [0.0]}}])
+    return {Name: Block for Sensor in Result for Name, Block in Sensor.items()}
+
+def test_statistics():
+    Result = Aggregate([1.0, 2.0, 3.0, 4.0, 5.0, 5.0, 5.0, 5.0])
+    assert Result['S.min'] == {'t0': 0, 'dt': 1000, 'values': [1.0, 5.0]}
+    assert Result['S.max']['values'] == [4.0, 5.0]
+    assert Result['S.mean']['values'] == [2.5, 5.0]
+    assert math.isclose(Result['S.stddev']['values'][0], math.sqrt(1.25))
+    assert Result['S.last']['values'] == [4.0, 5.0]
+
+# A null leaves the value out of the statistics of its window
+def test_null_in_window():
+    Result = Aggregate([1.0, None, 3.0, float('nan'), 5.0, 6.0, None, 7.0])
+    assert Result['S.min']['values'] == [1.0, 5.0]
+    assert Result['S.max']['values'] == [3.0, 7.0]
+    assert Result['S.mean']['values'] == [2.0, 6.0]
+    assert Result['S.last']['values'] == [3.0, 7.0]
+    json.dumps(Result, allow_nan=False)
+
+# A window of nulls only is not sent, the windows around it are sent as separate blocks
+def test_window_of_nulls():
+    Filter = Aggregator()
+    Filter.Configure('S', {'Window': 1, 'Statistics': ['mean']})
+    Values = [1.0] * 4 + [None] * 4 + [2.0] * 4 + [0.0]
+    Result = Filter.Process('M', [{'S': {'t0': 0, 'dt': 250, 'values': Values}}])
+    assert Result == [
+        {'S.mean': {'t0': 0, 'dt': 1000, 'values': [1.0]}},
+        {'S.mean': {'t0': 2000, 'dt': 1000, 'values': [2.0]}}
+    ]
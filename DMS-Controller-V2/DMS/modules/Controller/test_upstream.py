@@ -0,0 +1,36 @@
+# Tests of the telemetry message format on the AdapterOut route. Run with python -m pytest in this directory.
+
+import json
+import pytest
+import upstream
+
+def Blocks(Values: list):
+    return [{'S': {'t0': 1602935000000, 'dt': 100, 'values': Values}}]
+
+# Values as the adapters receive them: encoded, sent as JSON and decoded
+def RoundTrip(Values: list, Resolution: dict, Version: int = upstream.VERSION):
+    Msg = json.loads(json.dumps(upstream.Encode(Blocks(Values), Resolution, Version), allow_nan=False))
+    [(Name, Timestamps, Decoded)] = upstream.Decode(Msg)
+    assert Name == 'S'
+    assert Timestamps.tolist() == [1602935000000 + 100 * i for i in range(len(Values))]
+    return Decoded
+
+@pytest.mark.parametrize('Version', [1, 2])
+def test_round_trip(Version):
+    assert RoundTrip([1.0, 1.1, 0.95, 20.0], {'S': 0.05}, Version) == [1.0, 1.1, 0.95, 20.0]
+    assert RoundTrip([1.0, 1.1, 0.95, 20.0], dict(), Version) == [1.0, 1.1, 0.95, 20.0]
+
+def test_quantised():
+    Msg = upstream.Encode(Blocks([1.0, 1.1, 1.2]), {'S': 0.1})
+    assert Msg['b'] == [['S', 0, 100, [10, 1, 1], 0.1]]
+
+# A block with a value which is not a finite number is sent as it is
+@pytest.mark.parametrize('Values', [[1.0, None, 1.2], [True, False, True], [1.0, 'high'], [None]])
+def test_not_quantised(Values):
+    Msg = upstream.Encode(Blocks(Values), {'S': 0.1})
+    assert Msg['b'] == [['S', 0, 100, Values]]
+    assert RoundTrip(Values, {'S': 0.1}) == Values
+
+def test_nan_not_quantised():
+    assert upstream.Quantise([1.0, float('nan')], 0.1) is None
+    assert upstream.Quantise([1.0, float('inf')], 0.1) is None
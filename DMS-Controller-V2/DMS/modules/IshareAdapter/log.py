@@ -0,0 +1,182 @@
+# Logging of the module, replacing print.
+# Ensure that this file is equal in the Controller, SerialInterface, ThingsboardAdapter and IshareAdapter modules.
+# Every task logs with the standard logging module, to a logger named after the task. Every line written is a JSON
+# object, so the logs can be parsed:
+#   {"t": time (s), "level": "INFO", "module": "Controller", "task": "Process messages", "msg": "...", ...}
+# Values passed in extra (for example extra={'Message': Msg}) are added as fields of their own.
+# Formatting is lazy: a message below the level of its logger costs one comparison, its arguments and fields are
+# not formatted at all. The level is set in the twin, for all tasks or per task (see SetLevel).
+# Per-message logs are sampled: at most Rate records per second are written for every logger and message. The number
+# of records left out is added to the next record written, as "suppressed".
+# Records are encoded by the logging task and written to stdout by a thread, so a slow console never blocks the event
+# loop. When the writer can't keep up, QUEUE_SIZE records wait, further records are dropped and counted.
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+
+LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+
+# Records waiting for the writer
+QUEUE_SIZE = 10000
+# Lines written at once
+WRITE_BATCH = 100
+# Libraries which log every connection event at INFO
+QUIET_LOGGERS = ('azure', 'paho', 'urllib3')
+
+# Attributes of every log record, the others were passed in extra
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, ModuleName: str):
+        super().__init__()
+        self.ModuleName = ModuleName
+
+    def format(self, record: logging.LogRecord):
+        Line = {
+            't': round(record.created, 3),
+            'level': record.levelname,
+            'module': self.ModuleName,
+            'task': record.name,
+            'msg': record.getMessage()
+        }
+        for Key, Value in record.__dict__.items():
+            if(Key not in STANDARD_ATTRIBUTES):
+                Line[Key] = Value
+        if(record.exc_info):
+            Line['exc'] = self.formatException(record.exc_info)
+        # Bytes and other values without a JSON form are written as text
+        return json.dumps(Line, default=str)
+
+# Lets through at most Rate records per second for every logger and message
+class SampleFilter(logging.Filter):
+    def __init__(self, Rate: float):
+        super().__init__()
+        self.Rate = Rate
+        # [second, records written, records left out] by (logger name, message)
+        self.Windows = dict()
+        self.Suppressed = 0
+
+    def filter(self, record: logging.LogRecord):
+        if(not self.Rate): return True
+        Key = (record.name, record.msg)
+        Second = int(record.created)
+        Window = self.Windows.get(Key)
+        if(Window is None):
+            Window = self.Windows[Key] = [Second, 0, 0]
+        elif(Window[0] != Second):
+            Window[0] = Second
+            Window[1] = 0
+        if(Window[1] >= self.Rate):
+            Window[2] += 1
+            self.Suppressed += 1
+            return False
+        Window[1] += 1
+        if(Window[2] > 0):
+            record.suppressed = Window[2]
+            Window[2] = 0
+        return True
+
+# Encodes a record and passes the line to the writer, without waiting
+class QueueHandler(logging.Handler):
+    def __init__(self, Lines: queue.Queue):
+        super().__init__()
+        self.Lines = Lines
+        self.Written = 0
+        self.Dropped = 0
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            Line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.Lines.put_nowait(Line)
+            self.Written += 1
+        except queue.Full:
+            self.Dropped += 1
+
+# Writes the lines in the queue to the stream, in batches
+def Writer(Lines: queue.Queue, Stream):
+    while(True):
+        Batch = [Lines.get()]
+        while(len(Batch) < WRITE_BATCH):
+            try:
+                Batch.append(Lines.get_nowait())
+            except queue.Empty:
+                break
+        Write(Stream, Batch)
+
+def Write(Stream, Batch: list):
+    try:
+        Stream.write('\n'.join(Batch) + '\n')
+        Stream.flush()
+    except Exception:
+        pass
+
+# Write the lines still waiting, when the module exits
+def Flush():
+    Batch = []
+    while(True):
+        try:
+            Batch.append(Handler.Lines.get_nowait())
+        except queue.Empty:
+            break
+    if(len(Batch) > 0):
+        Write(sys.stdout, Batch)
+
+Handler = None
+Sampler = None
+
+# Send the logs of all tasks of the module to stdout
+def Setup(ModuleName: str, Level = 'INFO', Rate: float = 10):
+    global Handler, Sampler
+    Lines = queue.Queue(QUEUE_SIZE)
+    Handler = QueueHandler(Lines)
+    Handler.setFormatter(JsonFormatter(ModuleName))
+    Sampler = SampleFilter(Rate)
+    Handler.addFilter(Sampler)
+    Root = logging.getLogger()
+    Root.handlers = [Handler]
+    for Name in QUIET_LOGGERS:
+        logging.getLogger(Name).setLevel(logging.WARNING)
+    SetLevel(Level)
+    threading.Thread(target=Writer, args=(Lines, sys.stdout), daemon=True).start()
+    atexit.register(Flush)
+
+# Set the level of all tasks with a level name, or per task with a dict of task name and level name. The level of
+# 'Default' applies to the tasks without a level of their own, a task set to None uses the default level again.
+# The default level is INFO.
+def SetLevel(Level):
+    if(not isinstance(Level, dict)):
+        Level = {'Default': Level}
+    for Name, Value in Level.items():
+        Logger = logging.getLogger() if Name == 'Default' else logging.getLogger(Name)
+        if(Value is None):
+            Logger.setLevel(logging.INFO if Name == 'Default' else logging.NOTSET)
+        elif(str(Value).upper() in LEVELS):
+            Logger.setLevel(LEVELS[str(Value).upper()])
+        else:
+            raise ValueError('Unknown log level {}'.format(Value))
+
+# Largest number of records per second for every logger and message, 0 for all records
+def SetRate(Rate: float):
+    Sampler.Rate = float(Rate)
+
+# Counters for the reported properties
+def Report():
+    return {
+        'Written': Handler.Written,
+        'Dropped': Handler.Dropped,
+        'Sampled': Sampler.Suppressed
+    }
@@ -1,10 +1,18 @@
 import datetime
 import os
 import sys
+import time
 import asyncio
 from azure.iot.device.aio import IoTHubModuleClient
-from azure.iot.device import Message
+from azure.iot.device import Message, MethodResponse
 import json
+import logging
+import log
+import upstream
+from store import MessageStore
+from queues import BoundedQueue
+from metrics import MetricsRegistry, METRICS_PORT
+from profiling import Profiler, PROFILE_PATH
 import requests
 
 # Verify if all settings are set
@@ -19,42 +27,68 @@ def SettingsFilled():
 # ReceiveTwinProperties is invoked when the module twin's desired properties are updated.
 async def ReceiveTwinProperties(client: IoTHubModuleClient):
     global SettingsComplete, Settings
+    Log = logging.getLogger('Receive twin properties')
     try:
         # Get desired properties
         properties = await client.get_twin()
-        print('Receive twin properties: Got twin')
+        Log.info('Got twin')
         SettingsComplete = UpdateProperties(properties['desired'])
         
         # Listen for updates
         while(True):
             try:
                 data = await client.receive_twin_desired_properties_patch()  # blocking call
-                print('Receive twin properties: Got update patch')
+                Log.info('Got update patch')
                 SettingsComplete = UpdateProperties(data)
             except Exception as ex:
-                print ( 'Unexpected error in twin_patch_listener: {}'.format(ex) )
+                Log.error('Unexpected error in twin patch listener - %s', ex)
     except asyncio.CancelledError:
-        print('Receive twin properties: Task cancelled')
+        Log.info('Task cancelled')
 
 # receive messages from the controller
 async def DataPlatformReceiver(Client: IoTHubModuleClient, DataPlatformIn: asyncio.Queue):
+    Log = logging.getLogger('Data platform receiver')
+    Received = Metrics.Counter('dms_messages_received_total', 'Messages received from the controller')
     try:
         while(True):
             try:
                 input_message = await Client.receive_message_on_input('AdapterIn')  # blocking call
-                print('Data platform receiver: Received message from controller')
+                Log.debug('Received message from controller')
+                Received.Add()
                 Msg = input_message.data
                 try:
                     Msg = json.loads(Msg)
-                    print('Data platform receiver: ', Msg)
+                    Log.debug('Message', extra={'Message': Msg})
                     await DataPlatformIn.put(Msg)
                 except json.JSONDecodeError as ex:
-                    print('Interface receiver: Error decoding JSON - {}'.format(ex))
+                    Log.error('Error decoding JSON - %s', ex)
             except Exception as ex:
-                print('Message receiver: Error - {}'.format(ex))
+                Log.error('Error - %s', ex)
             
     except asyncio.CancelledError:
-        print('Dataplatform receiver: Task cancelled.')
+        Log.info('Task cancelled')
+
+"""
+    Messages which can not be sent to I-share are kept in a store on disk (see store.py), of at most STORESIZE MB.
+    While I-share can't be reached, new messages go to the store as well. Once a message from the store is accepted,
+    the store is sent in batches of REPLAYBATCH messages, one batch every REPLAYINTERVAL seconds, so new messages
+    keep getting through. While I-share can't be reached, the store is tried every RETRYINTERVAL seconds. A message
+    which I-share refuses (a 4xx status other than 429), or which can't be sent at all, is dropped, and a refused batch
+    is halved until the refused message is found. The store is kept at STORE_PATH, which is a volume of the host in the deployment.
+    At most QUEUESIZE messages from the controller wait to be sent. When the queue is full, QUEUEPOLICY decides what
+    happens (see queues.py). While the queue is congested, a Backpressure message is sent to the controller every
+    BACKPRESSURE_INTERVAL seconds, and the controller holds back its telemetry requests. The queue and store
+    statistics are reported every REPORTINTERVAL seconds.
+    The log lines of all tasks are JSON objects (see log.py). LOGLEVEL sets the level of all tasks, or of each task
+    by name with a dict, for example {"Default": "INFO", "Forward stored": "DEBUG"}. At most LOGRATE lines per
+    second are written for every message, 0 writes all lines.
+    The number of messages, posts and the time of every post, the queue and the store are kept in metrics (see
+    metrics.py). They are reported in METRICS, and served in the Prometheus text format on
+    http://IshareAdapter:METRICS_PORT/metrics.
+    A PROFILE with a new ID starts a profiling session of DURATION seconds (see profiling.py). The state of the
+    session is reported in PROFILE, the results are kept in PROFILE_PATH and fetched with the direct method
+    GetProfile.
+"""
 
 def FormatMessageToIshare(Msg: dict):
     global Settings
@@ -62,62 +96,271 @@ def FormatMessageToIshare(Msg: dict):
         'api-key': Settings['API-KEY'],
         'data': []
     }
-    for Sensor in Msg:
-        for Key, Values in Sensor.items():
-            for value in Values:
-                Template = {
-                    'id': Key,
-                    'value': value[0],
-                    'timestamp': value[1]
-                }
-                Message['data'].append(Template)
+    for Key, Timestamps, Values in upstream.Decode(Msg):
+        # Timestamps in seconds since epoch
+        for Timestamp, Value in zip((Timestamps / 1000.0).tolist(), Values):
+            Template = {
+                'id': Key,
+                'value': Value,
+                'timestamp': Timestamp
+            }
+            Message['data'].append(Template)
     return Message
 
-# Send message to I-share
-async def SendToIshare(MessageQueue: asyncio.Queue):
+# Post a message to I-share on a worker thread. Returns POST_OK if I-share accepted it, POST_RETRY if it could not be
+# reached or is too busy (connection error, timeout, 5xx or 429), and POST_REJECTED if it refused the message or the
+# message could not be sent for another reason. A refused message will be refused again, so it is not kept.
+async def PostToIshare(Message: dict):
     global Settings
+    Log = logging.getLogger('Send to I-share')
+    Latency = Metrics.Histogram('dms_http_post_seconds', 'Time until the data platform answered a post')
     headers = {
         'Content-Type': 'application/json'
     }
+    loop = asyncio.get_event_loop()
+    Start = time.perf_counter()
+    try:
+        result = await loop.run_in_executor(None, lambda: requests.post(url=Settings['URL'], headers=headers , json=Message, timeout=HTTP_TIMEOUT))
+        Log.debug('Result %s', result.status_code)
+        Latency.Record(time.perf_counter() - Start)
+        if(result.ok):
+            Result = POST_OK
+        elif(result.status_code >= 500 or result.status_code == 429):
+            Result = POST_RETRY
+        else:
+            Result = POST_REJECTED
+            Log.warning('Message rejected with status %s - %s', result.status_code, result.text[:200])
+        Metrics.Counter('dms_http_posts_total', 'Posts to the data platform', {'result': Result}).Add()
+        return Result
+    except (requests.ConnectionError, requests.Timeout) as ex:
+        Log.error('Error - %s', ex)
+        Metrics.Counter('dms_http_posts_total', 'Posts to the data platform', {'result': POST_RETRY}).Add()
+        return POST_RETRY
+    except Exception as ex:
+        # The message could not be sent at all (for example, it can not be serialised), so sending it again won't help
+        Log.error('Error sending message - %s', ex)
+        Metrics.Counter('dms_http_posts_total', 'Posts to the data platform', {'result': POST_REJECTED}).Add()
+        return POST_REJECTED
+
+# Send message to I-share
+async def SendToIshare(MessageQueue: asyncio.Queue):
+    global Settings, SettingsComplete, Connected, Store
+    Log = logging.getLogger('Send to I-share')
     try:
-        while(not Settings):
-            await asyncio.sleep(5)
         while(True):
             Msg = await MessageQueue.get()
-            if(Settings):
+            if(SettingsComplete and Connected):
                 try:
                     Message = FormatMessageToIshare(Msg)
-                    print('Send to I-share: Sending message -', Message)
-                    result = requests.post(url=Settings['URL'], headers=headers , json=Message)
                 except Exception as ex:
-                    print('Error: {}'.format(ex))
+                    Log.error('Error formatting message - %s', ex)
+                    continue
+                Log.debug('Sending message', extra={'Message': Message})
+                Result = await PostToIshare(Message)
+                if(Result == POST_OK): continue
+                if(Result == POST_REJECTED):
+                    Log.warning('Dropping rejected message', extra={'Message': Msg})
+                    continue
+                Connected = False
+            # Keep the message until I-share can be reached
+            Store.Append(json.dumps(Msg, separators=(',', ':')))
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
+
+# Send the messages in the store, oldest first
+async def ForwardStored():
+    global Settings, SettingsComplete, Connected, Store
+    Log = logging.getLogger('Forward stored')
+    # Number of messages in the next batch. A rejected batch is halved until the rejected message is found.
+    Batch = Settings['REPLAYBATCH']
+    try:
+        while(True):
+            if(len(Store) == 0 or not SettingsComplete):
+                await asyncio.sleep(Settings['REPLAYINTERVAL'])
+                continue
+            Rows = Store.Peek(min(Batch, Settings['REPLAYBATCH']))
+            Message = {
+                'api-key': Settings['API-KEY'],
+                'data': []
+            }
+            for Id, Body in Rows:
+                try:
+                    Message['data'].extend(FormatMessageToIshare(json.loads(Body))['data'])
+                except Exception as ex:
+                    Log.warning('Dropping message %s - %s', Id, ex)
+            Log.info('Sending %s messages, %s in store', len(Rows), len(Store))
+            Result = POST_OK if len(Message['data']) == 0 else await PostToIshare(Message)
+            if(Result == POST_OK):
+                Store.Remove(Rows[-1][0])
+                Connected = True
+                await asyncio.sleep(Settings['REPLAYINTERVAL'])
+            elif(Result == POST_REJECTED and len(Rows) == 1):
+                Log.warning('Dropping rejected message %s', Rows[0][0], extra={'Message': Rows[0][1]})
+                Store.Remove(Rows[0][0], False)
+                Connected = True
+                Batch = Settings['REPLAYBATCH']
+            elif(Result == POST_REJECTED):
+                # One of the messages was rejected, the first half is tried next
+                Batch = len(Rows) // 2
+            else:
+                Connected = False
+                await asyncio.sleep(Settings['RETRYINTERVAL'])
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
+
+# Tell the controller to hold back its telemetry requests while the queue is congested
+async def SignalBackpressure(client: IoTHubModuleClient):
+    global DataPlatformIn
+    Log = logging.getLogger('Signal backpressure')
+    Name = os.environ.get('IOTEDGE_MODULEID', 'IshareAdapter')
+    Signalled = False
+    try:
+        while(True):
+            await asyncio.sleep(BACKPRESSURE_INTERVAL)
+            if(not DataPlatformIn.Congested and not Signalled): continue
+            Msg = {
+                'MessageType': 'Backpressure',
+                'Adapter': Name,
+                'Congested': DataPlatformIn.Congested
+            }
+            try:
+                await client.send_message_to_output(Message(json.dumps(Msg)), 'ControllerOut')
+                Signalled = Msg['Congested']
+            except Exception as ex:
+                Log.error('Error - %s', ex)
     except asyncio.CancelledError:
-        print('Send to I-share: Task cancelled.')  
+        Log.info('Task cancelled')
+
+# Report the queue and store statistics as reported properties
+async def ReportProperties(client: IoTHubModuleClient):
+    global Settings, DataPlatformIn, Store, Metrics, Profiling
+    Log = logging.getLogger('Report properties')
+    try:
+        while(True):
+            await asyncio.sleep(Settings['REPORTINTERVAL'])
+            try:
+                await client.patch_twin_reported_properties({'QUEUE': DataPlatformIn.Report(), 'STORE': Store.Report(), 'LOGGING': log.Report(), 'METRICS': Metrics.Report(), 'PROFILE': Profiling.Report()})
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 # Update settings from received twin properties
 def UpdateProperties(Twin: dict):
-    global Settings
+    global Settings, Store, DataPlatformIn, Profiling
     if('URL' in Twin):
         Settings['URL'] = Twin['URL']
     if('API-KEY' in Twin):
         Settings['API-KEY'] = Twin['API-KEY']
+    if('STORESIZE' in Twin):
+        Settings['STORESIZE'] = float(Twin['STORESIZE'])
+        if(Store is not None):
+            Store.MaxBytes = int(Settings['STORESIZE'] * 1e6)
+            Store.Evict()
+    if('REPLAYBATCH' in Twin):
+        Settings['REPLAYBATCH'] = int(Twin['REPLAYBATCH'])
+    if('REPLAYINTERVAL' in Twin):
+        Settings['REPLAYINTERVAL'] = float(Twin['REPLAYINTERVAL'])
+    if('RETRYINTERVAL' in Twin):
+        Settings['RETRYINTERVAL'] = float(Twin['RETRYINTERVAL'])
+    if('QUEUESIZE' in Twin):
+        Settings['QUEUESIZE'] = int(Twin['QUEUESIZE'])
+        if(DataPlatformIn is not None):
+            DataPlatformIn.Configure(Settings['QUEUESIZE'], None)
+    if('QUEUEPOLICY' in Twin):
+        Settings['QUEUEPOLICY'] = str(Twin['QUEUEPOLICY'])
+        if(DataPlatformIn is not None):
+            DataPlatformIn.Configure(None, Settings['QUEUEPOLICY'])
+    if('LOGLEVEL' in Twin):
+        log.SetLevel(Twin['LOGLEVEL'])
+    if('LOGRATE' in Twin):
+        log.SetRate(Twin['LOGRATE'])
+    if('REPORTINTERVAL' in Twin):
+        Settings['REPORTINTERVAL'] = float(Twin['REPORTINTERVAL'])
+    if('PROFILE' in Twin):
+        Profiling.Request(Twin['PROFILE'])
     return SettingsFilled()
 
 Settings = {
     'URL': None,
     'API-KEY': None,
+    # Largest size of the store (MB)
+    'STORESIZE': 100,
+    # Stored messages sent at once
+    'REPLAYBATCH': 500,
+    # Time between batches from the store (s)
+    'REPLAYINTERVAL': 1,
+    # Time between attempts to reach I-share (s)
+    'RETRYINTERVAL': 30,
+    # Largest number of messages waiting to be sent, and what happens when there are more
+    'QUEUESIZE': 1000,
+    'QUEUEPOLICY': 'block',
+    # Interval of the reported properties (s)
+    'REPORTINTERVAL': 60
 }
 SettingsComplete = False
+# Messages which could not be sent yet
+STORE_PATH = os.environ.get('STORE_PATH', '/data/store.db')
+Store = None
+# False after I-share could not be reached, until a stored message was accepted
+Connected = True
+# Results of a post
+POST_OK = 'ok'
+POST_RETRY = 'failed'
+POST_REJECTED = 'rejected'
+# Time to wait for an answer of I-share (s)
+HTTP_TIMEOUT = 30
+# Messages from the controller, created in Main
+DataPlatformIn = None
+# Interval of the Backpressure messages while the queue is congested (s)
+BACKPRESSURE_INTERVAL = 5
+# Counters, gauges and latency histograms of the module
+Metrics = MetricsRegistry()
+# On-demand profiling sessions, written to a volume of the host
+Profiling = Profiler(os.environ.get('PROFILE_PATH', PROFILE_PATH))
+
+# DIRECT METHODS
+# Profiling sessions and their files, see Profiler.Get
+def GetProfile(Payload: dict):
+    global Profiling
+    return Profiling.Get(Payload)
+
+# Direct methods by name
+Methods = {
+    'GetProfile': GetProfile
+}
+
+# Answer direct method requests
+async def MethodRequestListener(client: IoTHubModuleClient):
+    Log = logging.getLogger('Method request listener')
+    try:
+        while(True):
+            try:
+                Request = await client.receive_method_request()  # blocking call
+                Log.info('Received %s', Request.name)
+                if(Request.name in Methods):
+                    Status, Payload = Methods[Request.name](Request.payload)
+                else:
+                    Status, Payload = 404, {'Error': 'Unknown method'}
+                await client.send_method_response(MethodResponse.create_from_method_request(Request, Status, Payload))
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 async def Startup():
-    print("Starting now")
+    Log = logging.getLogger('Startup')
+    Log.info('Starting now')
     client = IoTHubModuleClient.create_from_edge_environment()
-    print("Created client")
+    Log.info('Created client')
     await client.connect()
-    print("Connected")
+    Log.info('Connected')
     return client
 
 def Main():
+    global Store, DataPlatformIn
+    Log = logging.getLogger('IshareAdapter')
+    log.Setup('IshareAdapter')
     # All settings required for the operation of the DMS
     
     Tasks = []
@@ -127,26 +370,40 @@ def Main():
         if(not sys.version >= '3.7.0'):
             raise Exception('The sample requires python 3.7.0+. Current version of Python: {}'.format(sys.version))
         loop = asyncio.get_event_loop()
+        Store = MessageStore(STORE_PATH, int(Settings['STORESIZE'] * 1e6))
+        Log.info('%s messages in store', len(Store))
         client = loop.run_until_complete(Startup())
         
         # message queue shared by all interfaces which send data to the controller
-        DataPlatformIn = asyncio.Queue()
+        DataPlatformIn = BoundedQueue(Settings['QUEUESIZE'], Settings['QUEUEPOLICY'],
+            Wait=Metrics.Histogram('dms_queue_wait_seconds', 'Time messages wait in a queue', {'queue': 'DataPlatformIn'}))
+        Metrics.Gauge('dms_queue_depth', 'Messages waiting in a queue', {'queue': 'DataPlatformIn'}, DataPlatformIn.qsize)
+        Metrics.Counter('dms_queue_dropped_total', 'Messages dropped by a full queue', {'queue': 'DataPlatformIn'}, lambda: DataPlatformIn.Stats['Dropped'])
+        Metrics.Gauge('dms_store_messages', 'Messages in the store', None, Store.__len__)
+        Metrics.Gauge('dms_store_bytes', 'Size of the messages in the store', None, lambda: Store.Bytes)
+        for Name in ('Stored', 'Forwarded', 'Evicted'):
+            Metrics.Counter('dms_store_messages_total', 'Messages put in, forwarded from and evicted from the store', {'event': Name}, (lambda Name=Name: Store.Stats[Name]))
         
         # Construct tasks
         Tasks.append( loop.create_task( ReceiveTwinProperties( client ) ) )
         Tasks.append( loop.create_task( DataPlatformReceiver( client, DataPlatformIn ) ) )
         Tasks.append( loop.create_task( SendToIshare( DataPlatformIn ) ) )
+        Tasks.append( loop.create_task( ForwardStored() ) )
+        Tasks.append( loop.create_task( SignalBackpressure( client ) ) )
+        Tasks.append( loop.create_task( ReportProperties( client ) ) )
+        Tasks.append( loop.create_task( MethodRequestListener( client ) ) )
+        Tasks.append( loop.create_task( Metrics.Serve( int(os.environ.get('METRICS_PORT', METRICS_PORT)) ) ) )
         
         
         while(True):
             loop.run_until_complete(asyncio.sleep(30))
         
     except KeyboardInterrupt:
-        print('Quittin')
+        Log.info('Quittin')
     except Exception as ex:
-        print('IshareAdapter: {}'.format(ex))
+        Log.error('Error - %s', ex)
     finally:
-        print('Quittin')
+        Log.info('Quittin')
         for task in Tasks:
             task.cancel()
         
@@ -0,0 +1,151 @@
+# Bounded message queues between the tasks of a module, replacing the unbounded asyncio.Queue.
+# Ensure that this file is equal in the Controller, SerialInterface, ThingsboardAdapter and IshareAdapter modules.
+# A queue has the get/put interface of asyncio.Queue, and holds at most MaxSize messages. What happens to a message
+# put in a full queue depends on the policy of the queue:
+#   block        put waits until a message is taken from the queue, put_nowait raises asyncio.QueueFull
+#   drop-oldest  the oldest message in the queue is dropped
+#   drop-newest  the new message is dropped
+#   coalesce     a new message replaces the queued message with the same key, in the place of the queued message.
+#                This happens whether or not the queue is full. Otherwise a full queue drops the oldest message.
+# A queue is congested from the moment it is HIGH_WATER full, until it is emptied to LOW_WATER. Producers which can
+# wait, like the poll scheduler of the controller, hold back while a queue is congested, so a slow consumer slows
+# down the producers before messages are dropped.
+# The numbers of dropped and coalesced messages, and the largest size since the last report, are reported. With a
+# Wait histogram (see metrics.py), the time every message spent in the queue is recorded.
+
+import asyncio
+import collections
+import time
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+# Fill at which a queue becomes congested, and at which it is no longer congested
+HIGH_WATER = 0.8
+LOW_WATER = 0.5
+
+class BoundedQueue:
+    def __init__(self, MaxSize: int = 1000, Policy: str = BLOCK, Key = None, Wait = None):
+        self.MaxSize = MaxSize
+        self.Policy = Policy
+        # Function returning the key of a message, for coalescing
+        self.Key = Key
+        # Histogram of the time between put and get
+        self.Wait = Wait
+        # [key, message, time of the put] of the queued messages, oldest first
+        self.Entries = collections.deque()
+        # Queued entry by key
+        self.Keys = dict()
+        self.Available = asyncio.Event()
+        self.Room = asyncio.Event()
+        self.Room.set()
+        self.Congested = False
+        self.Stats = {
+            'Put': 0,
+            'Dropped': 0,
+            'Coalesced': 0,
+            # Largest size since the last report
+            'HighWater': 0
+        }
+
+    # Change the size or the policy. Messages above a smaller size stay in the queue.
+    def Configure(self, MaxSize: int = None, Policy: str = None):
+        if(Policy is not None):
+            if(Policy not in POLICIES):
+                raise ValueError('Unknown queue policy {}'.format(Policy))
+            self.Policy = Policy
+        if(MaxSize is not None):
+            self.MaxSize = max(1, int(MaxSize))
+        self.Update()
+        # Producers waiting for room check the new size and policy
+        self.Room.set()
+
+    def qsize(self):
+        return len(self.Entries)
+
+    def empty(self):
+        return len(self.Entries) == 0
+
+    def full(self):
+        return len(self.Entries) >= self.MaxSize
+
+    # Update the congestion state and wake up producers waiting for room
+    def Update(self):
+        Size = len(self.Entries)
+        if(Size >= HIGH_WATER * self.MaxSize):
+            self.Congested = True
+        elif(Size <= LOW_WATER * self.MaxSize):
+            self.Congested = False
+        if(Size < self.MaxSize):
+            self.Room.set()
+
+    def Pop(self):
+        Key, Msg, Time = self.Entries.popleft()
+        if(Key is not None):
+            self.Keys.pop(Key, None)
+        return Msg, Time
+
+    # Returns False if the message was dropped
+    def put_nowait(self, Msg):
+        Key = self.Key(Msg) if self.Policy == COALESCE and self.Key is not None else None
+        if(Key is not None and Key in self.Keys):
+            self.Keys[Key][1] = Msg
+            self.Stats['Put'] += 1
+            self.Stats['Coalesced'] += 1
+            return True
+        if(self.full()):
+            if(self.Policy == BLOCK):
+                raise asyncio.QueueFull()
+            if(self.Policy == DROP_NEWEST):
+                self.Stats['Put'] += 1
+                self.Stats['Dropped'] += 1
+                return False
+            while(self.full()):
+                self.Pop()
+                self.Stats['Dropped'] += 1
+        Entry = [Key, Msg, time.monotonic()]
+        self.Entries.append(Entry)
+        if(Key is not None):
+            self.Keys[Key] = Entry
+        self.Stats['Put'] += 1
+        self.Stats['HighWater'] = max(self.Stats['HighWater'], len(self.Entries))
+        self.Update()
+        self.Available.set()
+        return True
+
+    async def put(self, Msg):
+        while(self.Policy == BLOCK and self.full()):
+            self.Room.clear()
+            await self.Room.wait()
+        return self.put_nowait(Msg)
+
+    def get_nowait(self):
+        if(self.empty()):
+            raise asyncio.QueueEmpty()
+        Msg, Time = self.Pop()
+        if(self.Wait is not None):
+            self.Wait.Record(time.monotonic() - Time)
+        self.Update()
+        return Msg
+
+    async def get(self):
+        while(self.empty()):
+            self.Available.clear()
+            await self.Available.wait()
+        return self.get_nowait()
+
+    def task_done(self):
+        pass
+
+    # Statistics for the reported properties, the high-water mark is reset
+    def Report(self):
+        Report = dict(self.Stats)
+        Report['Size'] = len(self.Entries)
+        Report['MaxSize'] = self.MaxSize
+        Report['Policy'] = self.Policy
+        Report['Congested'] = self.Congested
+        self.Stats['HighWater'] = len(self.Entries)
+        return Report
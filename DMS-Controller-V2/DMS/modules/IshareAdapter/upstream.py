@@ -0,0 +1,76 @@
+# Telemetry message format on the AdapterOut route, from the controller to the data platform adapters.
+# Ensure that this file is equal in the Controller, ThingsboardAdapter and IshareAdapter modules.
+#
+# Version 1 is a list of sensor blocks:
+#   [{SensorName: {'t0': first timestamp (ms), 'dt': interval (ms), 'values': [...]}}, ...]
+# Version 2 is a compact object. Block timestamps are relative to a base time, so they are short numbers:
+#   {'v': 2, 't': base time (ms), 'b': [[SensorName, t0 - t, dt, values], ...]}
+# A block with a fifth element (the resolution) holds quantised values: the first value divided by the resolution
+# and rounded, followed by the differences between consecutive quantised values. Slowly changing values become
+# small integers, which take a few characters each instead of a full float. A block with a value which is not a
+# finite number (null, NaN, a boolean or a string) is sent as it is, without resolution.
+# The values of a block are sampled at a fixed interval, so timestamps need no encoding beyond t0 and dt.
+
+import numpy as np
+
+VERSION = 2
+
+# Quantise values to multiples of Resolution, as the first value followed by the differences.
+# Returns None if a value is not a finite number.
+def Quantise(Values: list, Resolution: float):
+    Values = np.asarray(Values)
+    # Null or strings give an object or string array, booleans a boolean array
+    if(Values.dtype.kind not in 'iuf' or not np.isfinite(Values).all()):
+        return None
+    Quantised = np.rint(Values / Resolution).astype(np.int64)
+    Quantised[1:] = np.diff(Quantised)
+    return Quantised.tolist()
+
+# Undo Quantise
+def Dequantise(Deltas: list, Resolution: float):
+    Quantised = np.cumsum(np.asarray(Deltas, dtype=np.int64))
+    # Dividing by the inverse of a resolution like 0.1 gives 0.3 instead of 0.30000000000000004
+    Inverse = 1.0 / Resolution
+    if(abs(Inverse - round(Inverse)) < 1e-9):
+        return (Quantised / round(Inverse)).tolist()
+    return (Quantised * Resolution).tolist()
+
+# Encode the sensor blocks of ProcessTelemetry. Resolution maps sensor names to the resolution their values
+# are quantised to, sensors without a resolution are sent as they are.
+def Encode(Blocks: list, Resolution: dict = None, Version: int = VERSION):
+    if(Version == 1):
+        return Blocks
+    if(Resolution is None):
+        Resolution = dict()
+    Entries = []
+    Base = None
+    for Sensor in Blocks:
+        for Name, Block in Sensor.items():
+            if(Base is None):
+                Base = Block['t0']
+            Entry = [Name, Block['t0'] - Base, Block['dt'], Block['values']]
+            Quantised = Quantise(Block['values'], Resolution[Name]) if Resolution.get(Name) else None
+            if(Quantised is not None):
+                Entry[3] = Quantised
+                Entry.append(Resolution[Name])
+            Entries.append(Entry)
+    return {'v': 2, 't': Base if Base is not None else 0, 'b': Entries}
+
+# Decode a message of any version to a list of (SensorName, timestamps (ms, numpy array), values) tuples
+def Decode(Msg):
+    Decoded = []
+    if(isinstance(Msg, list)):
+        for Sensor in Msg:
+            for Name, Block in Sensor.items():
+                Timestamps = Block['t0'] + np.arange(len(Block['values']), dtype=np.int64) * Block['dt']
+                Decoded.append((Name, Timestamps, Block['values']))
+    elif(isinstance(Msg, dict) and Msg.get('v') == 2):
+        for Entry in Msg['b']:
+            Values = Entry[3]
+            if(len(Entry) > 4):
+                Values = Dequantise(Values, Entry[4])
+            Timestamps = Msg['t'] + Entry[1] + np.arange(len(Values), dtype=np.int64) * Entry[2]
+            Decoded.append((Entry[0], Timestamps, Values))
+    else:
+        raise ValueError('Unknown telemetry message version')
+    return Decoded
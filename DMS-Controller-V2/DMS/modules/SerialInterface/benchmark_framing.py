@@ -0,0 +1,91 @@
+# Micro-benchmark for the frame decoder.
+# Run with: python3 benchmark_framing.py
+# The random frames are used by the fuzz test in test_framing.py as well.
+# The benchmark compares decoding a stream frame by frame (as the adapter did before) with the streaming decoder.
+
+import json
+import random
+import time
+import config
+from framing import FrameDecoder, CrcTrailer
+
+# Random telemetry payload, as sent by the Interface firmware
+def RandomTelemetry(Rng: random.Random, Sensors: int, Samples: int):
+    return json.dumps([
+        ['Sensor{}'.format(i), 100, Rng.randint(0, 100000), [round(Rng.uniform(-100, 100), 4) for _ in range(Samples)]]
+        for i in range(Sensors)
+    ], separators=(',', ':')).encode('ascii')
+
+# Random frame. Some frames are valid, some have broken payloads. Some have a CRC trailer, which may be wrong.
+def RandomFrame(Rng: random.Random):
+    Address = Rng.randint(1, 0xfd)
+    Code = Rng.choice([config.RESP_TEL_SUCCESS, config.RESP_TEL_NO_NEW_VALUES, config.RESP_ATT_SUCCESS])
+    Kind = Rng.random()
+    if(Kind < 0.2):
+        Payload = b''
+    elif(Kind < 0.3):
+        Payload = b'\n'
+    elif(Kind < 0.4):
+        # Invalid JSON
+        Payload = b'[1,2'
+    elif(Kind < 0.5):
+        # Invalid ASCII
+        Payload = bytes([Rng.randint(0x80, 0xff) for _ in range(5)])
+    else:
+        Payload = RandomTelemetry(Rng, Rng.randint(1, 3), Rng.randint(1, 20))
+    Body = bytes([Address, Code]) + Payload
+    if(Rng.random() < 0.3):
+        Trailer = CrcTrailer(Body) if Rng.random() < 0.8 else b'%04X' % Rng.randint(0, 0xffff)
+        return bytes([config.RESP_START_CRC]) + Body + Trailer + bytes([config.MSG_END])
+    return bytes([config.RESP_START]) + Body + bytes([config.MSG_END])
+
+# Garbage between frames. It does not contain start bytes, since a stray start byte directly followed by a frame
+# can not be told apart from a corrupted frame with this protocol.
+def RandomGarbage(Rng: random.Random):
+    Bytes = [b for b in range(256) if b not in (config.RESP_START, config.RESP_START_CRC)]
+    return bytes(Rng.choice(Bytes) for _ in range(Rng.randint(0, 10)))
+
+# Decoding as done before the frame decoder existed: the frame is assembled one byte at a time,
+# after which the payload is copied out of it and decoded
+def DecodeBytewise(Stream: bytes):
+    Text = bytearray()
+    for Position in range(len(Stream)):
+        Text += Stream[Position:Position + 1]
+        if(Text[-1] == config.MSG_END):
+            json.loads(Text[3:-1].decode('ascii'))
+            Text = bytearray()
+
+# Only the decoding step of the above, for frames which are already assembled
+def DecodeSliced(Frames: list):
+    for Frame in Frames:
+        json.loads(Frame[3:-1].decode('ascii'))
+
+def DecodeStream(Stream: bytes, ChunkSize: int):
+    Decoder = FrameDecoder()
+    for Position in range(0, len(Stream), ChunkSize):
+        Decoder.Feed(Stream[Position:Position + ChunkSize])
+
+def Benchmark(Rounds: int = 10):
+    Rng = random.Random(2)
+    Frames = [
+        bytes([config.RESP_START, 1, config.RESP_TEL_SUCCESS]) + RandomTelemetry(Rng, 3, 20) + bytes([config.MSG_END])
+        for _ in range(1000)
+    ]
+    Stream = b''.join(Frames)
+    Cases = [
+        ('Byte at a time, then sliced', lambda: DecodeBytewise(Stream)),
+        ('Sliced, frames preassembled', lambda: DecodeSliced(Frames)),
+        ('FrameDecoder, 64 byte chunks', lambda: DecodeStream(Stream, 64)),
+        ('FrameDecoder, 4096 byte chunks', lambda: DecodeStream(Stream, 4096)),
+    ]
+    print('Benchmark: {} frames, {} bytes'.format(len(Frames), len(Stream)))
+    for Name, Function in Cases:
+        Best = float('inf')
+        for _ in range(Rounds):
+            Start = time.perf_counter()
+            Function()
+            Best = min(Best, time.perf_counter() - Start)
+        print('\t{:<32} {:8.2f} us/frame'.format(Name, Best / len(Frames) * 1e6))
+
+if __name__ == '__main__':
+    Benchmark()
@@ -0,0 +1,133 @@
+# Throughput benchmark of the SerialInterface module against the bus simulator.
+# Run with: python3 benchmark_serial.py --modules 20 --duration 10
+# The serial adapter of main.py is started on a simulated bus. Every module is polled continuously, with one
+# telemetry request outstanding per module. Reported are the polls per second, the poll round-trip time
+# (from queueing the request to receiving the response) and how long the event loop was stalled.
+# Every module is sent an attribute request first, so modules can announce support for CRC trailers.
+
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+import config
+import main
+from scheduler import BusScheduler
+from simulator import BusSimulator, SimulatedModule
+
+def Percentile(Values: list, Fraction: float):
+    if(len(Values) == 0): return float('nan')
+    Values = sorted(Values)
+    return Values[min(len(Values) - 1, int(Fraction * len(Values)))]
+
+# Measure event loop stalls: a task which sleeps for Interval and records how late it wakes up
+async def StallMonitor(Stalls: list, Interval: float = 0.001):
+    while(True):
+        Start = time.perf_counter()
+        await asyncio.sleep(Interval)
+        Stalls.append(max(0.0, time.perf_counter() - Start - Interval))
+
+async def Poll(Args, PortName: str):
+    main.Settings.update({
+        'BAUDRATE': Args.baudrate,
+        'SERIALPORT': PortName,
+        'PARITY': main.serial.PARITY_NONE,
+        'STOPBITS': main.serial.STOPBITS_ONE,
+        'DATABITS': main.serial.EIGHTBITS,
+        'TIMEOUT': Args.timeout
+    })
+    main.SettingsComplete = True
+    OutQueue = BusScheduler()
+    InQueue = asyncio.Queue()
+    Code = config.REQ_TEL_BINARY if Args.binary else config.REQ_TEL
+    Addresses = list(range(1, Args.modules + 1))
+    Sent = {}
+    RoundTrips = []
+    Codes = {}
+    Stalls = []
+    Tasks = [
+        asyncio.ensure_future(main.SerialAdapter(main.DEFAULT_PORT, InQueue, OutQueue)),
+        asyncio.ensure_future(StallMonitor(Stalls))
+    ]
+    Pending = set(Addresses)
+    for Attempt in range(5):
+        for Address in Pending:
+            await OutQueue.put({'Address': Address, 'FunctionCode': config.REQ_ATT})
+        for _ in range(len(Pending)):
+            Response = await asyncio.wait_for(InQueue.get(), 5.0)
+            if(Response['ResponseCode'] == config.RESP_ATT_SUCCESS):
+                Pending.discard(Response['Address'])
+    for Address in Addresses:
+        Sent[Address] = time.perf_counter()
+        await OutQueue.put({'Address': Address, 'FunctionCode': Code})
+    Start = time.perf_counter()
+    while(time.perf_counter() - Start < Args.duration):
+        try:
+            Response = await asyncio.wait_for(InQueue.get(), 1.0)
+        except asyncio.TimeoutError:
+            continue
+        Now = time.perf_counter()
+        Address = Response['Address']
+        RoundTrips.append(Now - Sent[Address])
+        Codes[Response['ResponseCode']] = Codes.get(Response['ResponseCode'], 0) + 1
+        Sent[Address] = Now
+        await OutQueue.put({'Address': Address, 'FunctionCode': Code})
+    Elapsed = time.perf_counter() - Start
+    Estimator = main.Estimators.get(main.DEFAULT_PORT)
+    Report = Estimator.Report(Args.timeout) if Estimator is not None else dict()
+    Link = dict(main.LinkStats.get(main.DEFAULT_PORT, dict()))
+    for Task in Tasks:
+        Task.cancel()
+    await asyncio.gather(*Tasks, return_exceptions=True)
+    return Elapsed, RoundTrips, Codes, Stalls, Report, Link
+
+def Main():
+    Parser = argparse.ArgumentParser(description='SerialInterface throughput benchmark on a simulated bus')
+    Parser.add_argument('--modules', type=int, default=8)
+    Parser.add_argument('--samples', type=int, default=10, help='values per sensor in each telemetry response')
+    Parser.add_argument('--sensors', type=int, default=2)
+    Parser.add_argument('--latency', type=float, default=0.002, help='module processing time (s)')
+    Parser.add_argument('--drop', type=float, default=0.0, help='fraction of requests not answered')
+    Parser.add_argument('--corrupt', type=float, default=0.0, help='fraction of frames with a damaged byte')
+    Parser.add_argument('--baudrate', type=int, default=115200)
+    Parser.add_argument('--timeout', type=float, default=0.1, help='TIMEOUT twin setting (s)')
+    Parser.add_argument('--binary', action='store_true', help='poll with binary telemetry requests')
+    Parser.add_argument('--duration', type=float, default=10.0)
+    Parser.add_argument('--verbose', action='store_true', help='keep the output of the module')
+    Args = Parser.parse_args()
+
+    Simulator = BusSimulator(
+        [SimulatedModule(Address, Args.sensors, Args.samples) for Address in range(1, Args.modules + 1)],
+        Latency = Args.latency,
+        DropRate = Args.drop,
+        CorruptRate = Args.corrupt,
+        Baudrate = Args.baudrate,
+        Seed = 1
+    )
+    Simulator.Start()
+    try:
+        loop = asyncio.get_event_loop()
+        with open(os.devnull, 'w') as Null:
+            # The module prints every message. The printing cost is kept, the output is discarded.
+            with (contextlib.redirect_stdout(Null) if not Args.verbose else contextlib.suppress()):
+                Elapsed, RoundTrips, Codes, Stalls, Report, Link = loop.run_until_complete(Poll(Args, Simulator.PortName))
+    finally:
+        Simulator.Stop()
+
+    print('Modules: {}, sensors: {}, values per sensor: {}, latency: {} ms, drop rate: {}, corrupt rate: {}, baudrate: {}, binary: {}'.format(
+        Args.modules, Args.sensors, Args.samples, Args.latency * 1000, Args.drop, Args.corrupt, Args.baudrate, Args.binary))
+    print('Polls/s:          {:10.1f}'.format(len(RoundTrips) / Elapsed))
+    Telemetry = Codes.get(config.RESP_TEL_SUCCESS, 0) + Codes.get(config.RESP_TEL_BINARY_SUCCESS, 0)
+    print('Values/s:         {:10.1f}'.format(Telemetry * Args.sensors * Args.samples / Elapsed))
+    print('Round trip p50:   {:10.2f} ms'.format(Percentile(RoundTrips, 0.5) * 1000))
+    print('Round trip p99:   {:10.2f} ms'.format(Percentile(RoundTrips, 0.99) * 1000))
+    print('Loop stall p99:   {:10.2f} ms'.format(Percentile(Stalls, 0.99) * 1000))
+    print('Loop stall max:   {:10.2f} ms'.format(max(Stalls, default=0.0) * 1000))
+    print('Loop stall total: {:10.2f} ms'.format(sum(Stalls) * 1000))
+    print('Response codes:   {}'.format({hex(Code): Count for Code, Count in sorted(Codes.items())}))
+    print('Link:             {}'.format(Link))
+    for Address, Stats in sorted(Report.items(), key=lambda Item: int(Item[0])):
+        print('Address {:>3}:      srtt {SRTT} ms, rttvar {RTTVAR} ms, timeout {Timeout} ms, timeouts {Timeouts}'.format(Address, **Stats))
+
+if __name__ == '__main__':
+    Main()
@@ -7,6 +7,11 @@ RESP_JSON_DECODE_ERROR = 0x04
 RESP_INVALID_REQUEST = 0x05
 RESP_JSON_ENCODE_ERROR = 0x06
 RESP_INVALID_FUNCTIONCODE = 0x07 # used at the sensor module
+# Frame integrity, for modules which announce "CRC" in their attribute response
+RESP_CRC_ERROR = 0x08 # the response frame failed its CRC check
+REQ_RETRANSMIT = 0x09 # ask the module to send its last response frame again
+RESP_REQUEST_CRC_ERROR = 0x0A # used at the sensor module, the request frame failed its CRC check
+RESP_NO_RETRANSMIT = 0x0B # used at the sensor module, there is no response to send again
 
 # Request latest telemetry from module
 REQ_TEL = 0x10
@@ -16,6 +21,11 @@ RESP_TEL_ERROR = 0x12
 RESP_TEL_NO_SENSORS = 0x13
 RESP_TEL_NO_NEW_VALUES = 0x14
 
+# Request latest telemetry from module as a binary payload
+REQ_TEL_BINARY = 0x15
+# Module response code to a binary telemetry request. The other telemetry response codes are used as well.
+RESP_TEL_BINARY_SUCCESS = 0x16
+
 # Request attributes from module
 REQ_ATT = 0x20
 # Response codes to attribute request
@@ -40,6 +50,12 @@ RESP_SAMPLEINTERVAL_ERROR = 0x42
 RESP_SAMPLEINTERVAL_NOSENSOR = 0x43
 RESP_SAMPLEINTERVAL_JSONERROR = 0x44
 
+# Broadcast address. Every module answers a broadcast request, in a time slot derived from its address
+ADDRESS_BROADCAST = 0xfe
+
 MSG_START = 77
 RESP_START = 82
+# Start bytes of frames with a CRC16 trailer (4 hexadecimal characters in front of MSG_END)
+MSG_START_CRC = 67
+RESP_START_CRC = 83
 MSG_END = 0
\ No newline at end of file
@@ -0,0 +1,254 @@
+# Decoding of module responses.
+# A response frame looks like: RESP_START, address, response code, optional ASCII JSON payload, MSG_END.
+# Binary telemetry responses carry a COBS encoded payload instead of JSON, which contains no MSG_END bytes either.
+# Frames starting with RESP_START_CRC end with a CRC16 of the address, response code and payload, written as
+# 4 hexadecimal characters in front of MSG_END.
+# The frame decoder accepts the bytes from the serial port in arbitrary chunks and returns every complete frame,
+# skipping any garbage between frames. Payloads are decoded straight from a memoryview on the receive buffer,
+# so no intermediate copies of the frame are made.
+
+import array
+import binascii
+import datetime
+import json
+import logging
+import re
+import struct
+import sys
+import config
+
+# Largest frame the decoder will wait for. A module can send at most OUTBUFFER_SIZE bytes of JSON (InterfaceConfig.h)
+MAX_FRAME_SIZE = 1024
+
+# Decoding errors are logged by the task which decodes the frame. Only the text of an exception is logged: a decoding
+# exception refers to the memoryview of the frame, which would keep the receive buffer from being resized.
+Log = logging.getLogger('Framing')
+
+# Binary telemetry: header of each sensor block (index, value type, number of values, interval, offset), little-endian
+TELEMETRY_HEADER = struct.Struct('<BBHII')
+# Array typecode and size of each value type
+TELEMETRY_TYPES = {
+    0: ('f', 4),
+    1: ('i', 4),
+    2: ('B', 1)
+}
+
+# Length of the CRC trailer
+CRC_SIZE = 4
+# Either start byte of a response frame
+FRAME_START = re.compile(b'[' + bytes([config.RESP_START, config.RESP_START_CRC]) + b']')
+
+# CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF), as calculated by the module (Crc16Update)
+def Crc16(Data):
+    return binascii.crc_hqx(Data, 0xFFFF)
+
+# CRC trailer of a frame, over everything between the start byte and the trailer
+def CrcTrailer(Data):
+    return b'%04X' % Crc16(Data)
+
+# Consistent Overhead Byte Stuffing, as applied by the module (SerialInterface::WriteCobs). Used by the simulator.
+def CobsEncode(Data):
+    Output = bytearray()
+    Start = 0
+    while(True):
+        End = Start
+        while(End < len(Data) and Data[End] != 0 and End - Start < 254):
+            End += 1
+        Output.append(End - Start + 1)
+        Output += Data[Start:End]
+        if(End >= len(Data)): break
+        # A full block of 254 bytes has no zero after it, the next block starts right after it.
+        # Otherwise the block ended at a zero, which is replaced by the length byte.
+        Start = End if End - Start == 254 else End + 1
+    return bytes(Output)
+
+# Undo the Consistent Overhead Byte Stuffing applied by the module
+def CobsDecode(Data):
+    Output = bytearray()
+    Position = 0
+    while(Position < len(Data)):
+        Code = Data[Position]
+        End = Position + Code
+        if(Code == 0 or End > len(Data)):
+            raise ValueError('Invalid COBS block at {}'.format(Position))
+        Output += Data[Position + 1:End]
+        Position = End
+        # Every block except a full one and the last is followed by a zero
+        if(Code < 0xFF and Position < len(Data)):
+            Output.append(0)
+    return Output
+
+# Decode a binary telemetry payload to the same structure as a JSON telemetry payload.
+# The sensor name is replaced by the index of the sensor in the attribute response.
+def DecodeBinaryTelemetry(Payload):
+    Telemetry = []
+    Position = 0
+    while(Position < len(Payload)):
+        Index, Type, Count, Interval, Offset = TELEMETRY_HEADER.unpack_from(Payload, Position)
+        Position += TELEMETRY_HEADER.size
+        Typecode, Size = TELEMETRY_TYPES[Type]
+        End = Position + Count * Size
+        if(End > len(Payload)):
+            raise ValueError('Telemetry block of sensor {} is truncated'.format(Index))
+        Values = array.array(Typecode, Payload[Position:End])
+        if(sys.byteorder == 'big'): Values.byteswap()
+        Telemetry.append([Index, Interval, Offset, Values.tolist()])
+        Position = End
+    return Telemetry
+
+# Decode one complete frame. Returns the address of the sending module and the fields for the controller message.
+def ParseFrame(Frame):
+    PayloadEnd = len(Frame) - 1
+    if(Frame[0] == config.RESP_START_CRC):
+        PayloadEnd -= CRC_SIZE
+        try:
+            Valid = PayloadEnd >= 3 and int(bytes(Frame[PayloadEnd:-1]), 16) == Crc16(Frame[1:PayloadEnd])
+        except ValueError:
+            Valid = False
+        if(not Valid):
+            # The address may be damaged as well
+            return int(Frame[1]), {'ResponseCode': config.RESP_CRC_ERROR}
+    Fields = {'ResponseCode': int(Frame[2])}
+    if(Fields['ResponseCode'] == config.RESP_TEL_BINARY_SUCCESS):
+        try:
+            Fields['Message'] = DecodeBinaryTelemetry(CobsDecode(Frame[3:PayloadEnd]))
+        except (ValueError, KeyError, struct.error) as ex:
+            Log.warning('Decoding failed - %s', str(ex))
+            Fields = {'ResponseCode': config.RESP_BYTE_DECODE_ERROR}
+    elif(PayloadEnd > 3):
+        try:
+            String = str(Frame[3:PayloadEnd], 'ascii')
+            # The module sends a newline when there is no payload
+            if(not String.isspace()):
+                Fields['Message'] = json.loads(String)
+        except UnicodeDecodeError as ex:
+            # Byte array can't be converted to string
+            Log.warning('Decoding failed - %s', str(ex))
+            Fields = {'ResponseCode': config.RESP_BYTE_DECODE_ERROR}
+        except json.JSONDecodeError as ex:
+            # Wrong JSON syntax
+            Log.warning('Decoding failed - %s', str(ex))
+            Fields = {'ResponseCode': config.RESP_JSON_DECODE_ERROR}
+    return int(Frame[1]), Fields
+
+class FrameDecoder:
+    def __init__(self, MaxFrameSize: int = MAX_FRAME_SIZE):
+        self.Buffer = bytearray()
+        self.MaxFrameSize = MaxFrameSize
+        # Number of bytes which were not part of a valid frame
+        self.Discarded = 0
+
+    # Forget any partially received frame
+    def Reset(self):
+        self.Buffer.clear()
+
+    # Add received bytes. Returns a list of (Address, Fields) tuples, one for each frame completed by these bytes.
+    def Feed(self, Chunk: bytes):
+        Buffer = self.Buffer
+        Buffer += Chunk
+        Frames = []
+        Position = 0
+        View = memoryview(Buffer)
+        try:
+            while(True):
+                Match = FRAME_START.search(Buffer, Position)
+                Start = Match.start() if Match is not None else -1
+                if(Start < 0):
+                    # Nothing but garbage left
+                    self.Discarded += len(Buffer) - Position
+                    Position = len(Buffer)
+                    break
+                self.Discarded += Start - Position
+                End = Buffer.find(config.MSG_END, Start + 1)
+                if(End < 0):
+                    if(len(Buffer) - Start > self.MaxFrameSize):
+                        # No delimiter within the maximum frame length, this was not a real start byte
+                        self.Discarded += 1
+                        Position = Start + 1
+                        continue
+                    # Frame is not complete yet, keep it for the next chunk
+                    Position = Start
+                    break
+                if(End - Start < 3):
+                    # Too short to contain a header
+                    self.Discarded += End + 1 - Start
+                else:
+                    Frames.append(ParseFrame(View[Start:End + 1]))
+                Position = End + 1
+        finally:
+            View.release()
+        del Buffer[:Position]
+        return Frames
+
+# Base of a response message for the controller. Request is the encoded request as it was sent to the module,
+# so the address and function code can be copied from it.
+def ResponseMessage(Request: bytes):
+    return {
+        'MessageType': 'ModuleResponse',
+        'InterfaceType': 'SerialInterface',
+        'Address': int(Request[1]),
+        'Timestamp': datetime.datetime.now().timestamp(),
+        'FunctionCode': int(Request[2])
+    }
+
+# Construct the response message from the frames decoded during a transaction
+def ResponseFromFrames(Request: bytes, Frames: list, Received: int):
+    Message = ResponseMessage(Request)
+    for Address, Fields in Frames:
+        if(Address == Request[1]):
+            Message.update(Fields)
+            return Message
+    # A damaged frame, most likely from the requested module with a damaged address
+    if(any(Fields['ResponseCode'] == config.RESP_CRC_ERROR for Address, Fields in Frames)):
+        Message.update({'ResponseCode': config.RESP_CRC_ERROR})
+    # No response at all
+    elif(Received == 0):
+        Message.update({'ResponseCode': config.RESP_TIMEOUT})
+    # Bytes were received, but no valid frame from the requested module
+    else:
+        Message.update({'ResponseCode': config.RESP_INVALID_HEADER})
+    return Message
+
+# Construct a response message for every module that answered a broadcast request.
+# Modules in Addresses which did not answer get a timeout response. Damaged frames can't be attributed to a module,
+# they are left out.
+def ResponsesFromBroadcast(Request: bytes, Frames: list, Addresses: list):
+    Responses = []
+    Answered = set()
+    for Address, Fields in Frames:
+        if(Fields['ResponseCode'] == config.RESP_CRC_ERROR): continue
+        Message = ResponseMessage(Request)
+        Message.update(Fields)
+        Message['Address'] = Address
+        Responses.append(Message)
+        Answered.add(Address)
+    for Address in Addresses:
+        if(Address not in Answered):
+            Message = ResponseMessage(Request)
+            Message.update({'Address': Address, 'ResponseCode': config.RESP_TIMEOUT})
+            Responses.append(Message)
+    return Responses
+
+# Replacement for SerialBytesToDict
+def ConstructResponse(Request: bytes, Input: bytes):
+    # This function constructs a response message for the controller, based on the received bytes from the serial connection.
+    # It uses the responsecodes defined in config. Ensure that those response codes are equal to the codes in the controller config and the InterfaceConfig.h file
+    Message = ResponseMessage(Request)
+    # No response at all
+    if(len(Input) == 0):
+        Message.update({'ResponseCode': config.RESP_TIMEOUT})
+
+    # At least 4 bytes are expected in a response
+    elif(len(Input) < 4):
+        Message.update({'ResponseCode': config.RESP_INVALID_HEADER})
+
+    # Last byte should be MSG_END and first byte should be RESP_START or RESP_START_CRC
+    elif(Input[-1] != config.MSG_END or int(Input[0]) not in (config.RESP_START, config.RESP_START_CRC)):
+        Message.update({'ResponseCode': config.RESP_INVALID_HEADER})
+
+    # Normal response, with or without JSON payload
+    else:
+        with memoryview(Input) as View:
+            Address, Fields = ParseFrame(View)
+        Message.update(Fields)
+    return Message
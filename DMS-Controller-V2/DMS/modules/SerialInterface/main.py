@@ -5,57 +5,241 @@
 import datetime
 import os
 import sys
+import time
 import asyncio
 from azure.iot.device.aio import IoTHubModuleClient
-from azure.iot.device import Message
+from azure.iot.device import Message, MethodResponse
 import serial
 import json
+import logging
+import log
 import config
+from transport import SerialTransport
+from framing import ResponseFromFrames, ResponsesFromBroadcast, CrcTrailer
+from scheduler import BusScheduler, POLICIES as BUS_POLICIES
+from rtt import RttEstimator
+from queues import BoundedQueue
+from metrics import MetricsRegistry, METRICS_PORT
+from profiling import Profiler, PROFILE_PATH
 
-# Verify if all settings are set
-def SettingsFilled():
-    global Settings
+"""
+    This is an example of how the IoT Edge module twin should look like.
+    The settings at the root configure the port named Default. Additional ports are configured in PORTS,
+    each with its own bus task and request queue. Settings missing for a port are taken from the root.
+    {
+        "BAUDRATE": 115200,
+        "SERIALPORT": "/dev/ttyUSB0",
+        "PARITY": "NONE",
+        "STOPBITS": "ONE",
+        "DATABITS": 8,
+        "TIMEOUT": 0.5,
+        "MINTIMEOUT": 0.02,
+        "REPORTINTERVAL": 60,
+        "RETRIES": 2,
+        "BATCHTIME": 0.05,
+        "BATCHSIZE": 65536,
+        "QUEUESIZE": 1000,
+        "QUEUEPOLICY": "block",
+        "BUSQUEUESIZE": 1000,
+        "BUSQUEUEPOLICY": "block",
+        "LOGLEVEL": "INFO",
+        "LOGRATE": 10,
+        "PROFILE": {"ID": "slow-bus-1", "MODE": "sample", "DURATION": 60, "INTERVAL": 0.01, "SLOWCALLBACK": 0.1},
+        "PORTS": {
+            "Blades": {
+                "SERIALPORT": "/dev/ttyUSB1"
+            },
+            "Tower": {
+                "SERIALPORT": "/dev/ttyUSB2",
+                "BAUDRATE": 57600
+            }
+        }
+    }
+    Responses are tagged with the name of the port in 'Port'. Requests from the controller are sent on the port 
+    in their 'Port' field, or on the Default port (or the only port) if they have none.
+    The wait for a module to start answering is learned from its previous response times, bounded by MINTIMEOUT
+    and TIMEOUT. The response time statistics of every address are reported in the RTT reported property
+    every REPORTINTERVAL seconds.
+    Modules which announce "CRC" in their attribute response are sent frames with a CRC16 trailer, and answer
+    with one. A damaged frame is recovered right away, at most RETRIES times. The retry counters of every port
+    are reported in the LINK reported property.
+    If BATCHTIME (s) is set, responses are collected for up to BATCHTIME or BATCHSIZE bytes of JSON and sent 
+    to the controller as one message, containing a list of responses.
+    At most QUEUESIZE responses wait to be sent to the controller. When the queue is full, QUEUEPOLICY decides
+    what happens (see queues.py): with block, the buses wait before the next transaction, so a slow upstream slows
+    down the buses instead of filling the memory. At most BUSQUEUESIZE requests wait for each bus. When a bus queue
+    is full, BUSQUEUEPOLICY decides what happens (see scheduler.py): with block, the next request from the controller
+    waits, so the controller holds back its polls. With drop-newest, the request is dropped and logged. The queue statistics are reported in the QUEUES reported property.
+    The log lines of all tasks are JSON objects (see log.py). LOGLEVEL sets the level of all tasks, or of each task
+    by name with a dict, for example {"Default": "INFO", "Serial adapter": "DEBUG"}. At most LOGRATE lines per
+    second are written for every message, 0 writes all lines. The logging counters are reported in LOGGING.
+    Throughput, queue depths, round-trip and transaction times of every port are kept in metrics (see metrics.py).
+    They are reported in METRICS, and served in the Prometheus text format on
+    http://SerialInterface:METRICS_PORT/metrics.
+    A PROFILE with a new ID starts a profiling session of DURATION seconds (see profiling.py). The state of the
+    session is reported in PROFILE, the results are kept in PROFILE_PATH and fetched with the direct method
+    GetProfile.
+"""
+
+# Verify if all settings of a port are set
+def SettingsFilled(Port: dict):
     # Serial interface settings
-    if(Settings['BAUDRATE'] == None): return False
-    if(Settings['SERIALPORT'] == None): return False
-    if(Settings['PARITY'] == None): return False
-    if(Settings['STOPBITS'] == None): return False
-    if(Settings['DATABITS'] == None): return False
-    if(Settings['TIMEOUT'] == None): return False
+    if(Port['BAUDRATE'] == None): return False
+    if(Port['SERIALPORT'] == None): return False
+    if(Port['PARITY'] == None): return False
+    if(Port['STOPBITS'] == None): return False
+    if(Port['DATABITS'] == None): return False
+    if(Port['TIMEOUT'] == None): return False
     return True
 
-# Update settings from received twin properties
-def UpdateProperties(Twin: dict):
-    global Settings, SettingsUpdated
+# Names of all configured ports
+def PortNames():
+    global Settings, PortSettings
+    Names = list(PortSettings.keys())
+    if(Settings['SERIALPORT'] is not None and DEFAULT_PORT not in PortSettings):
+        Names.insert(0, DEFAULT_PORT)
+    return Names
+
+# Settings of a port, completed with the settings at the root of the twin
+def GetPortSettings(Name: str):
+    global Settings, PortSettings
+    Port = dict(Settings)
+    Port.update(PortSettings.get(Name, dict()))
+    return Port
+
+# Copy the serial settings in Twin to Target. Returns which settings changed: UNCHANGED, REFRESH or REOPEN.
+def ParseSerialSettings(Twin: dict, Target: dict):
+    Updated = UNCHANGED
     if('BAUDRATE' in Twin):
-        Settings['BAUDRATE'] = int(Twin['BAUDRATE'])
-        SettingsUpdated = True
+        Target['BAUDRATE'] = int(Twin['BAUDRATE'])
+        Updated = REOPEN
     if('TIMEOUT' in Twin):
-        Settings['TIMEOUT'] = float(Twin['TIMEOUT'])
-        SettingsUpdated = True
+        Target['TIMEOUT'] = float(Twin['TIMEOUT'])
+        Updated = REOPEN
     if('SERIALPORT' in Twin):
-        Settings['SERIALPORT'] = str(Twin['SERIALPORT'])
-        SettingsUpdated = True
+        Target['SERIALPORT'] = str(Twin['SERIALPORT'])
+        Updated = REOPEN
+    if('BROADCASTSLOT' in Twin):
+        Target['BROADCASTSLOT'] = float(Twin['BROADCASTSLOT'])
+        Updated = max(Updated, REFRESH)
+    if('MINTIMEOUT' in Twin):
+        Target['MINTIMEOUT'] = float(Twin['MINTIMEOUT'])
+        Updated = max(Updated, REFRESH)
+    if('RETRIES' in Twin):
+        Target['RETRIES'] = int(Twin['RETRIES'])
+        Updated = max(Updated, REFRESH)
     if('PARITY' in Twin):
-        if(Twin['PARITY'] == 'ODD'): Settings['PARITY'] = serial.PARITY_ODD
-        elif(Twin['PARITY'] == 'EVEN'): Settings['PARITY'] = serial.PARITY_EVEN
-        elif(Twin['PARITY'] == 'NONE'): Settings['PARITY'] = serial.PARITY_NONE
-        elif(Twin['PARITY'] == 'MARK'): Settings['PARITY'] = serial.PARITY_MARK
-        elif(Twin['PARITY'] == 'SPACE'): Settings['PARITY'] = serial.PARITY_SPACE
-        SettingsUpdated = True
+        if(Twin['PARITY'] == 'ODD'): Target['PARITY'] = serial.PARITY_ODD
+        elif(Twin['PARITY'] == 'EVEN'): Target['PARITY'] = serial.PARITY_EVEN
+        elif(Twin['PARITY'] == 'NONE'): Target['PARITY'] = serial.PARITY_NONE
+        elif(Twin['PARITY'] == 'MARK'): Target['PARITY'] = serial.PARITY_MARK
+        elif(Twin['PARITY'] == 'SPACE'): Target['PARITY'] = serial.PARITY_SPACE
+        Updated = REOPEN
     if('STOPBITS' in Twin):
-        if(Twin['STOPBITS'] == 'ONE'): Settings['STOPBITS'] = serial.STOPBITS_ONE
-        elif(Twin['STOPBITS'] == 'ONE_POINT_FIVE'): Settings['STOPBITS'] = serial.STOPBITS_ONE_POINT_FIVE
-        elif(Twin['STOPBITS'] == 'TWO'): Settings['STOPBITS'] = serial.STOPBITS_TWO
-        SettingsUpdated = True
+        if(Twin['STOPBITS'] == 'ONE'): Target['STOPBITS'] = serial.STOPBITS_ONE
+        elif(Twin['STOPBITS'] == 'ONE_POINT_FIVE'): Target['STOPBITS'] = serial.STOPBITS_ONE_POINT_FIVE
+        elif(Twin['STOPBITS'] == 'TWO'): Target['STOPBITS'] = serial.STOPBITS_TWO
+        Updated = REOPEN
     if('DATABITS' in Twin):
-        if(Twin['DATABITS'] == 7): Settings['DATABITS'] = serial.SEVENBITS
-        elif(Twin['DATABITS'] == 8): Settings['DATABITS'] = serial.EIGHTBITS
-        SettingsUpdated = True
-    return SettingsFilled()
+        if(Twin['DATABITS'] == 7): Target['DATABITS'] = serial.SEVENBITS
+        elif(Twin['DATABITS'] == 8): Target['DATABITS'] = serial.EIGHTBITS
+        Updated = REOPEN
+    return Updated
+
+# Update settings from received twin properties
+def UpdateProperties(Twin: dict):
+    global Settings, PortSettings, UpdatedPorts, InQueue, Buses, Profiling
+    if('REPORTINTERVAL' in Twin):
+        Settings['REPORTINTERVAL'] = float(Twin['REPORTINTERVAL'])
+    if('BATCHTIME' in Twin):
+        Settings['BATCHTIME'] = float(Twin['BATCHTIME'])
+    if('BATCHSIZE' in Twin):
+        Settings['BATCHSIZE'] = int(Twin['BATCHSIZE'])
+    if('LOGLEVEL' in Twin):
+        log.SetLevel(Twin['LOGLEVEL'])
+    if('LOGRATE' in Twin):
+        log.SetRate(Twin['LOGRATE'])
+    if('QUEUESIZE' in Twin):
+        Settings['QUEUESIZE'] = int(Twin['QUEUESIZE'])
+        if(InQueue is not None):
+            InQueue.Configure(Settings['QUEUESIZE'], None)
+    if('QUEUEPOLICY' in Twin):
+        Settings['QUEUEPOLICY'] = str(Twin['QUEUEPOLICY'])
+        if(InQueue is not None):
+            InQueue.Configure(None, Settings['QUEUEPOLICY'])
+    if('BUSQUEUESIZE' in Twin):
+        Settings['BUSQUEUESIZE'] = int(Twin['BUSQUEUESIZE'])
+        for Bus in Buses.values():
+            Bus['Queue'].Configure(Settings['BUSQUEUESIZE'], None)
+    if('BUSQUEUEPOLICY' in Twin):
+        if(str(Twin['BUSQUEUEPOLICY']) not in BUS_POLICIES):
+            raise ValueError('Unknown bus queue policy {}'.format(Twin['BUSQUEUEPOLICY']))
+        Settings['BUSQUEUEPOLICY'] = str(Twin['BUSQUEUEPOLICY'])
+        for Bus in Buses.values():
+            Bus['Queue'].Configure(None, Settings['BUSQUEUEPOLICY'])
+    Updated = ParseSerialSettings(Twin, Settings)
+    if(Updated != UNCHANGED):
+        # Every port inherits the root settings
+        for Name in PortNames():
+            UpdatedPorts[Name] = max(UpdatedPorts.get(Name, UNCHANGED), Updated)
+    if('PROFILE' in Twin):
+        Profiling.Request(Twin['PROFILE'])
+    if('PORTS' in Twin):
+        for Name, Value in Twin['PORTS'].items():
+            if(Value is None):
+                # Port removed from the twin
+                PortSettings.pop(Name, None)
+                continue
+            if(Name not in PortSettings):
+                PortSettings[Name] = dict()
+            Updated = ParseSerialSettings(Value, PortSettings[Name])
+            if(Updated != UNCHANGED):
+                UpdatedPorts[Name] = max(UpdatedPorts.get(Name, UNCHANGED), Updated)
+    return any(SettingsFilled(GetPortSettings(Name)) for Name in PortNames())
+
+# Bus for a request from the controller
+def FindBus(Msg: dict):
+    global Buses
+    if('Port' in Msg): return Buses.get(Msg['Port'])
+    if(DEFAULT_PORT in Buses): return Buses[DEFAULT_PORT]
+    if(len(Buses) == 1): return next(iter(Buses.values()))
+    return None
+
+# Start a bus task for every port with complete settings, and stop the tasks of removed ports
+async def BusManager(InQueue: asyncio.Queue):
+    global Buses
+    Log = logging.getLogger('Bus manager')
+    try:
+        while(True):
+            Names = PortNames()
+            for Name in Names:
+                if(Name not in Buses and SettingsFilled(GetPortSettings(Name))):
+                    Log.info('Starting bus on port %s', Name)
+                    # Requests for the bus, ordered by priority and address
+                    Queue = BusScheduler(Settings['BUSQUEUESIZE'], Settings['BUSQUEUEPOLICY'])
+                    Metrics.Gauge('dms_queue_depth', 'Messages waiting in a queue', {'queue': 'Bus', 'port': Name}, Queue.qsize)
+                    Metrics.Counter('dms_queue_dropped_total', 'Messages dropped by a full queue', {'queue': 'Bus', 'port': Name}, (lambda Queue=Queue: Queue.Dropped))
+                    Metrics.Counter('dms_queue_coalesced_total', 'Messages replaced by a newer message in a queue', {'queue': 'Bus', 'port': Name}, (lambda Queue=Queue: Queue.Coalesced))
+                    Buses[Name] = {
+                        'Queue': Queue,
+                        'Task': asyncio.ensure_future(SerialAdapter(Name, InQueue, Queue))
+                    }
+            for Name in list(Buses.keys()):
+                if(Name not in Names):
+                    Log.info('Stopping bus on port %s', Name)
+                    Buses.pop(Name)['Task'].cancel()
+                    Estimators.pop(Name, None)
+                    LinkStats.pop(Name, None)
+                    Metrics.Remove('port', Name)
+            await asyncio.sleep(3)
+    except asyncio.CancelledError:
+        for Bus in Buses.values():
+            Bus['Task'].cancel()
+        Log.info('Task cancelled')
 
 # Listen for messages from the controller
-async def MessageReceiver(Client: IoTHubModuleClient, InQueue: asyncio.Queue):
+async def MessageReceiver(Client: IoTHubModuleClient):
+    Log = logging.getLogger('Message receiver')
     try:
         while(True):
             try:
@@ -63,34 +247,65 @@ async def MessageReceiver(Client: IoTHubModuleClient, InQueue: asyncio.Queue):
                 Msg = input_message.data
                 try:
                     Msg = json.loads(Msg)
-                    print('Message receiver: Got Data: ', Msg)
+                    Log.debug('Got data', extra={'Message': Msg})
                     if(Msg['MessageType'] == 'ModuleCommand' and Msg['InterfaceType'] == 'SerialInterface'):
-                        print('Message receiver: Queueing')
-                        await InQueue.put(Msg)
+                        Bus = FindBus(Msg)
+                        if(Bus is not None):
+                            Log.debug('Queueing')
+                            await Bus['Queue'].put(Msg)
+                        else:
+                            Log.warning('No bus for port %s', Msg.get('Port'))
                 except json.JSONDecodeError as ex:
-                    print('Message receiver: Error decoding JSON - {}'.format(ex))
+                    Log.error('Error decoding JSON - %s', ex)
             except Exception as ex:
-                print('Message receiver: Error - {}'.format(ex))
+                Log.error('Error - %s', ex)
             
     except asyncio.CancelledError:
-        print('Message receiver: Task cancelled.')
+        Log.info('Task cancelled')
 
 # Send message to the controller
 async def MessageSender(Client: IoTHubModuleClient, OutQueue: asyncio.Queue):
+    global Settings
+    Log = logging.getLogger('Message sender')
+    Latency = Metrics.Histogram('dms_send_seconds', 'Time to send a message to another module', {'output': 'InterfaceOut'})
+    Responses = Metrics.Counter('dms_responses_sent_total', 'Module responses sent to the controller')
     try:
         while(True):
             data = await OutQueue.get()
-            print('Message sender: ', data)
-            msg = json.dumps(data)
+            Log.debug('Message to send', extra={'Message': data})
+            # Every response is serialized once, a batch is the serialized responses joined into a JSON list
+            Batch = [json.dumps(data)]
+            Size = len(Batch[0])
+            if(Settings['BATCHTIME'] > 0):
+                Deadline = time.monotonic() + Settings['BATCHTIME']
+                Waited = False
+                while(Size < Settings['BATCHSIZE']):
+                    if(OutQueue.empty()):
+                        # Wait once for the rest of the batch
+                        if(Waited): break
+                        await asyncio.sleep(max(0.0, Deadline - time.monotonic()))
+                        Waited = True
+                        continue
+                    Item = json.dumps(OutQueue.get_nowait())
+                    Batch.append(Item)
+                    Size += len(Item) + 1
+            if(len(Batch) == 1):
+                msg = Batch[0]
+            else:
+                msg = '[' + ','.join(Batch) + ']'
             msg = Message(msg)
             try:
+                Start = time.perf_counter()
                 await Client.send_message_to_output(msg, 'InterfaceOut')
-                OutQueue.task_done()
+                Latency.Record(time.perf_counter() - Start)
+                Responses.Add(len(Batch))
+                for _ in Batch:
+                    OutQueue.task_done()
             except Exception as ex:
-                print ('Unexpected error in sender: {}'.format(ex))
-            print('Finished sending')
+                Log.error('Unexpected error in sender - %s', ex)
+            Log.debug('Finished sending %s responses', len(Batch))
     except asyncio.CancelledError:
-        print('Message sender: Task cancelled')
+        Log.info('Task cancelled')
             
 # Process message form controller
 def ProcessMessage(Msg: dict, OutQueue: asyncio.Queue):
@@ -100,12 +315,13 @@ def ProcessMessage(Msg: dict, OutQueue: asyncio.Queue):
 
 # Convert bytearray message to dictionary
 def SerialBytesToDict(Response: bytes,  Request: dict):
+    Log = logging.getLogger('Serial')
     # Decode a serial interface message to a python dictionary
     try: 
-        print(Response)
+        Log.debug('Response', extra={'Response': Response})
         length = len(Response)
         if(length < 4 or Response[-1] != config.MSG_END or int(Response[0]) != config.RESP_START):
-            print('Invalid Message: ')
+            Log.warning('Invalid message')
             Msg = {
                 'MessageType': 'ModuleResponse',
                 'InterfaceType': 'SerialInterface',
@@ -117,11 +333,10 @@ def SerialBytesToDict(Response: bytes,  Request: dict):
             try:
                 PH = json.loads(Response[3:-1].decode('ascii'))
             except json.JSONDecodeError as ex:
-                print('Decoding failed: {}'.format(ex))
+                Log.warning('Decoding failed - %s', ex)
                 return False, dict()
 
-            print('Message contents:')
-            print(PH)
+            Log.debug('Message contents', extra={'Message': PH})
         Message = {
             'MessageType': 'ModuleResponse',
             'InterfaceType': 'SerialInterface',
@@ -132,152 +347,155 @@ def SerialBytesToDict(Response: bytes,  Request: dict):
         }
         return True, Message
     except Exception as ex:
-        print('Serial: Error converting bytes to dict - {}'.format(ex))
+        Log.error('Error converting bytes to dict - %s', ex)
         False, dict()
 
-# Convert dictionary message to bytearray
-def DictToSerialBytes(Msg: dict):
+# Convert dictionary message to bytearray. With Crc, the frame gets a CRC16 trailer.
+def DictToSerialBytes(Msg: dict, Crc: bool = False):
+    Log = logging.getLogger('Serial')
     try:
         # text = bytearray()
         # text += bytes([config.MSG_START,  int(Msg['Address']), int(Msg['FunctionCode'])])
+        text = bytes([
+            int(Msg['Address']), 
+            int(Msg['FunctionCode'])
+        ])
         if('Message' in Msg): 
-            text = bytes([
-                config.MSG_START, 
-                int(Msg['Address']), 
-                int(Msg['FunctionCode']),
-                json.dumps(Msg['Message']).encode('ascii'),
-                0
-            ])
-            return True, text
-        else:
-            text = bytes([
-                config.MSG_START, 
-                int(Msg['Address']), 
-                int(Msg['FunctionCode']),
-                0
-            ])
-            return True, text
-        # text += bytes([0])
+            text += json.dumps(Msg['Message']).encode('ascii')
+        if(Crc):
+            return True, bytes([config.MSG_START_CRC]) + text + CrcTrailer(text) + bytes([config.MSG_END])
+        return True, bytes([config.MSG_START]) + text + bytes([config.MSG_END])
         
     except Exception as ex:
-        print ('Serial: Error converting dict to bytes - {}'.format(ex))
+        Log.error('Error converting dict to bytes - %s', ex)
         return False, bytearray()
 
-# Replacement for SerialBytesToDict
-def ConstructResponse(Request: dict, Input: bytes):
-    # This function constructs a response message for the controller, based on the received bytes from the serial connection.
-    # It uses the responsecodes defined in config. Ensure that those response codes are equal to the codes in the controller config and the InterfaceConfig.h file
-    Message = {
-        'MessageType': 'ModuleResponse',
-        'InterfaceType': 'SerialInterface',
-        'Address': int(Request[1]),
-        'Timestamp': datetime.datetime.now().timestamp(),
-        'FunctionCode': int(Request[2])
-    }
-    # No response at all
-    if(len(Input) == 0): 
-        Message.update({'ResponseCode': config.RESP_TIMEOUT})
-    
-    # At least 4 bytes are expected in a response
-    elif(len(Input) < 4):
-        Message.update({'ResponseCode': config.RESP_INVALID_HEADER})
-    
-    # Last byte should be MSG_END and first byte should be RESP_START
-    elif(Input[-1] != config.MSG_END or int(Input[0]) != config.RESP_START):
-        Message.update({'ResponseCode': config.RESP_INVALID_HEADER})
-    
-    # Normal response without JSON payload
-    elif(len(Input) == 4):
-        Message.update({'ResponseCode': int(Input[2])})
-    
-    # Normal response with JSON payload
-    else:
-        try:
-            String = Input[3:-1].decode('ascii')
-            PH = json.loads(String)
-            Message.update({'ResponseCode': int(Input[2]), 'Message': PH})
-        except UnicodeDecodeError as ex:
-            # Byte array cna't be converted to string
-            print('Decoding failed: {}'.format(ex))
-            Message.update({'ResponseCode': config.RESP_BYTE_DECODE_ERROR})
-        except json.JSONDecodeError as ex:
-            # Wrong JSON syntax
-            print('Decoding failed: {}'.format(ex))
-            Message.update({'ResponseCode': config.RESP_JSON_DECODE_ERROR})
-    return Message
-            
+# Request for the last response frame of a module
+def RetransmitRequest(Address: int):
+    return DictToSerialBytes({'Address': Address, 'FunctionCode': config.REQ_RETRANSMIT}, True)[1]
+
+# Remember which modules check and send CRC trailers, from their attribute responses
+def UpdateCrcSupport(CrcAddresses: set, Message: dict):
+    if(Message['ResponseCode'] == config.RESP_ATT_SUCCESS and isinstance(Message.get('Message'), dict)):
+        if(Message['Message'].get('CRC')):
+            CrcAddresses.add(Message['Address'])
+        else:
+            CrcAddresses.discard(Message['Address'])
+
+# Send a request to one module and construct the response message.
+# Damaged frames are recovered before the bus is given to the next request: a response which failed its CRC check
+# is requested again, a request which failed the check at the module is sent again, at most RETRIES times.
+# The response times are recorded in Rtt, if given.
+async def Transaction(Transport: SerialTransport, Estimator: RttEstimator, Port: dict, Stats: dict, Data: bytes, Rtt = None):
+    Address = Data[1]
+    Attempt = Data
+    Retries = 0
+    Message = None
+    while(True):
+        Frames, Received, Latency = await Transport.Transact(Attempt, Estimator.Timeout(Address, Port['TIMEOUT']))
+        if(Latency is not None):
+            Estimator.Sample(Address, Latency)
+            if(Rtt is not None):
+                Rtt.Record(Latency)
+        else:
+            Estimator.Lost(Address)
+        Response = ResponseFromFrames(Data, Frames, Received)
+        # A retry without answer doesn't replace the error it was meant to recover
+        if(Message is None or Response['ResponseCode'] != config.RESP_TIMEOUT):
+            Message = Response
+        if(Response['ResponseCode'] == config.RESP_CRC_ERROR): Stats['CrcErrors'] += 1
+        if(Response['ResponseCode'] == config.RESP_REQUEST_CRC_ERROR): Stats['RequestCrcErrors'] += 1
+        if(Message['ResponseCode'] not in (config.RESP_CRC_ERROR, config.RESP_REQUEST_CRC_ERROR)):
+            if(Retries > 0): Stats['Recovered'] += 1
+            return Message
+        if(Retries >= Port['RETRIES']):
+            Stats['Failed'] += 1
+            return Message
+        Retries += 1
+        Stats['Retries'] += 1
+        # The module answered, but the answer was damaged. Sending the request again would not return the same
+        # telemetry, since the module clears its buffers when it answers.
+        if(Message['ResponseCode'] == config.RESP_CRC_ERROR):
+            Attempt = RetransmitRequest(Address)
+        # Otherwise the module did not process the request, the same frame is sent again
+
 # Serial manager
-async def SerialAdapter(InQueue: asyncio.Queue, OutQueue: asyncio.Queue):
-    global Settings, SettingsComplete, SettingsUpdated
-    # RequestInProcess = False
-    # StartingTime = datetime.time()
-    # print('Serial: Starting')
-    while(not SettingsComplete):
+async def SerialAdapter(PortName: str, InQueue: asyncio.Queue, OutQueue: BusScheduler):
+    global UpdatedPorts
+    Log = logging.getLogger('Serial adapter')
+    while(not SettingsFilled(GetPortSettings(PortName))):
         await asyncio.sleep(3)
-    print('Serial adapter: Starting serial port.')
+    Log.info('Starting serial port %s', PortName)
     
+    Transport = None
     try:
+        Port = GetPortSettings(PortName)
         ser = serial.Serial(
-            port = Settings['SERIALPORT'], 
-            baudrate = Settings['BAUDRATE'], 
-            bytesize = Settings['DATABITS'], 
-            parity = Settings['PARITY'], 
-            stopbits = Settings['STOPBITS'],
-            timeout = Settings['TIMEOUT']
+            port = Port['SERIALPORT'], 
+            baudrate = Port['BAUDRATE'], 
+            bytesize = Port['DATABITS'], 
+            parity = Port['PARITY'], 
+            stopbits = Port['STOPBITS'],
+            timeout = Port['TIMEOUT']
             )
-        SettingsUpdated = False
-        print('Serial adapter: Serial port started.')
+        # All blocking serial calls are done by the transport on a worker thread
+        Transport = SerialTransport(ser)
+        # Response times of the modules on this port
+        Estimator = RttEstimator(Port['MINTIMEOUT'])
+        Estimators[PortName] = Estimator
+        # Modules which check and send CRC trailers, and the counters of damaged frames
+        CrcAddresses = set()
+        Stats = {'CrcErrors': 0, 'RequestCrcErrors': 0, 'Retries': 0, 'Recovered': 0, 'Failed': 0}
+        LinkStats[PortName] = Stats
+        Rtt = Metrics.Histogram('dms_serial_rtt_seconds', 'Time until a module starts answering', {'port': PortName})
+        Duration = Metrics.Histogram('dms_serial_transaction_seconds', 'Time of a transaction on the bus, including retries', {'port': PortName})
+        Transactions = Metrics.Counter('dms_serial_transactions_total', 'Requests sent on the bus', {'port': PortName})
+        UpdatedPorts.pop(PortName, None)
+        Log.info('Serial port %s started', PortName)
         while(True):
-            if(SettingsUpdated):
-                ser.close()
-                ser.baudrate = Settings['BAUDRATE']
-                ser.bytesize = Settings['DATABITS']
-                ser.parity = Settings['PARITY']
-                ser.stopbits = Settings['STOPBITS']
-                ser.timeout = Settings['TIMEOUT']
-                ser.port = Settings['SERIALPORT']
-                ser.open()
-                SettingsUpdated = False
-            # A queued message can be sent
+            if(PortName in UpdatedPorts):
+                Updated = UpdatedPorts.pop(PortName)
+                Port = GetPortSettings(PortName)
+                Estimator.MinTimeout = Port['MINTIMEOUT']
+                if(Updated == REOPEN):
+                    await Transport.Reconfigure(Port)
+            # A queued message can be sent. The scheduler decides which request gets the bus next.
             Request = await OutQueue.get() # this function blocks until a message is available from the queue
             if( Request['Address'] in range(0, 256) and Request['FunctionCode'] in range(0, 256) ):
-                print('Serial adapter: Message from controller:', Request)
-                Success, data = DictToSerialBytes(Request)
-                # OutQueue.task_done()
+                Log.debug('Message from controller', extra={'Message': Request})
+                Success, data = DictToSerialBytes(Request, Request['Address'] in CrcAddresses)
                 if(Success):
-                    print('Serial adapter: Sending message -', data)
-                    try:
-                        # Discard any previous responses that failed the timeout deadline but still arrived
-                        ser.flushInput()
-                        BytesSent = ser.write(data)
-                    except Exception as ex:
-                        print ('Serial adapter: Error sending message - {}'.format(ex))
-                    # StartingTime = datetime.time()
+                    Log.debug('Sending message', extra={'Frame': data})
+                    Transactions.Add()
+                    Start = time.perf_counter()
                     try:
-                        text = bytearray()
-                        # Blocks until timeout or byte received
-                        text += ser.read()
-                        if(len(text) > 0):
-                            # We wantz more bytez, until the zero byte haz arrived
-                            while(text[-1] != 0):
-                                byte = ser.read()
-                                # Timeout
-                                if(len(byte) == 0): break
-                                else: text += byte
-                        Message = ConstructResponse(Request, text)
-                        await InQueue.put(Message)
-                    
+                        if(Request['Address'] == config.ADDRESS_BROADCAST):
+                            # Every module answers in its own time slot. Listen until the slot of the highest address has passed.
+                            Addresses = Request.get('Addresses', [])
+                            Window = Port['BROADCASTSLOT'] * (max(Addresses, default=config.ADDRESS_BROADCAST - 1) + 1) + Port['TIMEOUT']
+                            Frames, Received, Latency = await Transport.Broadcast(data, Addresses, Window)
+                            for Message in ResponsesFromBroadcast(data, Frames, Addresses):
+                                UpdateCrcSupport(CrcAddresses, Message)
+                                Message['Port'] = PortName
+                                await InQueue.put(Message)
+                        else:
+                            Message = await Transaction(Transport, Estimator, Port, Stats, data, Rtt)
+                            Duration.Record(time.perf_counter() - Start)
+                            UpdateCrcSupport(CrcAddresses, Message)
+                            Message['Port'] = PortName
+                            await InQueue.put(Message)
                     except Exception as ex:
-                        print ('Serial adapter: Error receiving response - {}'.format(ex))
+                        Log.error('Error during transaction - %s', ex)
                 else:
                     await InQueue.put(
                         {
                             'MessageType': 'ModuleResponse',
                             'InterfaceType': 'SerialInterface',
-                            'Address': int(Request[1]),
+                            'Address': int(Request['Address']),
                             'Timestamp': datetime.datetime.now().timestamp(),
-                            'FunctionCode': int(Request[2]), 
-                            'ResponseCode': config.RESP_JSON_ENCODE_ERROR
+                            'FunctionCode': int(Request['FunctionCode']), 
+                            'ResponseCode': config.RESP_JSON_ENCODE_ERROR,
+                            'Port': PortName
                         }
                     )
             else:
@@ -285,52 +503,113 @@ async def SerialAdapter(InQueue: asyncio.Queue, OutQueue: asyncio.Queue):
                 {
                     'MessageType': 'ModuleResponse',
                     'InterfaceType': 'SerialInterface',
-                    'Address': int(Request[1]),
+                    'Address': int(Request['Address']),
                     'Timestamp': datetime.datetime.now().timestamp(),
-                    'FunctionCode': int(Request[2]), 
-                    'ResponseCode': config.RESP_INVALID_REQUEST
+                    'FunctionCode': int(Request['FunctionCode']), 
+                    'ResponseCode': config.RESP_INVALID_REQUEST,
+                    'Port': PortName
                 }
             )
     # except Exception as ex:
-    #     print ('Serial adapter: Error - {}'.format(ex))
+    #     Log.error('Error - %s', ex)
     except (KeyboardInterrupt, asyncio.CancelledError):
-        print('Serial adapter: exit.')
-        ser.close()# Send to and receive commands from modules connected to the serial interface
+        Log.info('Exit %s', PortName)
+        if(Transport is not None):
+            Transport.Close()
+
+# Report the response time statistics, retry counters and queue statistics of every port in the reported properties
+async def ReportProperties(client: IoTHubModuleClient):
+    global Settings, Estimators, LinkStats, InQueue, Buses, Metrics, Profiling
+    Log = logging.getLogger('Report properties')
+    # Ports in the last report, a port which is gone is removed from the reported properties by reporting None
+    Reported = set()
+    try:
+        while(True):
+            await asyncio.sleep(Settings['REPORTINTERVAL'])
+            Gone = {Name: None for Name in Reported if Name not in Estimators}
+            Report = {'RTT': dict(Gone), 'LINK': dict(Gone), 'QUEUES': dict(Gone)}
+            Report['QUEUES']['InQueue'] = InQueue.Report()
+            Report['LOGGING'] = log.Report()
+            Report['METRICS'] = Metrics.Report()
+            Report['PROFILE'] = Profiling.Report()
+            for Name, Estimator in Estimators.items():
+                Report['RTT'][Name] = Estimator.Report(GetPortSettings(Name)['TIMEOUT'])
+                Report['LINK'][Name] = dict(LinkStats.get(Name, dict()))
+            for Name, Bus in Buses.items():
+                Report['QUEUES'][Name] = Bus['Queue'].Report()
+            try:
+                await client.patch_twin_reported_properties(Report)
+                Reported = set(Estimators.keys())
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 # ReceiveTwinProperties is invoked when the module twin's desired properties are updated.
 async def ReceiveTwinProperties(client: IoTHubModuleClient):
     global SettingsComplete, Settings
-    print('Receive twin properties: Starting')
+    Log = logging.getLogger('Receive twin properties')
+    Log.info('Starting')
     try:
         # Get desired properties
         properties = await client.get_twin()
         SettingsComplete = UpdateProperties(properties['desired'])
-        print('Receive twin properties: Got twin:', properties['desired'])
-        print('Receive twin properties: Current settings:', Settings)
+        Log.info('Got twin', extra={'Twin': properties['desired']})
+        Log.info('Current settings', extra={'Settings': Settings, 'Ports': PortSettings})
         # Listen for updates
         while(True):
             try:
                 data = await client.receive_twin_desired_properties_patch()  # blocking call
                 SettingsComplete = UpdateProperties(data)
-                print('Receive twin properties: Got update patch', Settings)
+                Log.info('Got update patch', extra={'Settings': Settings, 'Ports': PortSettings})
             except Exception as ex:
-                print('Receive twin properties: Error - {}'.format(ex))
+                Log.error('Error - %s', ex)
     except asyncio.CancelledError:
-        print('Receive twin properties: Task cancelled')
+        Log.info('Task cancelled')
     except Exception as ex:
-        print('Receive twin properties: Error - {}'.format(ex))
+        Log.error('Error - %s', ex)
+
+# DIRECT METHODS
+# Profiling sessions and their files, see Profiler.Get
+def GetProfile(Payload: dict):
+    global Profiling
+    return Profiling.Get(Payload)
+
+# Direct methods by name
+Methods = {
+    'GetProfile': GetProfile
+}
+
+# Answer direct method requests
+async def MethodRequestListener(client: IoTHubModuleClient):
+    Log = logging.getLogger('Method request listener')
+    try:
+        while(True):
+            try:
+                Request = await client.receive_method_request()  # blocking call
+                Log.info('Received %s', Request.name)
+                if(Request.name in Methods):
+                    Status, Payload = Methods[Request.name](Request.payload)
+                else:
+                    Status, Payload = 404, {'Error': 'Unknown method'}
+                await client.send_method_response(MethodResponse.create_from_method_request(Request, Status, Payload))
+            except Exception as ex:
+                Log.error('Error - %s', ex)
+    except asyncio.CancelledError:
+        Log.info('Task cancelled')
 
 # async setup function, because create_from_edge_environment needs a background event loop
 async def Startup():
-    print('Starting now')
+    Log = logging.getLogger('Startup')
+    Log.info('Starting now')
     try:
         client = IoTHubModuleClient.create_from_edge_environment()
-        print('Created client')
+        Log.info('Created client')
         await client.connect()
-        print('Connected')
+        Log.info('Connected')
         return client
     except Exception as ex:
-        print('Startup: Error - {}'.format(ex))
+        Log.error('Error - %s', ex)
 
 # GLOBALS
 Settings = {
@@ -339,16 +618,64 @@ Settings = {
     'PARITY': None,
     'STOPBITS': None,
     'DATABITS': None,
-    'TIMEOUT': None
+    'TIMEOUT': None,
+    # Length of a broadcast response time slot (s). Equal to BROADCAST_SLOT_TIME in InterfaceConfig.h
+    'BROADCASTSLOT': 0.04,
+    # Shortest wait for a module to start answering (s). TIMEOUT is the longest.
+    'MINTIMEOUT': 0.02,
+    # Interval of the reported properties (s)
+    'REPORTINTERVAL': 60,
+    # Number of times a damaged frame is sent or requested again
+    'RETRIES': 2,
+    # Longest time (s) and largest size (bytes of JSON) of a batch of responses to the controller.
+    # Without BATCHTIME, every response is sent on its own.
+    'BATCHTIME': 0,
+    'BATCHSIZE': 65536,
+    # Largest number of responses waiting to be sent to the controller, and what happens when there are more
+    'QUEUESIZE': 1000,
+    'QUEUEPOLICY': 'block',
+    # Largest number of requests waiting for a bus, and what happens when there are more
+    'BUSQUEUESIZE': 1000,
+    'BUSQUEUEPOLICY': 'block'
 }
 
+# Name of the port configured by the settings at the root of the twin
+DEFAULT_PORT = 'Default'
+# Settings of the ports in PORTS. Only the settings given for a port are stored, the rest is taken from Settings
+PortSettings = dict()
+# Which settings of a port changed, see ParseSerialSettings
+UNCHANGED = 0
+# Only settings which are read for every transaction (BROADCASTSLOT, MINTIMEOUT, RETRIES), the port stays open
+REFRESH = 1
+# Settings of the serial port itself, the port is reopened
+REOPEN = 2
+# Ports of which the settings changed since the port was (re)opened, with REFRESH or REOPEN
+UpdatedPorts = dict()
+# Running buses by port name, each with its request queue and adapter task
+Buses = dict()
+# Response time estimators by port name
+Estimators = dict()
+# Counters of damaged frames and retries by port name
+LinkStats = dict()
+
+# Responses waiting to be sent to the controller, created in Main
+InQueue = None
+# Counters, gauges and latency histograms of the module
+Metrics = MetricsRegistry()
+# On-demand profiling sessions, written to a volume of the host
+Profiling = Profiler(os.environ.get('PROFILE_PATH', PROFILE_PATH))
+
 SettingsComplete = False
-SettingsUpdated = False
 
 # Everthing starts at the main
 def Main():
-    OutQueue = asyncio.Queue()
-    InQueue = asyncio.Queue()
+    global InQueue
+    Log = logging.getLogger('SerialInterface')
+    log.Setup('SerialInterface')
+    InQueue = BoundedQueue(Settings['QUEUESIZE'], Settings['QUEUEPOLICY'],
+        Wait=Metrics.Histogram('dms_queue_wait_seconds', 'Time messages wait in a queue', {'queue': 'InQueue'}))
+    Metrics.Gauge('dms_queue_depth', 'Messages waiting in a queue', {'queue': 'InQueue'}, InQueue.qsize)
+    Metrics.Counter('dms_queue_dropped_total', 'Messages dropped by a full queue', {'queue': 'InQueue'}, lambda: InQueue.Stats['Dropped'])
     Tasks = []
 
     # All settings required for the operation of this adapter are in place
@@ -363,23 +690,32 @@ def Main():
             ReceiveTwinProperties(client)
             ))
         Tasks.append(loop.create_task(
-            MessageReceiver(client, OutQueue)
+            MessageReceiver(client)
             ))
         Tasks.append(loop.create_task(
             MessageSender(client, InQueue)
             ))
         Tasks.append(loop.create_task(
-            SerialAdapter(InQueue, OutQueue)
+            BusManager(InQueue)
+            ))
+        Tasks.append(loop.create_task(
+            ReportProperties(client)
+            ))
+        Tasks.append(loop.create_task(
+            MethodRequestListener(client)
+            ))
+        Tasks.append(loop.create_task(
+            Metrics.Serve(int(os.environ.get('METRICS_PORT', METRICS_PORT)))
             ))
         
         while(True):
             loop.run_until_complete(asyncio.sleep(30))
     except Exception as ex:
-        print('Main: {}'.format(ex))
+        Log.error('Error - %s', ex)
     except KeyboardInterrupt:
         pass
     finally:
-        print('Quittin\'')
+        Log.info('Quittin')
         for task in Tasks:
             task.cancel()
         loop.run_until_complete(client.disconnect())
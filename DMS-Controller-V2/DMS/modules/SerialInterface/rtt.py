@@ -0,0 +1,69 @@
+# Per-address response time statistics, used to decide how long to wait for a module to start answering.
+# The estimate follows the TCP retransmission timer (RFC 6298): a smoothed response time plus four times its
+# mean deviation. A fast module which dropped a request is given up on after a few milliseconds, instead of
+# after the TIMEOUT of the twin, which only serves as an upper bound. Every timeout doubles the wait for that
+# address, so a module which became slower is not cut off forever.
+
+# Gains of the smoothed response time and its deviation
+ALPHA = 1.0 / 8.0
+BETA = 1.0 / 4.0
+# Number of deviations added to the smoothed response time
+K = 4
+# Largest backoff factor after consecutive timeouts
+MAX_BACKOFF = 64
+
+class RttEstimator:
+    def __init__(self, MinTimeout: float = 0.02):
+        # Lower bound of the timeout (s), covers the scheduling jitter of the module and the host
+        self.MinTimeout = MinTimeout
+        self.Stats = dict()
+
+    def Entry(self, Address: int):
+        if(Address not in self.Stats):
+            self.Stats[Address] = {
+                'SRTT': None,
+                'RTTVAR': None,
+                'Backoff': 1,
+                'Samples': 0,
+                'Timeouts': 0
+            }
+        return self.Stats[Address]
+
+    # Time to wait for the first byte of a response (s)
+    def Timeout(self, Address: int, MaxTimeout: float):
+        Entry = self.Stats.get(Address)
+        if(Entry is None or Entry['SRTT'] is None):
+            return MaxTimeout
+        Timeout = max(Entry['SRTT'] + K * Entry['RTTVAR'], self.MinTimeout) * Entry['Backoff']
+        return min(Timeout, MaxTimeout)
+
+    # Record the time between sending a request and receiving the first byte of the response (s)
+    def Sample(self, Address: int, Rtt: float):
+        Entry = self.Entry(Address)
+        if(Entry['SRTT'] is None):
+            Entry['SRTT'] = Rtt
+            Entry['RTTVAR'] = Rtt / 2
+        else:
+            Entry['RTTVAR'] = (1 - BETA) * Entry['RTTVAR'] + BETA * abs(Entry['SRTT'] - Rtt)
+            Entry['SRTT'] = (1 - ALPHA) * Entry['SRTT'] + ALPHA * Rtt
+        Entry['Backoff'] = 1
+        Entry['Samples'] += 1
+
+    # Record that a module did not answer
+    def Lost(self, Address: int):
+        Entry = self.Entry(Address)
+        Entry['Timeouts'] += 1
+        Entry['Backoff'] = min(Entry['Backoff'] * 2, MAX_BACKOFF)
+
+    # Statistics for the reported properties, in ms. Twin property names must be strings.
+    def Report(self, MaxTimeout: float):
+        Report = dict()
+        for Address, Entry in self.Stats.items():
+            Report[str(Address)] = {
+                'SRTT': round(Entry['SRTT'] * 1000, 2) if Entry['SRTT'] is not None else None,
+                'RTTVAR': round(Entry['RTTVAR'] * 1000, 2) if Entry['RTTVAR'] is not None else None,
+                'Timeout': round(self.Timeout(Address, MaxTimeout) * 1000, 2),
+                'Samples': Entry['Samples'],
+                'Timeouts': Entry['Timeouts']
+            }
+        return Report
@@ -0,0 +1,139 @@
+# Bus scheduler, replacing the plain FIFO between the message receiver and the serial adapter.
+# Requests are kept in a queue per address, grouped in priority classes: commands are sent before attribute requests,
+# and attribute requests before telemetry requests. Within a class the addresses are served round-robin, so one
+# module with many pending requests can not starve the others. A request which is identical to a request that is
+# still pending is dropped, since the module would only send the same answer twice.
+# The scheduler has the same get/put interface as asyncio.Queue, so the adapter and receiver don't need to know the difference.
+# At most MaxSize requests are pending. What happens to a request for a full scheduler depends on the policy (see
+# queues.py): with block, put waits until a request was sent, which holds back the message receiver and with it the
+# controller. With drop-newest the request is dropped and logged: the controller sends a telemetry request again
+# when the poll times out.
+
+import asyncio
+import collections
+import json
+import logging
+import config
+from queues import BLOCK, DROP_NEWEST
+
+# Policies of a full scheduler
+POLICIES = (BLOCK, DROP_NEWEST)
+
+Log = logging.getLogger('Bus scheduler')
+
+# Priority classes, lower is served first
+PRIORITY_COMMAND = 0
+PRIORITY_ATTRIBUTE = 1
+PRIORITY_TELEMETRY = 2
+
+def Priority(Msg: dict):
+    if(Msg['FunctionCode'] in (config.REQ_TEL, config.REQ_TEL_BINARY)): return PRIORITY_TELEMETRY
+    if(Msg['FunctionCode'] == config.REQ_ATT): return PRIORITY_ATTRIBUTE
+    return PRIORITY_COMMAND
+
+# Requests with the same key are identical for the module
+def RequestKey(Msg: dict):
+    Payload = json.dumps(Msg['Message'], sort_keys=True) if 'Message' in Msg else None
+    return (Msg['Address'], Msg['FunctionCode'], Payload)
+
+class BusScheduler:
+    def __init__(self, MaxSize: int = 1000, Policy: str = BLOCK):
+        # One ordered dict per priority class, mapping address to the queue of pending requests for that address.
+        # The order of the dict is the round-robin order.
+        self.Classes = [collections.OrderedDict() for _ in (PRIORITY_COMMAND, PRIORITY_ATTRIBUTE, PRIORITY_TELEMETRY)]
+        self.PendingKeys = set()
+        self.Available = asyncio.Event()
+        self.Room = asyncio.Event()
+        self.Room.set()
+        self.MaxSize = MaxSize
+        self.Policy = Policy
+        # Number of requests dropped because an identical request was pending
+        self.Coalesced = 0
+        # Number of requests dropped because the scheduler was full
+        self.Dropped = 0
+        # Largest number of pending requests since the last report
+        self.HighWater = 0
+
+    # Change the size or the policy. Requests above a smaller size stay pending.
+    def Configure(self, MaxSize: int = None, Policy: str = None):
+        if(Policy is not None):
+            if(Policy not in POLICIES):
+                raise ValueError('Unknown bus queue policy {}'.format(Policy))
+            self.Policy = Policy
+        if(MaxSize is not None):
+            self.MaxSize = max(1, int(MaxSize))
+        # Producers waiting for room check the new size and policy
+        self.Room.set()
+
+    def qsize(self):
+        return len(self.PendingKeys)
+
+    def empty(self):
+        return len(self.PendingKeys) == 0
+
+    def full(self):
+        return len(self.PendingKeys) >= self.MaxSize
+
+    # Returns False if the request was dropped
+    def put_nowait(self, Msg: dict):
+        Key = RequestKey(Msg)
+        if(Key in self.PendingKeys):
+            self.Coalesced += 1
+            return True
+        if(self.full()):
+            if(self.Policy == BLOCK):
+                raise asyncio.QueueFull()
+            self.Dropped += 1
+            Log.warning('Bus queue full, request dropped', extra={'Address': Msg['Address'], 'FunctionCode': Msg['FunctionCode']})
+            return False
+        self.PendingKeys.add(Key)
+        self.HighWater = max(self.HighWater, len(self.PendingKeys))
+        Queues = self.Classes[Priority(Msg)]
+        if(Msg['Address'] not in Queues):
+            Queues[Msg['Address']] = collections.deque()
+        Queues[Msg['Address']].append((Key, Msg))
+        self.Available.set()
+        return True
+
+    async def put(self, Msg: dict):
+        while(self.Policy == BLOCK and self.full() and RequestKey(Msg) not in self.PendingKeys):
+            self.Room.clear()
+            await self.Room.wait()
+        return self.put_nowait(Msg)
+
+    def get_nowait(self):
+        for Queues in self.Classes:
+            if(len(Queues) > 0):
+                Address, Queue = next(iter(Queues.items()))
+                Key, Msg = Queue.popleft()
+                if(len(Queue) == 0):
+                    del Queues[Address]
+                else:
+                    # Next address gets its turn
+                    Queues.move_to_end(Address)
+                self.PendingKeys.discard(Key)
+                self.Room.set()
+                return Msg
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while(self.empty()):
+            self.Available.clear()
+            await self.Available.wait()
+        return self.get_nowait()
+
+    def task_done(self):
+        pass
+
+    # Statistics for the reported properties, the high-water mark is reset
+    def Report(self):
+        Report = {
+            'Size': len(self.PendingKeys),
+            'MaxSize': self.MaxSize,
+            'Policy': self.Policy,
+            'Coalesced': self.Coalesced,
+            'Dropped': self.Dropped,
+            'HighWater': self.HighWater
+        }
+        self.HighWater = len(self.PendingKeys)
+        return Report
@@ -0,0 +1,213 @@
+# Simulator of a bus with sensor modules running the Interface firmware, for benchmarks without hardware.
+# The simulator opens a pseudo-terminal pair. The SerialInterface opens the slave side (PortName) as if it were
+# a USB-RS485 adapter, the simulator answers on the master side with MSG_START/RESP_START/MSG_END framing.
+# Requests with a CRC trailer are answered with one, damaged frames on the line can be simulated as well.
+# Linux only.
+#
+# Run standalone with: python3 simulator.py [modules]
+# and point the SERIALPORT twin setting of a local SerialInterface to the printed port.
+
+import json
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+import config
+from framing import CobsEncode, CrcTrailer, TELEMETRY_HEADER
+
+class SimulatedModule:
+    def __init__(self, Address: int, Sensors: int = 2, Samples: int = 10, Interval: int = 100):
+        self.Address = Address
+        self.Names = ['Module{}-Sensor{}'.format(Address, i) for i in range(Sensors)]
+        # Number of values returned per sensor in each telemetry response
+        self.Samples = Samples
+        self.Interval = Interval
+        self.Start = time.monotonic()
+        self.Values = 0
+        # Address, response code, payload and CRC trailer of the last response, for REQ_RETRANSMIT
+        self.LastFrame = None
+
+    def Millis(self):
+        return int((time.monotonic() - self.Start) * 1000)
+
+    def Attributes(self):
+        return {
+            'HWV': 'sim',
+            'SWV': 'sim',
+            'Time': self.Millis(),
+            'BIN': 1,
+            'CRC': 1,
+            'MEM': 2,
+            'Sensors': [{'Name': Name, 'Unit': '-', 'SR': self.Interval} for Name in self.Names]
+        }
+
+    def Telemetry(self):
+        Offset = self.Millis() - self.Samples * self.Interval
+        self.Values += self.Samples * len(self.Names)
+        return [
+            [Index, self.Interval, Offset, [random.uniform(-100, 100) for _ in range(self.Samples)]]
+            for Index in range(len(self.Names))
+        ]
+
+    # Response code and payload bytes for a request, like Interface::ProcessMessage
+    def Respond(self, Code: int, Payload: bytes):
+        if(Code == config.REQ_ATT):
+            return config.RESP_ATT_SUCCESS, json.dumps(self.Attributes()).encode('ascii')
+        if(Code == config.REQ_TEL):
+            Telemetry = self.Telemetry()
+            for Block in Telemetry:
+                Block[0] = self.Names[Block[0]]
+            return config.RESP_TEL_SUCCESS, json.dumps(Telemetry).encode('ascii')
+        if(Code == config.REQ_TEL_BINARY):
+            Data = bytearray()
+            for Index, Interval, Offset, Values in self.Telemetry():
+                Data += TELEMETRY_HEADER.pack(Index, 0, len(Values), Interval, max(Offset, 0))
+                Data += struct.pack('<{}f'.format(len(Values)), *Values)
+            return config.RESP_TEL_BINARY_SUCCESS, CobsEncode(Data)
+        if(Code == config.SET_SAMPLEINTERVAL):
+            try:
+                for Name, Interval in json.loads(Payload.decode('ascii')):
+                    if(Name not in self.Names):
+                        return config.RESP_SAMPLEINTERVAL_NOSENSOR, b'\n'
+                return config.RESP_SAMPLEINTERVAL_SUCCESS, b'\n'
+            except (ValueError, TypeError):
+                return config.RESP_SAMPLEINTERVAL_JSONERROR, b'\n'
+        return config.RESP_INVALID_FUNCTIONCODE, b'\n'
+
+class BusSimulator:
+    def __init__(
+            self,
+            Modules: list,
+            Latency: float = 0.002,
+            DropRate: float = 0.0,
+            CorruptRate: float = 0.0,
+            Baudrate: int = 115200,
+            Slot: float = 0.04,
+            Seed = None
+        ):
+        self.Modules = {Module.Address: Module for Module in Modules}
+        # Processing time of a module before it starts answering (s)
+        self.Latency = Latency
+        # Fraction of requests which are not answered
+        self.DropRate = DropRate
+        # Fraction of requests and of responses in which a byte is damaged
+        self.CorruptRate = CorruptRate
+        # Bytes are written at the speed of the simulated line, 10 bits per byte
+        self.ByteTime = 10.0 / Baudrate if Baudrate else 0.0
+        # Broadcast response time slot (s), BROADCAST_SLOT_TIME in the firmware
+        self.Slot = Slot
+        self.Random = random.Random(Seed)
+        self.Requests = 0
+        self.Dropped = 0
+        self.Corrupted = 0
+        self.Running = False
+        self.Thread = None
+        self.Master, self.Slave = os.openpty()
+        tty.setraw(self.Slave)
+        self.PortName = os.ttyname(self.Slave)
+
+    def Start(self):
+        self.Running = True
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    def Stop(self):
+        self.Running = False
+        if(self.Thread is not None):
+            self.Thread.join()
+        os.close(self.Master)
+        os.close(self.Slave)
+
+    # Write a frame in small chunks, so the first bytes arrive before the whole frame is on the line
+    def Write(self, Frame: bytes, Chunk: int = 16):
+        for Start in range(0, len(Frame), Chunk):
+            Piece = Frame[Start:Start + Chunk]
+            if(self.ByteTime > 0):
+                time.sleep(len(Piece) * self.ByteTime)
+            os.write(self.Master, Piece)
+
+    # Damage a random byte between the start byte and MSG_END
+    def Corrupt(self, Frame: bytes):
+        if(len(Frame) < 3 or self.Random.random() >= self.CorruptRate): return Frame
+        self.Corrupted += 1
+        Frame = bytearray(Frame)
+        Frame[self.Random.randrange(1, len(Frame) - 1)] ^= self.Random.randrange(1, 256)
+        return bytes(Frame)
+
+    def Answer(self, Module: SimulatedModule, Code: int, Payload: bytes, Crc: bool):
+        if(self.Random.random() < self.DropRate):
+            self.Dropped += 1
+            return
+        if(Code == config.REQ_RETRANSMIT):
+            if(Module.LastFrame is None):
+                ResponseCode, Data = config.RESP_NO_RETRANSMIT, b'\n'
+            else:
+                self.Write(self.Corrupt(bytes([config.RESP_START_CRC]) + Module.LastFrame + bytes([config.MSG_END])))
+                return
+        elif(Code is None):
+            ResponseCode, Data = config.RESP_REQUEST_CRC_ERROR, b'\n'
+        else:
+            ResponseCode, Data = Module.Respond(Code, Payload)
+        Body = bytes([Module.Address, ResponseCode]) + Data
+        Trailer = CrcTrailer(Body)
+        # A damaged request was not processed, the last response stays available
+        if(Code is not None and Code != config.REQ_RETRANSMIT):
+            Module.LastFrame = Body + Trailer
+        if(Crc):
+            Frame = bytes([config.RESP_START_CRC]) + Body + Trailer + bytes([config.MSG_END])
+        else:
+            Frame = bytes([config.RESP_START]) + Body + bytes([config.MSG_END])
+        self.Write(self.Corrupt(Frame))
+
+    def Process(self, Request: bytes):
+        if(len(Request) < 3 or Request[0] not in (config.MSG_START, config.MSG_START_CRC)): return
+        self.Requests += 1
+        Request = self.Corrupt(Request + bytes([config.MSG_END]))[:-1]
+        Address, Code, Payload = Request[1], Request[2], Request[3:]
+        Crc = Request[0] == config.MSG_START_CRC
+        if(Crc):
+            Payload = Payload[:-4]
+            if(len(Request) < 7 or Request[-4:] != CrcTrailer(Request[1:-4])):
+                # Answered with RESP_REQUEST_CRC_ERROR, if the address survived
+                Code = None
+        Received = time.monotonic()
+        if(Address == config.ADDRESS_BROADCAST):
+            # Every module answers in the time slot of its address
+            for Module in sorted(self.Modules.values(), key=lambda Module: Module.Address):
+                Delay = Received + Module.Address * self.Slot - time.monotonic()
+                if(Delay > 0): time.sleep(Delay)
+                self.Answer(Module, Code, Payload, Crc)
+        elif(Address in self.Modules):
+            time.sleep(self.Latency)
+            self.Answer(self.Modules[Address], Code, Payload, Crc)
+
+    def Run(self):
+        Buffer = bytearray()
+        while(self.Running):
+            Readable, _, _ = select.select([self.Master], [], [], 0.1)
+            if(not Readable): continue
+            try:
+                Buffer += os.read(self.Master, 4096)
+            except OSError:
+                break
+            while(True):
+                End = Buffer.find(config.MSG_END)
+                if(End < 0): break
+                Request = bytes(Buffer[:End])
+                del Buffer[:End + 1]
+                self.Process(Request)
+
+if __name__ == '__main__':
+    Count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    Simulator = BusSimulator([SimulatedModule(Address) for Address in range(1, Count + 1)])
+    Simulator.Start()
+    print('Simulating {} modules on {}'.format(Count, Simulator.PortName))
+    try:
+        while(True):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        Simulator.Stop()
@@ -0,0 +1,128 @@
+# Tests of the framing of the serial protocol. Run with python -m pytest in this directory.
+
+import binascii
+import json
+import random
+import pytest
+import config
+from benchmark_framing import RandomFrame, RandomGarbage
+from framing import CobsEncode, CobsDecode, Crc16, CrcTrailer, ParseFrame, FrameDecoder, ConstructResponse
+
+# Runs of non-zero bytes around the length of a full COBS block, with and without zeros after them
+@pytest.mark.parametrize('Length', [1, 253, 254, 255, 508, 509])
+@pytest.mark.parametrize('Tail', [b'', b'\x00', b'\x00\x05', b'\x00\x00'])
+def test_cobs_round_trip(Length, Tail):
+    Data = b'\x01' * Length + Tail
+    Encoded = CobsEncode(Data)
+    assert 0 not in Encoded
+    assert bytes(CobsDecode(Encoded)) == Data
+
+def test_cobs_full_block_followed_by_zero():
+    Encoded = CobsEncode(b'\x01' * 254 + b'\x00\x05')
+    # The full block, an empty block for the zero and the block with 0x05
+    assert Encoded == b'\xff' + b'\x01' * 254 + b'\x01\x02\x05'
+
+@pytest.mark.parametrize('Data', [b'', b'\x00', b'\x00\x00', b'\x11\x22\x00\x33'])
+def test_cobs_short(Data):
+    assert bytes(CobsDecode(CobsEncode(Data))) == Data
+
+def test_cobs_invalid_block():
+    with pytest.raises(ValueError):
+        CobsDecode(b'\x05\x01')
+
+# Decoding of the fields of a single frame as ConstructResponse did before the frame decoder existed, frozen here as
+# the reference for the frame decoder. Two changes were made on purpose since: a payload of only whitespace (the
+# newline the firmware sends without payload) is no payload, and frames with a CRC trailer are checked first.
+def BaselineFields(Frame: bytes):
+    if(Frame[0] == config.RESP_START_CRC):
+        Body, Trailer = Frame[1:-5], Frame[-5:-1]
+        if(b'%04X' % binascii.crc_hqx(Body, 0xFFFF) != Trailer):
+            return {'ResponseCode': config.RESP_CRC_ERROR}
+        Frame = bytes([config.RESP_START]) + Body + bytes([config.MSG_END])
+    if(len(Frame) == 4 or Frame[3:-1].isspace()):
+        return {'ResponseCode': int(Frame[2])}
+    try:
+        String = Frame[3:-1].decode('ascii')
+        PH = json.loads(String)
+        return {'ResponseCode': int(Frame[2]), 'Message': PH}
+    except UnicodeDecodeError:
+        return {'ResponseCode': config.RESP_BYTE_DECODE_ERROR}
+    except json.JSONDecodeError:
+        return {'ResponseCode': config.RESP_JSON_DECODE_ERROR}
+
+REQUEST = bytes([config.MSG_START, 5, config.REQ_TEL, config.MSG_END])
+
+def test_crc16():
+    # Check value of CRC-16/CCITT-FALSE
+    assert Crc16(b'123456789') == 0x29B1
+    assert CrcTrailer(b'\x05\x14') == b'B04F'
+
+# Frames and the fields they decode to
+@pytest.mark.parametrize('Frame, Fields', [
+    (b'R\x05\x14\x00', {'ResponseCode': config.RESP_TEL_NO_NEW_VALUES}),
+    (b'R\x05\x14\n\x00', {'ResponseCode': config.RESP_TEL_NO_NEW_VALUES}),
+    (b'R\x05\x11[["T",100,7,[1.5,2]]]\x00', {'ResponseCode': config.RESP_TEL_SUCCESS, 'Message': [['T', 100, 7, [1.5, 2]]]}),
+    (b'R\x05\x11[1,2\x00', {'ResponseCode': config.RESP_JSON_DECODE_ERROR}),
+    (b'R\x05\x11\xff\xfe\x00', {'ResponseCode': config.RESP_BYTE_DECODE_ERROR}),
+    (b'S\x05\x14B04F\x00', {'ResponseCode': config.RESP_TEL_NO_NEW_VALUES}),
+    (b'S\x05\x11[1]4C8B\x00', {'ResponseCode': config.RESP_TEL_SUCCESS, 'Message': [1]}),
+    (b'S\x05\x11[2]4C8B\x00', {'ResponseCode': config.RESP_CRC_ERROR}),
+    (b'S\x05\x11[1]XXXX\x00', {'ResponseCode': config.RESP_CRC_ERROR}),
+])
+def test_parse_frame(Frame, Fields):
+    assert ParseFrame(memoryview(Frame)) == (5, Fields)
+    assert BaselineFields(Frame) == Fields
+
+def test_binary_telemetry():
+    # Sensor 0, int32 values, 2 values, every 100 ms, offset 5 ms
+    Payload = b'\x00\x01\x02\x00' + b'\x64\x00\x00\x00' + b'\x05\x00\x00\x00' + b'\x01\x00\x00\x00' + b'\xfe\xff\xff\xff'
+    Frame = bytes([config.RESP_START, 5, config.RESP_TEL_BINARY_SUCCESS]) + CobsEncode(Payload) + bytes([config.MSG_END])
+    assert ParseFrame(memoryview(Frame)) == (5, {'ResponseCode': config.RESP_TEL_BINARY_SUCCESS, 'Message': [[0, 100, 5, [1, -2]]]})
+    # A truncated block
+    Frame = bytes([config.RESP_START, 5, config.RESP_TEL_BINARY_SUCCESS]) + CobsEncode(Payload[:-1]) + bytes([config.MSG_END])
+    assert ParseFrame(memoryview(Frame)) == (5, {'ResponseCode': config.RESP_BYTE_DECODE_ERROR})
+
+@pytest.mark.parametrize('Input, ResponseCode', [
+    (b'', config.RESP_TIMEOUT),
+    (b'R\x05\x00', config.RESP_INVALID_HEADER),
+    (b'X\x05\x14\x00', config.RESP_INVALID_HEADER),
+    (b'R\x05\x14\n', config.RESP_INVALID_HEADER),
+    (b'R\x05\x14\x00', config.RESP_TEL_NO_NEW_VALUES),
+])
+def test_construct_response(Input, ResponseCode):
+    Message = ConstructResponse(REQUEST, Input)
+    assert Message['ResponseCode'] == ResponseCode
+    assert (Message['Address'], Message['FunctionCode']) == (5, config.REQ_TEL)
+
+def test_decoder_chunks_and_garbage():
+    Decoder = FrameDecoder()
+    Stream = b'\x01\x02R\x05\x14\x00garbage\x00R\x06\x11[1]\x00S\x07\x14'
+    Frames = []
+    for Position in range(len(Stream)):
+        Frames += Decoder.Feed(Stream[Position:Position + 1])
+    assert Frames == [(5, {'ResponseCode': config.RESP_TEL_NO_NEW_VALUES}), (6, {'ResponseCode': config.RESP_TEL_SUCCESS, 'Message': [1]})]
+    # The last frame is completed by the next chunk
+    assert Decoder.Feed(b'F0A4\x00') == [(7, {'ResponseCode': config.RESP_CRC_ERROR})]
+    assert Decoder.Discarded == len(b'\x01\x02garbage\x00')
+
+def test_decoder_frame_too_long():
+    Decoder = FrameDecoder(MaxFrameSize=16)
+    # A start byte without a delimiter within the maximum frame size is garbage
+    assert Decoder.Feed(b'R' + b'x' * 20) == []
+    assert Decoder.Feed(b'R\x05\x14\x00') == [(5, {'ResponseCode': config.RESP_TEL_NO_NEW_VALUES})]
+    assert Decoder.Discarded == 21
+
+# Random frames with garbage between them, cut into random chunks, decode like the frozen baseline decodes each frame
+def test_decoder_fuzz():
+    Rng = random.Random(1)
+    for Iteration in range(2000):
+        Frames = [RandomFrame(Rng) for _ in range(Rng.randint(1, 5))]
+        Stream = b''.join(RandomGarbage(Rng) + Frame for Frame in Frames) + RandomGarbage(Rng)
+        Decoder = FrameDecoder()
+        Decoded = []
+        Position = 0
+        while(Position < len(Stream)):
+            Size = Rng.randint(1, 64)
+            Decoded += Decoder.Feed(Stream[Position:Position + Size])
+            Position += Size
+        assert Decoded == [(Frame[1], BaselineFields(Frame)) for Frame in Frames], 'Iteration {}'.format(Iteration)
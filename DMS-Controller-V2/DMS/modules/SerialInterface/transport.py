@@ -0,0 +1,105 @@
+# Asyncio wrapper around a pyserial port.
+# pyserial only offers blocking calls. Every call that touches the port is run on a single worker thread,
+# so the event loop (and with it the message receiver, sender and twin updates) keeps running while
+# the adapter waits for a module to answer. The single worker also guarantees that requests on the bus never overlap.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+import config
+from framing import FrameDecoder
+
+# Port timeout (s). Reads block for at most this long, the timeouts of a transaction are checked between reads.
+# Setting the port timeout reconfigures the tty, so it is only set when the port is configured.
+READ_SLICE = 0.002
+
+class SerialTransport:
+    def __init__(self, Port: serial.Serial):
+        self.Port = Port
+        # Time to wait for the next byte of a response (s), the TIMEOUT setting of the port
+        self.Timeout = Port.timeout
+        Port.timeout = READ_SLICE
+        self.Executor = ThreadPoolExecutor(max_workers=1)
+        self.Decoder = FrameDecoder()
+
+    # Run a blocking function on the serial worker thread
+    async def Run(self, Function, *Args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.Executor, Function, *Args)
+
+    # Apply new port settings. The port is reopened on the worker thread, so no transaction can be in progress.
+    async def Reconfigure(self, Settings: dict):
+        await self.Run(self.ReconfigureBlocking, Settings)
+
+    def ReconfigureBlocking(self, Settings: dict):
+        self.Port.close()
+        self.Port.baudrate = Settings['BAUDRATE']
+        self.Port.bytesize = Settings['DATABITS']
+        self.Port.parity = Settings['PARITY']
+        self.Port.stopbits = Settings['STOPBITS']
+        self.Timeout = Settings['TIMEOUT']
+        self.Port.timeout = READ_SLICE
+        self.Port.port = Settings['SERIALPORT']
+        self.Port.open()
+
+    # Send a request and wait for the response.
+    # Returns the decoded frames and the number of bytes received, so the caller can tell a timeout from garbage,
+    # and the time until the first byte of the response arrived (None on a timeout).
+    # FirstByteTimeout (s) limits the wait for the module to start answering, after that the port timeout applies.
+    async def Transact(self, Data: bytes, FirstByteTimeout = None):
+        return await self.Run(self.TransactBlocking, Data, {Data[1]}, None, FirstByteTimeout)
+
+    # Send a broadcast request and collect the responses of all modules, until every address in Addresses
+    # has answered or the window (s) has passed.
+    async def Broadcast(self, Data: bytes, Addresses: list, Window: float):
+        return await self.Run(self.TransactBlocking, Data, set(Addresses), time.monotonic() + Window)
+
+    def TransactBlocking(self, Data: bytes, Addresses: set, Deadline, FirstByteTimeout = None):
+        # Discard any previous responses that failed the timeout deadline but still arrived
+        self.Port.reset_input_buffer()
+        self.Decoder.Reset()
+        self.Port.write(Data)
+        Sent = time.monotonic()
+        return self.ReadFrames(Addresses, Sent, Deadline, FirstByteTimeout)
+
+    # Read in bulk until a frame from each of the addresses is decoded.
+    # Each read returns whatever is waiting in the driver buffer, or blocks for one byte for at most READ_SLICE.
+    # Without a deadline, the read ends when no byte arrived for the TIMEOUT of the port. If a first byte timeout
+    # is given, it replaces TIMEOUT until the first byte has arrived. Responses to a broadcast may be separated by
+    # silent time slots, so with a deadline the read only ends at the deadline.
+    def ReadFrames(self, Addresses: set, Sent: float, Deadline = None, FirstByteTimeout = None):
+        Frames = []
+        Received = 0
+        Latency = None
+        Remaining = set(Addresses)
+        # Time by which the next byte must have arrived
+        if(Deadline is not None):
+            Wait = Deadline
+        else:
+            Wait = Sent + (FirstByteTimeout if FirstByteTimeout is not None else self.Timeout)
+        while(True):
+            Chunk = self.Port.read(max(1, self.Port.in_waiting))
+            Now = time.monotonic()
+            if(len(Chunk) == 0):
+                # Timeout
+                if(Now >= Wait): break
+                continue
+            if(Received == 0):
+                Latency = Now - Sent
+            if(Deadline is None):
+                # The module is answering, the rest of the response may take as long as the port timeout allows
+                Wait = Now + self.Timeout
+            Received += len(Chunk)
+            Decoded = self.Decoder.Feed(Chunk)
+            Frames += Decoded
+            Remaining.difference_update(Frame[0] for Frame in Decoded)
+            if(len(Addresses) > 0 and len(Remaining) == 0): break
+            # Only one module answers a unicast request, a damaged frame ends it since its address can't be trusted
+            if(Deadline is None and any(Fields['ResponseCode'] == config.RESP_CRC_ERROR for Address, Fields in Decoded)): break
+            if(Deadline is not None and Now >= Deadline): break
+        return Frames, Received, Latency
+
+    def Close(self):
+        self.Port.close()
+        self.Executor.shutdown(wait=False)
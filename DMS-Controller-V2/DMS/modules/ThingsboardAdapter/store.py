@@ -0,0 +1,82 @@
+# Store-and-forward of telemetry messages which could not be delivered to the data platform.
+# Ensure that this file is equal in the ThingsboardAdapter and IshareAdapter modules.
+# Messages are appended to an SQLite database in WAL mode, on a volume of the host, so they survive a restart of
+# the module. The store is bounded: when it grows beyond MaxBytes, the oldest messages are removed first. Messages
+# are read back oldest first, in batches, and removed once the data platform accepted or refused them.
+
+import os
+import sqlite3
+
+# Messages read at once when the oldest messages are evicted
+EVICT_BATCH = 1000
+
+class MessageStore:
+    def __init__(self, Path: str, MaxBytes: int):
+        Directory = os.path.dirname(Path)
+        if(Directory):
+            os.makedirs(Directory, exist_ok=True)
+        self.MaxBytes = MaxBytes
+        self.Connection = sqlite3.connect(Path)
+        self.Connection.execute('PRAGMA journal_mode=WAL')
+        # A power loss may lose the last transactions, but never corrupts the database
+        self.Connection.execute('PRAGMA synchronous=NORMAL')
+        self.Connection.execute('CREATE TABLE IF NOT EXISTS Messages (Id INTEGER PRIMARY KEY AUTOINCREMENT, Body TEXT NOT NULL)')
+        self.Connection.commit()
+        self.Count, self.Bytes = self.Connection.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(Body)), 0) FROM Messages').fetchone()
+        self.Stats = {
+            'Stored': 0,
+            'Forwarded': 0,
+            'Rejected': 0,
+            'Evicted': 0
+        }
+
+    def __len__(self):
+        return self.Count
+
+    def Append(self, Body: str):
+        with self.Connection:
+            self.Connection.execute('INSERT INTO Messages (Body) VALUES (?)', (Body,))
+        self.Count += 1
+        self.Bytes += len(Body)
+        self.Stats['Stored'] += 1
+        self.Evict()
+
+    # Remove the oldest messages until the store fits in MaxBytes
+    def Evict(self):
+        while(self.Bytes > self.MaxBytes and self.Count > 0):
+            Rows = self.Connection.execute('SELECT Id, LENGTH(Body) FROM Messages ORDER BY Id LIMIT ?', (EVICT_BATCH,)).fetchall()
+            Last = None
+            Count = 0
+            Bytes = 0
+            for Id, Length in Rows:
+                if(self.Bytes - Bytes <= self.MaxBytes): break
+                Last = Id
+                Count += 1
+                Bytes += Length
+            with self.Connection:
+                self.Connection.execute('DELETE FROM Messages WHERE Id <= ?', (Last,))
+            self.Count -= Count
+            self.Bytes -= Bytes
+            self.Stats['Evicted'] += Count
+
+    # The oldest messages, at most Limit, as (id, body)
+    def Peek(self, Limit: int):
+        return self.Connection.execute('SELECT Id, Body FROM Messages ORDER BY Id LIMIT ?', (Limit,)).fetchall()
+
+    # Remove the messages up to Id, after they were delivered or rejected by the data platform
+    def Remove(self, Id: int, Delivered: bool = True):
+        Count, Bytes = self.Connection.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(Body)), 0) FROM Messages WHERE Id <= ?', (Id,)).fetchone()
+        with self.Connection:
+            self.Connection.execute('DELETE FROM Messages WHERE Id <= ?', (Id,))
+        self.Count -= Count
+        self.Bytes -= Bytes
+        self.Stats['Forwarded' if Delivered else 'Rejected'] += Count
+
+    def Report(self):
+        Report = dict(self.Stats)
+        Report['Messages'] = self.Count
+        Report['Bytes'] = self.Bytes
+        return Report
+
+    def Close(self):
+        self.Connection.close()
@@ -32,6 +32,12 @@ class Interface
         // Buffer for incoming messages from DMS controller
         char mMessageBuffer[INBUFFER_SIZE] = {0};
         uint16_t mWritePointer = 0;
+
+        // Broadcast request waiting for the time slot of this module
+        char mBroadcastBuffer[INBUFFER_SIZE] = {0};
+        bool mBroadcastPending = false;
+        uint32_t mBroadcastReceived = 0;
+        uint32_t mBroadcastDelay = 0;
         
         // Information about this module
         // Module name. Should, but not must, be unique. Can be used in the i-share invironment to identify a module
@@ -48,13 +54,19 @@ class Interface
         void SetUpdateInterval(const char* Msg);
         Sensor* FindSensorByName(const char* Name);
 		void ProcessMessage(const char* Msg);
+        void ScheduleBroadcast(const char* Msg, uint32_t Delay);
+        void ProcessBroadcast();
         void SendTelemetry();
+        void SendTelemetryBinary();
 		void SendAttributes();
 		void GatherValues();
         void ClearBuffer();
+        // Add attributes of the data link to the attribute response
+        virtual void AddLinkAttributes(JsonDocument& Doc);
 		virtual void Send(char ResponseCode, const char* MsgPtr);
         virtual void Send(char ResponseCode);
         virtual void Send(char ResponseCode, JsonDocument& Doc);
+        virtual void Send(char ResponseCode, const uint8_t* Data, uint16_t Length);
 	public:
         template<unsigned int MaxSampleInterval>
         uint16_t AddSensor(const char* const Name, const char* const Unit, const uint32_t SampleInterval, FLOAT_CALLBACK_SIGNATURE);
@@ -179,6 +191,25 @@ class Interface
         }
         Send(RESP_GET_TIMESTAMP_SUCCESS, Timestamp);
     }
+
+    // Store a broadcast request, to be processed once the time slot of this module has started
+    void Interface::ScheduleBroadcast(const char* Msg, uint32_t Delay)
+    {
+        strncpy(mBroadcastBuffer, Msg, INBUFFER_SIZE - 1);
+        mBroadcastReceived = millis();
+        mBroadcastDelay = Delay;
+        mBroadcastPending = true;
+    }
+
+    // Process the pending broadcast request if the time slot of this module has started
+    void Interface::ProcessBroadcast()
+    {
+        if(mBroadcastPending && millis() - mBroadcastReceived >= mBroadcastDelay)
+        {
+            mBroadcastPending = false;
+            ProcessMessage(mBroadcastBuffer);
+        }
+    }
 //
 
 // MESSAGING
@@ -195,6 +226,9 @@ class Interface
             case REQ_TEL:
                 SendTelemetry();
                 break;
+            case REQ_TEL_BINARY:
+                SendTelemetryBinary();
+                break;
             case REQ_ATT:
                 SendAttributes();
                 break;
@@ -219,6 +253,11 @@ class Interface
         Doc["HWV"] = mHardwareVersion;
         Doc["SWV"] = mSoftwareVersion;
         Doc["Time"] = millis();
+        // This module answers binary telemetry requests
+        Doc["BIN"] = 1;
+        // Seconds of values a sensor stores at its fastest sample rate (SR), before its buffer overflows
+        Doc["MEM"] = SENSORMEMORY_SIZE;
+        AddLinkAttributes(Doc);
         JsonArray DocSensors = Doc.createNestedArray("Sensors");
         
         for(int i = 0; i < mSensorsRegistered; i++)
@@ -344,6 +383,72 @@ class Interface
         Send(RESP_TEL_SUCCESS, Telemetry);
     }
 
+    void Interface::SendTelemetryBinary()
+    {
+        /** Payload layout, all numbers little-endian. For each sensor with new values:
+            uint8_t     sensor index, in the order of the attribute response
+            uint8_t     value type (TELEMETRY_TYPE_*)
+            uint16_t    number of values
+            uint32_t    sample interval (ms)
+            uint32_t    timestamp of value_0 (ms since module start)
+            values      4 bytes each for float and int, 1 byte each for bool
+        */
+        if(mDebug)
+        {
+            mDebug->print(F("SendTelemetryBinary\n"));
+        }
+        if(mSensorsRegistered == 0)
+        {
+            Send(RESP_TEL_NO_SENSORS);
+            return;
+        }
+        uint8_t Buffer[OUTBUFFER_SIZE];
+        uint16_t Length = 0;
+        for(uint8_t i = 0; i < mSensorsRegistered; i++)
+        {
+            Sensor* Ptr = mSensorStore[i];
+            if(Ptr->mWritePointer == 0) continue;
+            if(Length + TELEMETRY_HEADER_SIZE > OUTBUFFER_SIZE)
+            {
+                Send(RESP_TEL_ERROR);
+                return;
+            }
+            uint8_t* Header = Buffer + Length;
+            uint16_t Count = Ptr->mWritePointer;
+            uint32_t Interval = Ptr->mUpdateInterval;
+            uint32_t Timestamp = Ptr->mTimestamp;
+            uint16_t Written = Ptr->GetBinary(Header + TELEMETRY_HEADER_SIZE, OUTBUFFER_SIZE - Length - TELEMETRY_HEADER_SIZE);
+            if(Written == 0)
+            {
+                Send(RESP_TEL_ERROR);
+                if(mDebug)
+                {
+                    mDebug->print(F("\tError - Values too long for buffer\n"));
+                }
+                return;
+            }
+            Header[0] = i;
+            Header[1] = Ptr->GetType();
+            memcpy(Header + 2, &Count, sizeof(Count));
+            memcpy(Header + 4, &Interval, sizeof(Interval));
+            memcpy(Header + 8, &Timestamp, sizeof(Timestamp));
+            Length += TELEMETRY_HEADER_SIZE + Written;
+        }
+        if(Length == 0)
+        {
+            // there are no new values.
+            Send(RESP_TEL_NO_NEW_VALUES);
+            return;
+        }
+        Send(RESP_TEL_BINARY_SUCCESS, Buffer, Length);
+    }
+
+    void Interface::AddLinkAttributes(JsonDocument& Doc)
+    {
+        // Nuthin'
+        // This funcion is implemented at the derived classes.
+    }
+
     void Interface::Send(char ResponseCode, const char* MsgPtr)
     {
         // Nuthin'
@@ -360,6 +465,12 @@ class Interface
         // Nuthin'
         // This funcion is implemented at the derived classes.
     }
+
+    void Interface::Send(char ResponseCode, const uint8_t* Data, uint16_t Length)
+    {
+        // Nuthin'
+        // This funcion is implemented at the derived classes.
+    }
 // 
 
 // SENSOR REGISTRATION
@@ -445,6 +556,8 @@ class Interface
     {
         // Listen for incoming messages.
         Listen();
+        // Answer a broadcast request if it is our turn.
+        ProcessBroadcast();
         // Check if a measurement needs to be done.
         GatherValues();
     }
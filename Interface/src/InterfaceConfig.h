@@ -16,10 +16,21 @@ Ensure that the functioncodes in this header are the same as the functioncodes i
 // Addresses
 // Broadcast address. All modules will process information sent to this address
 #define ADDRESS_BROADCAST 0xfe
+// Modules answer a broadcast request after (address * BROADCAST_SLOT_TIME) ms, so their responses don't collide.
+// A slot must fit the largest response: OUTBUFFER_SIZE bytes take about 35 ms at 115200 baud.
+// Ensure that this value is equal to BROADCASTSLOT (in seconds) in the SerialInterface module twin.
+#define BROADCAST_SLOT_TIME 40
 
 // Message codes
 // Request type neutral response codes
 #define RESP_INVALID_FUNCTIONCODE 0x07
+// Frame integrity. 0x08 is used by the SerialInterface edge module for responses which failed their CRC check.
+// Send the last response frame again
+#define REQ_RETRANSMIT 0x09
+// The request frame failed its CRC check and was not processed
+#define RESP_REQUEST_CRC_ERROR 0x0A
+// There is no response frame to send again
+#define RESP_NO_RETRANSMIT 0x0B
 
 // Request latest telemetry from module
 #define REQ_TEL 0x10
@@ -29,6 +40,17 @@ Ensure that the functioncodes in this header are the same as the functioncodes i
 #define RESP_TEL_NO_SENSORS 0x13
 #define RESP_TEL_NO_NEW_VALUES 0x14
 
+// Request latest telemetry from module, as a COBS encoded binary payload instead of JSON
+#define REQ_TEL_BINARY 0x15
+// Module response code to a binary telemetry request. The other telemetry response codes are used as well.
+#define RESP_TEL_BINARY_SUCCESS 0x16
+// Size of the header in front of the values of each sensor in a binary telemetry payload
+#define TELEMETRY_HEADER_SIZE 12
+// Value types in a binary telemetry payload
+#define TELEMETRY_TYPE_FLOAT 0
+#define TELEMETRY_TYPE_INT 1
+#define TELEMETRY_TYPE_BOOL 2
+
 // Request attributes from module
 #define REQ_ATT 0x20
 // Response codes to attribute request
@@ -51,11 +73,19 @@ Ensure that the functioncodes in this header are the same as the functioncodes i
 
 #define MSG_START 77 // 'M'
 #define RESP_START 82 // 'R'
+// Frames starting with these bytes end with a CRC16 (CCITT, initial value 0xFFFF) of the address, code and payload,
+// written as 4 hexadecimal characters in front of MESSAGE_END. A request with a CRC is answered with one.
+#define MSG_START_CRC 67 // 'C'
+#define RESP_START_CRC 83 // 'S'
+#define CRC_SIZE 4
 #define MESSAGE_END 0
 
 // Sensor module specific settings
 #define OUTBUFFER_SIZE 400
 #define INBUFFER_SIZE 100
+// Copy of the last response frame for REQ_RETRANSMIT: address, response code and payload. 
+// Binary payloads grow by a few bytes due to COBS.
+#define RETRANSMIT_BUFFER_SIZE (OUTBUFFER_SIZE + 8)
 
 // Max number of sensors of a datatype the module interface accepts.
 #define SENSORBUFFER_SIZE 10
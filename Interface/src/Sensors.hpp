@@ -48,6 +48,11 @@ class Sensor
         // {}
         virtual InterfaceError Update(uint32_t TimeStamp) = 0;
         virtual void Get(JsonArray& Values) = 0;
+        // Write the stored values to Buffer as little-endian binary. Returns the number of bytes written, 
+        // or 0 if the values don't fit in Size bytes. In that case the values are kept.
+        virtual uint16_t GetBinary(uint8_t* Buffer, uint16_t Size) = 0;
+        // One of the TELEMETRY_TYPE values
+        virtual uint8_t GetType() = 0;
     public:
         void SetUpdateInterval(uint32_t UpdateInterval)
         {
@@ -103,6 +108,25 @@ class FloatSensor: public Sensor
             mUpdateInterval = mNextUpdateInterval;
         }
 
+        uint16_t GetBinary(uint8_t* Buffer, uint16_t Size)
+        {
+            uint16_t Length = mWritePointer * sizeof(float);
+            if(Length > Size) return 0;
+            for(uint8_t i = 0; i < mWritePointer; i++)
+            {
+                float Value = mValueStore[i];
+                memcpy(Buffer + i * sizeof(float), &Value, sizeof(float));
+            }
+            mWritePointer = 0;
+            mUpdateInterval = mNextUpdateInterval;
+            return Length;
+        }
+
+        uint8_t GetType()
+        {
+            return TELEMETRY_TYPE_FLOAT;
+        }
+
         FLOAT_CALLBACK_SIGNATURE;
     public:
         friend class FRIEND_CLASS;
@@ -150,6 +174,25 @@ class IntSensor: public Sensor
             mUpdateInterval = mNextUpdateInterval;
         }
 
+        uint16_t GetBinary(uint8_t* Buffer, uint16_t Size)
+        {
+            uint16_t Length = mWritePointer * sizeof(int32_t);
+            if(Length > Size) return 0;
+            for(uint8_t i = 0; i < mWritePointer; i++)
+            {
+                int32_t Value = mValueStore[i];
+                memcpy(Buffer + i * sizeof(int32_t), &Value, sizeof(int32_t));
+            }
+            mWritePointer = 0;
+            mUpdateInterval = mNextUpdateInterval;
+            return Length;
+        }
+
+        uint8_t GetType()
+        {
+            return TELEMETRY_TYPE_INT;
+        }
+
         INT_CALLBACK_SIGNATURE;
     public:
         friend class FRIEND_CLASS;
@@ -196,6 +239,25 @@ class BoolSensor: public Sensor
             mUpdateInterval = mNextUpdateInterval;
         }
 
+        uint16_t GetBinary(uint8_t* Buffer, uint16_t Size)
+        {
+            uint16_t Length = mWritePointer * sizeof(uint8_t);
+            if(Length > Size) return 0;
+            for(uint8_t i = 0; i < mWritePointer; i++)
+            {
+                uint8_t Value = mValueStore[i];
+                memcpy(Buffer + i * sizeof(uint8_t), &Value, sizeof(uint8_t));
+            }
+            mWritePointer = 0;
+            mUpdateInterval = mNextUpdateInterval;
+            return Length;
+        }
+
+        uint8_t GetType()
+        {
+            return TELEMETRY_TYPE_BOOL;
+        }
+
         BOOL_CALLBACK_SIGNATURE;
     public:
         friend class FRIEND_CLASS;
@@ -2,6 +2,62 @@
 #define SERIALINTERFACE_HPP
 #include "Interface.hpp"
 
+// CRC16 (CCITT, polynomial 0x1021) of the frames with a CRC trailer. Start with 0xFFFF.
+uint16_t Crc16Update(uint16_t Crc, uint8_t Byte)
+{
+	Crc ^= (uint16_t)Byte << 8;
+	for(uint8_t i = 0; i < 8; i++)
+	{
+		Crc = (Crc & 0x8000) ? (Crc << 1) ^ 0x1021 : Crc << 1;
+	}
+	return Crc;
+}
+
+// Writes the address, response code and payload of a response frame to the data link. On the way, the CRC is 
+// calculated and a copy of the frame is kept, so it can be sent again on a REQ_RETRANSMIT request.
+class FrameWriter: public Print
+{
+	public:
+		FrameWriter(Stream& Datalink):
+			mDatalink(&Datalink)
+		{}
+		// Start a new frame. Frames which are not recorded leave the last recorded frame available.
+		void Begin(bool Record)
+		{
+			mCrc = 0xFFFF;
+			mRecord = Record;
+			if(mRecord)
+			{
+				mLength = 0;
+				mValid = true;
+			}
+		}
+		void End()
+		{
+			if(mRecord) mFrameCrc = mCrc;
+		}
+		size_t write(uint8_t Byte)
+		{
+			mCrc = Crc16Update(mCrc, Byte);
+			if(mRecord)
+			{
+				if(mLength < RETRANSMIT_BUFFER_SIZE) mFrame[mLength++] = Byte;
+				// Too long to keep, it can't be sent again
+				else mValid = false;
+			}
+			return mDatalink->write(Byte);
+		}
+		using Print::write;
+		Stream* mDatalink;
+		// CRC of the frame being written
+		uint16_t mCrc = 0xFFFF;
+		// Last recorded frame and its CRC
+		uint8_t mFrame[RETRANSMIT_BUFFER_SIZE];
+		uint16_t mLength = 0;
+		uint16_t mFrameCrc = 0xFFFF;
+		bool mValid = false;
+		bool mRecord = false;
+};
 
 class SerialInterface: public Interface
 {
@@ -19,6 +75,7 @@ class SerialInterface: public Interface
 			):
 			Interface(ModuleName, HardwareVersion, SoftwareVersion, Debug),
 			mDatalink(&Datalink),
+			mWriter(Datalink),
 			mReadEnablePin(ReadEnablePin),
 			mWriteEnablePin(WriteEnablePin),
 			mThisAddress(ThisAddress)
@@ -35,6 +92,7 @@ class SerialInterface: public Interface
 			):
 			Interface(ModuleName, HardwareVersion, SoftwareVersion),
 			mDatalink(&Datalink),
+			mWriter(Datalink),
 			mReadEnablePin(ReadEnablePin),
 			mWriteEnablePin(WriteEnablePin),
 			mThisAddress(ThisAddress)
@@ -48,11 +106,23 @@ class SerialInterface: public Interface
 		// To use the default arduino serial port, pass Serial as an argument to the constructor.
 		// Must inherit from the Stream class.
 		Stream* mDatalink = nullptr;
+		// Writes the responses, keeps the last one for retransmission
+		FrameWriter mWriter;
 		const char mThisAddress;
         const uint8_t mReadEnablePin;
 		const uint8_t mWriteEnablePin;
+		// The request being answered had a CRC trailer, so the response gets one as well
+		bool mCrcRequest = false;
+		void AddLinkAttributes(JsonDocument& Doc);
+		bool CheckCrc();
+		void BeginFrame(char ResponseCode);
+		void EndFrame();
+		void WriteCrc(uint16_t Crc);
+		void Retransmit();
 		void Send(char ResponseCode, const char* MsgPtr);
 		void Send(char ResponseCode, JsonDocument& Doc);
+		void Send(char ResponseCode, const uint8_t* Data, uint16_t Length);
+		void WriteCobs(const uint8_t* Data, uint16_t Length);
 		// void Send(char ResponseCode);
 		
 };
@@ -62,62 +132,144 @@ class SerialInterface: public Interface
 // 	Send(ResponseCode, "\n");
 // }
 
-void SerialInterface::Send(char ResponseCode, const char* MsgPtr)
+void SerialInterface::AddLinkAttributes(JsonDocument& Doc)
+{
+	// This module checks and sends CRC trailers
+	Doc["CRC"] = 1;
+}
+
+// Switch the RS485 module to write mode and write the header of a response frame
+void SerialInterface::BeginFrame(char ResponseCode)
 {
 	if(mDebug)
 	{
 		mDebug->println(F("Sending message: "));
-		// mDebug->print(MsgPtr);
 	}
+	// if the serial port for debugging is the same as for the interface, wait for all debug 
+	// information to be transmitted before switching the RS485 module to write mode
+	// otherwise, the controller would receive debug strings as module responses
+	// This is not necessary if debug is disabled
 	mDatalink->flush();
 	digitalWrite(mReadEnablePin, true);
 	digitalWrite(mWriteEnablePin, true);
-	mDatalink->write(RESP_START);
-	mDatalink->write(mThisAddress);
-	mDatalink->write(ResponseCode);
-	mDatalink->write(MsgPtr);
-	mDatalink->write((uint8_t)0x00);
+	mDatalink->write(mCrcRequest ? RESP_START_CRC : RESP_START);
+	// Errors about the request itself don't replace the response that may be requested again
+	mWriter.Begin(ResponseCode != RESP_REQUEST_CRC_ERROR && ResponseCode != RESP_NO_RETRANSMIT);
+	mWriter.write((uint8_t)mThisAddress);
+	mWriter.write((uint8_t)ResponseCode);
+}
+
+// Write the CRC trailer if requested and the end of the frame, and switch the RS485 module back to read mode
+void SerialInterface::EndFrame()
+{
+	mWriter.End();
+	if(mCrcRequest) WriteCrc(mWriter.mCrc);
+	mDatalink->write((uint8_t)MESSAGE_END);
+	// wait for transmission of all bytes before resetting the rs485 flow control pins
 	mDatalink->flush();
 	digitalWrite(mWriteEnablePin, false);
 	digitalWrite(mReadEnablePin, false);
-	// if(mDebug)
-	// {
-	// 	mDebug->write(RESP_START);
-	// 	mDebug->write(mThisAddress);
-	// 	mDebug->write(ResponseCode);
-	// 	mDebug->print(MsgPtr);
-	// 	mDebug->write((uint8_t)0x00);
-	// }
-	
 }
 
-void SerialInterface::Send(char ResponseCode, JsonDocument& Doc)
+void SerialInterface::WriteCrc(uint16_t Crc)
+{
+	const char Digits[] = "0123456789ABCDEF";
+	for(int8_t Shift = 12; Shift >= 0; Shift -= 4)
+	{
+		mDatalink->write((uint8_t)Digits[(Crc >> Shift) & 0x0F]);
+	}
+}
+
+// Send the last response frame again, after the edge module received it damaged
+void SerialInterface::Retransmit()
 {
+	if(!mWriter.mValid)
+	{
+		Send(RESP_NO_RETRANSMIT, "\n");
+		return;
+	}
 	if(mDebug)
 	{
-		mDebug->println(F("Sending message: "));
-		// mDebug->print(MsgPtr);
-		
+		mDebug->println(F("Sending message again."));
 	}
-	// if the serial port for debugging is the same as for the interface, wait for all debug 
-	// information to be transmitted before switching the RS485 module to write mode
-	// otherwise, the controller would receive debug strings as module responses
-	// This is not necessary if debug is disabled
 	mDatalink->flush();
 	digitalWrite(mReadEnablePin, true);
 	digitalWrite(mWriteEnablePin, true);
-	mDatalink->write(RESP_START);
-	mDatalink->write(mThisAddress);
-	mDatalink->write(ResponseCode);
-	serializeJson(Doc, *mDatalink);
-	mDatalink->write((uint8_t)0x00);
-	// wait for transmission of all bytes before resetting the rs485 flow control pins
+	mDatalink->write(RESP_START_CRC);
+	mDatalink->write(mWriter.mFrame, mWriter.mLength);
+	WriteCrc(mWriter.mFrameCrc);
+	mDatalink->write((uint8_t)MESSAGE_END);
 	mDatalink->flush();
-	// delay(5);
 	digitalWrite(mWriteEnablePin, false);
 	digitalWrite(mReadEnablePin, false);
 }
 
+void SerialInterface::Send(char ResponseCode, const char* MsgPtr)
+{
+	BeginFrame(ResponseCode);
+	mWriter.print(MsgPtr);
+	EndFrame();
+}
+
+void SerialInterface::Send(char ResponseCode, JsonDocument& Doc)
+{
+	BeginFrame(ResponseCode);
+	serializeJson(Doc, mWriter);
+	EndFrame();
+}
+
+void SerialInterface::Send(char ResponseCode, const uint8_t* Data, uint16_t Length)
+{
+	BeginFrame(ResponseCode);
+	WriteCobs(Data, Length);
+	EndFrame();
+}
+
+// Check the CRC trailer of the request in the message buffer, and remove the trailer
+bool SerialInterface::CheckCrc()
+{
+	// Start byte, address, function code and trailer
+	if(mWritePointer < 3 + CRC_SIZE + 1) return false;
+	uint16_t End = mWritePointer - 1 - CRC_SIZE;
+	uint16_t Crc = 0xFFFF;
+	for(uint16_t i = 1; i < End; i++)
+	{
+		Crc = Crc16Update(Crc, (uint8_t)mMessageBuffer[i]);
+	}
+	uint16_t Received = 0;
+	for(uint16_t i = End; i < End + CRC_SIZE; i++)
+	{
+		char c = mMessageBuffer[i];
+		uint8_t Digit;
+		if(c >= '0' && c <= '9') Digit = c - '0';
+		else if(c >= 'A' && c <= 'F') Digit = c - 'A' + 10;
+		else if(c >= 'a' && c <= 'f') Digit = c - 'a' + 10;
+		else return false;
+		Received = (Received << 4) | Digit;
+	}
+	mMessageBuffer[End] = 0;
+	return Crc == Received;
+}
+
+// Write binary data with Consistent Overhead Byte Stuffing, so the data contains no MESSAGE_END bytes.
+// Every zero byte is replaced by the distance to the next zero byte. A distance of 255 means a run of 254 
+// non-zero bytes without a zero after it.
+void SerialInterface::WriteCobs(const uint8_t* Data, uint16_t Length)
+{
+	uint16_t Start = 0;
+	while(true)
+	{
+		uint16_t End = Start;
+		while(End < Length && Data[End] != 0 && End - Start < 254) End++;
+		mWriter.write((uint8_t)(End - Start + 1));
+		mWriter.write(Data + Start, End - Start);
+		if(End >= Length) break;
+		// A full block of 254 bytes has no zero after it, the next block starts right after it.
+		// Otherwise skip the zero which is replaced by the distance byte.
+		Start = (End - Start == 254) ? End : End + 1;
+	}
+}
+
 void SerialInterface::Listen()
 {
 	// Listen for requests from master
@@ -127,9 +279,9 @@ void SerialInterface::Listen()
 		char c = mDatalink->read();
 		mMessageBuffer[mWritePointer] = c;
 		mWritePointer++;
-		while(c != MESSAGE_END || millis() - StartTime < 500)
+		while(c != MESSAGE_END && millis() - StartTime < 500)
 		{
-			while(mDatalink->available() > 0)
+			while(c != MESSAGE_END && mDatalink->available() > 0 && mWritePointer < INBUFFER_SIZE)
 			{
 				// Le message est arrivé
 				c = mDatalink->read();
@@ -145,20 +297,41 @@ void SerialInterface::Listen()
 				mDebug->println(F("Serial message received."));
 				mDebug->println(mMessageBuffer);
 			}
-			if(mMessageBuffer[0] == RESP_START)
+			if(mMessageBuffer[0] == RESP_START || mMessageBuffer[0] == RESP_START_CRC)
 			{
 				if(mDebug) mDebug->println(F("Response message: Ignoring."));
 				ClearBuffer();
 				return;
 			}
 			// Message is not specifically for this module, or is a broadcasted message. Quittin'.
-			if(mMessageBuffer[1] != mThisAddress && mMessageBuffer[1] != ADDRESS_BROADCAST)
+			if(mMessageBuffer[1] != mThisAddress && (uint8_t)mMessageBuffer[1] != ADDRESS_BROADCAST)
 			{
 				if(mDebug) mDebug->println(F("Message is not for this module"));
 				ClearBuffer();
 				return;
 			}
-			ProcessMessage(&mMessageBuffer[2]);
+			mCrcRequest = (mMessageBuffer[0] == MSG_START_CRC);
+			if(mCrcRequest && !CheckCrc())
+			{
+				if(mDebug) mDebug->println(F("Message failed CRC check."));
+				// Modules don't answer a damaged broadcast, their answers would collide
+				if(mMessageBuffer[1] == mThisAddress) Send(RESP_REQUEST_CRC_ERROR, "\n");
+				ClearBuffer();
+				return;
+			}
+			if(mMessageBuffer[1] == mThisAddress && mMessageBuffer[2] == REQ_RETRANSMIT)
+			{
+				Retransmit();
+			}
+			else if((uint8_t)mMessageBuffer[1] == ADDRESS_BROADCAST)
+			{
+				// Answer in the time slot of this module, other modules are answering the same request
+				ScheduleBroadcast(&mMessageBuffer[2], (uint32_t)(uint8_t)mThisAddress * BROADCAST_SLOT_TIME);
+			}
+			else
+			{
+				ProcessMessage(&mMessageBuffer[2]);
+			}
 		}
 		else
 		{